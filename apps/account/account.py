@@ -1,21 +1,23 @@
 from core.base.viewbase import BaseView
-from fastapi import Request
+from fastapi import Request,Depends
 from core.schemas.account import LoginRequest
 from core.biziness.account import AccountInfo
+from core.dataaccess.orm.db_engine import get_async_session
 class Account(BaseView):
     def __init__(self):
         self.account=AccountInfo()
-    async def login(self,request:Request,account:LoginRequest):
+    async def login(self,request:Request,account:LoginRequest,session=Depends(get_async_session)):
         """
         登录
         :param request:
         :param account:
+        :param session: 请求级的异步数据库会话
         :return:
         """
         user_name=account.username
         password=account.password
         print(user_name,password)
-        ret=self.account.auth_user(user_name,password)
+        ret=await self.account.auth_user(user_name,password,session)
         if ret:
             return {'success':1,'message':'登录成功'}
         return {'success':0,'message':'用户名或密码错误'}
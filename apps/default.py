@@ -1,9 +1,19 @@
-from fastapi import Request, UploadFile, File
+from fastapi import Request
 from fastapi.responses import JSONResponse
-import os
-import uuid
+from starlette.responses import StreamingResponse
 from datetime import datetime
+from typing import Optional
+import asyncio
+import json
 from core.base.viewbase import BaseView
+from core.biziness.upload import UploadError,StoredFile,save_stream,iter_multipart_file,check_content_length,upload_sessions
+from core.biziness.mq.base import Job
+from core.biziness.mq.ingest import ingest_queue,submit_ingest
+from core.dataaccess.orm.db_engine import get_pool_stats
+from core.dataaccess.redis.client import get_pool_stats as get_redis_pool_stats
+from core.dataaccess.redis.cache import get_cache_stats
+from core.schemas.default import UploadSession
+from utils.asyncutils import run_blocking
 class Default(BaseView):
     def default_page(self,request:Request):
         return self.template.TemplateResponse('main.html',{'request':request})
@@ -32,64 +42,163 @@ class Default(BaseView):
     def right_settings(self,request:Request):
         return self.template.TemplateResponse('right_settings.html',{'request':request})
 
-    async def file_upload(self, request: Request, file: UploadFile = File(...)):
+    def upload_error(self,e:UploadError):
+        return JSONResponse(status_code=e.status_code,content={"success": False, "message": e.message, **e.extra})
+
+    def parse_tags(self,tags:Optional[str]):
+        return [tag for tag in (tags or '').split(',') if tag.strip()]
+
+    def upload_result(self,stored:StoredFile,job:Optional[Job]=None):
+        return {
+            "success": True,
+            "message": "文件已存在，已复用" if stored.duplicate else "文件上传成功",
+            "data": {
+                "filename": stored.filename,
+                "size": stored.size,
+                "type": stored.ext,
+                "sha256": stored.sha256,
+                "duplicate": stored.duplicate,
+                "artifacts": stored.artifacts,
+                "job_id": job.id if job else None,
+                "upload_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "file_path": stored.file_path
+            }
+        }
+
+    async def file_upload(self, request: Request, priority: int = 0, tags: Optional[str] = None):
         '''
-        文件上传
+        文件上传(multipart/form-data，文件字段名file)
+        按Content-Length预先拒绝超大文件；请求体流式解析并分块写入磁盘，边写边校验大小并计算SHA256，不一次性读入内存；
+        保存后提交入库任务(解析->切片->向量化)立即返回，通过job_id查询进度
         :param request:
-        :param file: 上传的文件
+        :param priority: 入库任务优先级，越大越优先
+        :param tags: 文档标签，逗号分隔
         :return:
         '''
         try:
-            # 验证文件类型
-            print('上传')
-            allowed_extensions = ['.pdf', '.doc', '.docx', '.txt', '.xlsx', '.xls', '.html', '.md']
-            file_ext = os.path.splitext(file.filename)[1].lower()
-            
-            if file_ext not in allowed_extensions:
-                return JSONResponse(
-                    status_code=400,
-                    content={"success": False, "message": f"不支持的文件类型。支持的格式: {', '.join(allowed_extensions)}"}
-                )
-            
-            # 验证文件大小 (最大100MB)
-            if file.size > 100 * 1024 * 1024:
-                return JSONResponse(
-                    status_code=400,
-                    content={"success": False, "message": "文件大小不能超过100MB"}
-                )
-            
-            # 创建上传目录
-            upload_dir = "uploads"
-            os.makedirs(upload_dir, exist_ok=True)
-            
-            # 生成唯一文件名
-            unique_filename = f"{uuid.uuid4()}_{file.filename}"
-            file_path = os.path.join(upload_dir, unique_filename)
-            
-            # 保存文件
-            content = await file.read()
-            with open(file_path, "wb") as f:
-                f.write(content)
-            
-            # 这里可以添加文档解析和向量化的逻辑
-            # 暂时返回成功信息
-            return JSONResponse(
-                status_code=200,
-                content={
-                    "success": True,
-                    "message": "文件上传成功",
-                    "data": {
-                        "filename": file.filename,
-                        "size": file.size,
-                        "type": file_ext,
-                        "upload_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "file_path": file_path
-                    }
-                }
-            )
-            
+            check_content_length(request.headers.get('content-length'))
+            parts = iter_multipart_file(request.headers.get('content-type', ''), request.stream())
+            filename = await parts.__anext__()
+            stored = await save_stream(parts, filename, uploaded_by=self.current_user(request))
+            job = await submit_ingest(stored, priority, self.parse_tags(tags))
+            return JSONResponse(status_code=200, content=self.upload_result(stored, job))
+        except UploadError as e:
+            return self.upload_error(e)
         except Exception as e:
             return JSONResponse(
                 status_code=500,
                 content={"success": False, "message": f"文件上传失败: {str(e)}"}
-            )
\ No newline at end of file
+            )
+
+    async def upload_session_create(self, request: Request, session: UploadSession):
+        '''
+        创建分片上传会话(大文件断点续传)
+        客户端提供的SHA256只用于完成上传时校验；内容去重在服务端对收到的数据计算摘要之后进行，
+        不能凭摘要直接获得已存在的文件
+        :param request:
+        :param session: 文件名、大小及可选的SHA256
+        :return: upload_id、建议的分片大小及已接收的字节数
+        '''
+        user = self.current_user(request)
+        try:
+            info = await run_blocking(upload_sessions.create, session.filename, session.size, session.sha256, user)
+            return {"success": True, "data": info}
+        except UploadError as e:
+            return self.upload_error(e)
+
+    async def upload_session_status(self, request: Request, upload_id: str):
+        '''
+        查询已接收的字节数，续传时从该位置继续上传
+        :param request:
+        :param upload_id:
+        :return:
+        '''
+        try:
+            return {"success": True, "data": await run_blocking(upload_sessions.get, upload_id)}
+        except UploadError as e:
+            return self.upload_error(e)
+
+    async def upload_session_chunk(self, request: Request, upload_id: str, offset: int):
+        '''
+        上传一个分片，请求体为分片的原始字节，流式写入磁盘
+        :param request:
+        :param upload_id:
+        :param offset: 分片在文件中的起始位置
+        :return: 已接收的字节数
+        '''
+        try:
+            info = await upload_sessions.append(upload_id, offset, request.stream())
+            return {"success": True, "data": info}
+        except UploadError as e:
+            return self.upload_error(e)
+
+    async def upload_session_complete(self, request: Request, upload_id: str, priority: int = 0,
+                                      tags: Optional[str] = None):
+        '''
+        完成分片上传并提交入库任务
+        :param request:
+        :param upload_id:
+        :param priority: 入库任务优先级，越大越优先
+        :param tags: 文档标签，逗号分隔
+        :return:
+        '''
+        try:
+            stored = await upload_sessions.complete(upload_id)
+        except UploadError as e:
+            return self.upload_error(e)
+        return self.upload_result(stored, await submit_ingest(stored, priority, self.parse_tags(tags)))
+
+    async def pool_stats(self, request: Request):
+        '''
+        数据库及Redis连接池、共享缓存统计
+        :param request:
+        :return:
+        '''
+        return {"db": get_pool_stats(), "redis": get_redis_pool_stats(), "cache": get_cache_stats()}
+
+    async def ingest_jobs(self, request: Request, limit: int = 50):
+        '''
+        最近的入库任务及队列统计
+        :param request:
+        :param limit:
+        :return:
+        '''
+        jobs = await ingest_queue.backend.recent(min(max(limit, 1), 500))
+        return {"success": True, "data": [job.to_dict() for job in jobs], "stats": ingest_queue.get_stats()}
+
+    async def ingest_job(self, request: Request, job_id: str):
+        '''
+        查询入库任务进度
+        :param request:
+        :param job_id:
+        :return:
+        '''
+        job = await ingest_queue.get(job_id)
+        if job is None:
+            return JSONResponse(status_code=404, content={"success": False, "message": "任务不存在"})
+        return {"success": True, "data": job.to_dict()}
+
+    async def ingest_job_events(self, request: Request, job_id: str):
+        '''
+        以SSE推送入库任务进度，任务结束后关闭
+        后端可能在其他进程中更新任务，按间隔读取，有变化时推送
+        :param request:
+        :param job_id:
+        :return:
+        '''
+        async def generate():
+            last = None
+            while not await request.is_disconnected():
+                job = await ingest_queue.get(job_id)
+                if job is None:
+                    yield f"data: {json.dumps({'type': 'error', 'content': '任务不存在'}, ensure_ascii=False)}\n\n"
+                    return
+                state = (job.status, job.stage, job.progress, job.message)
+                if state != last:
+                    last = state
+                    yield f"data: {json.dumps({'type': 'progress', 'content': job.to_dict()}, ensure_ascii=False)}\n\n"
+                if job.finished:
+                    return
+                await asyncio.sleep(0.5)
+        return StreamingResponse(generate(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -0,0 +1,62 @@
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from typing import Optional
+from core.biziness.knowledge.retrieval import MODES,hybrid_search
+from core.biziness.knowledge.store import get_knowledge_base
+from core.schemas.default import DocumentTags
+from utils.asyncutils import run_blocking
+class Knowledge:
+    async def documents(self,request:Request,tag:Optional[str]=None,limit:int=100,offset:int=0):
+        '''
+        知识库中的文档
+        :param request:
+        :param tag: 按标签过滤
+        :param limit:
+        :param offset:
+        :return:
+        '''
+        kb=get_knowledge_base()
+        docs=await run_blocking(kb.chunks.documents,min(max(limit,1),1000),max(offset,0),tag)
+        return {'success':True,'data':docs}
+    async def delete_document(self,request:Request,doc_id:str):
+        '''
+        从知识库删除文档(切片及向量)
+        :param request:
+        :param doc_id: 文档ID(文件内容的SHA256)
+        :return:
+        '''
+        count=await run_blocking(get_knowledge_base().delete_document,doc_id)
+        if not count:
+            return JSONResponse(status_code=404,content={'success':False,'message':'文档不存在'})
+        return {'success':True,'data':{'doc_id':doc_id,'chunks':count}}
+    async def set_tags(self,request:Request,doc_id:str,body:DocumentTags):
+        '''
+        设置文档标签，检索时可按标签过滤
+        :param request:
+        :param doc_id:
+        :param body:
+        :return:
+        '''
+        if not await run_blocking(get_knowledge_base().set_tags,doc_id,body.tags):
+            return JSONResponse(status_code=404,content={'success':False,'message':'文档不存在'})
+        return {'success':True}
+    async def stats(self,request:Request):
+        return {'success':True,'data':await run_blocking(get_knowledge_base().get_stats)}
+    async def query(self,request:Request,q:str,k:int=10,tags:Optional[str]=None,match_all:bool=False,mode:Optional[str]=None):
+        '''
+        知识库查询：关键词与向量检索按倒数排名融合
+        :param request:
+        :param q: 查询文本
+        :param k: 返回条数
+        :param tags: 标签，逗号分隔
+        :param match_all: True时须包含全部标签
+        :param mode: hybrid/keyword/vector，默认按配置
+        :return:
+        '''
+        if not q.strip():
+            return JSONResponse(status_code=400,content={'success':False,'message':'请输入查询内容'})
+        if mode and mode not in MODES:
+            return JSONResponse(status_code=400,content={'success':False,'message':f'不支持的检索方式：{mode}'})
+        tag_list=[tag for tag in (tags or '').split(',') if tag.strip()]
+        result=await hybrid_search(q.strip(),min(max(k,1),100),tag_list,match_all,mode)
+        return {'success':True,'data':result}
@@ -1,13 +1,101 @@
 from fastapi import Request
-from starlette.responses import StreamingResponse
+from starlette.responses import StreamingResponse,Response
 from core.schemas.default import Query
-from core.biziness.texttosql import stream_sql_query
+from fastapi.responses import JSONResponse
+from typing import Literal
+from core.biziness.texttosql import stream_sql_query,get_workflow_stats,invalidate_schema_cache,get_answer_cache_stats,get_schema_cache_stats,QueryContext,get_db
+from core.biziness.resultstream import approved_queries,stream_results,MEDIA_TYPES
+from core.biziness.costguard import check_query_cost,user_limiter
+from core.biziness.metrics import metrics_payload
+from core.biziness.llmbase import get_gateway_stats
 import json
-class TextToSql:
+import settings
+from core.base.viewbase import BaseView
+from utils.asyncutils import run_blocking
+class LimitedStreamingResponse(StreamingResponse):
+    '''
+    响应结束后释放用户的并发查询名额
+    在生成器的finally中释放不可靠：客户端在响应开始前断开时生成器从未启动，finally不会执行
+    '''
+    def __init__(self,*args,user,**kwargs):
+        super().__init__(*args,**kwargs)
+        self.user=user
+    async def __call__(self,scope,receive,send):
+        try:
+            await super().__call__(scope,receive,send)
+        finally:
+            await user_limiter.release(self.user)
+class TextToSql(BaseView):
     async def query(self,request:Request,query:Query):
         q=query.question
+        try:
+            ctx=QueryContext.build(q,exec_mode=query.exec_mode,use_cache=query.use_cache,top_k=query.top_k,
+                                   exec_timeout=query.timeout,model=query.model,db_key=query.db,
+                                   candidates=query.candidates,debug=query.debug,user=self.current_user(request))
+        except ValueError as e:
+            return JSONResponse(status_code=400,content={'success':0,'message':str(e)})
         async def generate():
-            result=stream_sql_query(q)
+            result=stream_sql_query(q,ctx)
             async for chunk in result:
-                yield json.dumps({'content': chunk}) + '\n'
-        return StreamingResponse(generate(), media_type="text/event-stream")
\ No newline at end of file
+                #SSE帧：data: {"type":...,"content":...}
+                yield f"data: {json.dumps(chunk,ensure_ascii=False)}\n\n"
+        return StreamingResponse(generate(), media_type="text/event-stream",
+                                 headers={'Cache-Control':'no-cache','X-Accel-Buffering':'no'})
+    async def stats(self,request:Request):
+        '''
+        text-to-sql运行统计
+        :param request:
+        :return:
+        '''
+        return {'workflow':get_workflow_stats(),
+                'schema_cache':get_schema_cache_stats(),
+                'answer_cache':get_answer_cache_stats(),
+                'running_queries':user_limiter.running(),
+                'llm':get_gateway_stats()}
+    async def metrics(self,request:Request):
+        '''
+        Prometheus指标(各阶段耗时、LLM耗时及token用量、Agent迭代次数、重试次数)
+        :param request:
+        :return:
+        '''
+        content,content_type=metrics_payload()
+        return Response(content=content,media_type=content_type)
+    async def invalidate_schema(self,request:Request):
+        '''
+        手动失效表结构缓存
+        :param request:
+        :return:
+        '''
+        invalidate_schema_cache()
+        return {'success':1,'message':'表结构缓存已失效'}
+    async def results(self,request:Request,query_id:str,format:Literal['ndjson','csv','arrow']='ndjson',chunk_size:int=0):
+        '''
+        按块流式导出已校验SQL的完整查询结果
+        :param request:
+        :param query_id: text-to-sql流程返回的query_id
+        :param format: ndjson/csv/arrow
+        :param chunk_size: 每块行数
+        :return:
+        '''
+        approved=approved_queries.get(query_id)
+        if approved is None:
+            return JSONResponse(status_code=404,content={'success':0,'message':'查询不存在或已过期'})
+        if format=='arrow':
+            try:
+                import pyarrow
+            except ImportError:
+                return JSONResponse(status_code=400,content={'success':0,'message':'未安装pyarrow，不支持arrow格式'})
+        sql,db_key=approved
+        #导出不限制返回行数，按完整SQL重新检查成本(登记后数据量可能已变化)
+        guard,_=await run_blocking(check_query_cost,get_db(db_key),sql,allow_rewrite=False)
+        if guard.action=='reject':
+            return JSONResponse(status_code=400,content={'success':0,'message':f'查询代价过高：{guard.reason}'})
+        user=self.current_user(request)
+        if not await user_limiter.acquire(user):
+            return JSONResponse(status_code=429,content={'success':0,'message':'当前用户同时执行的查询已达上限，请稍后再试'})
+        chunk_size=max(1,min(chunk_size or settings.texttosql['result_stream']['chunk_size'],10000))
+        return LimitedStreamingResponse(stream_results(get_db(db_key),sql,format,chunk_size),user=user,
+                                        media_type=MEDIA_TYPES[format],
+                                        headers={'Content-Disposition':f'attachment; filename="{query_id}.{format}"',
+                                                 #超出该行数时截断，末尾带截断标记(见stream_results)
+                                                 'X-Max-Rows':str(settings.texttosql['result_stream']['max_rows'])})
\ No newline at end of file
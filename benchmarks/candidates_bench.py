@@ -0,0 +1,75 @@
+"""
+多候选SQL生成对比：候选数量与延迟、准确率的关系
+准确率按执行结果匹配计算：语料中带gold_sql的问题，比较最终执行SQL与gold_sql的结果集
+需要可用的数据库及LLM服务，不使用问题缓存
+用法：python -m benchmarks.candidates_bench [--candidates 1 3 5] [--questions benchmarks/offline_corpus.jsonl]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from collections import Counter
+
+from core.biziness.texttosql import stream_sql_query, QueryContext, get_db
+from core.biziness.resultstream import approved_queries
+from core.dataaccess.sql.executor import run_select
+
+
+def load_corpus(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def execution_match(db, sql, gold_sql, max_rows=1000):
+    '''
+    执行结果匹配：两个SQL的结果集(忽略行顺序)相同
+    '''
+    try:
+        _, rows = run_select(db, sql, max_rows)
+        _, gold_rows = run_select(db, gold_sql, max_rows)
+    except Exception:
+        return False
+    normalize = lambda values: Counter(tuple(str(v) for v in row) for row in values)
+    return normalize(rows) == normalize(gold_rows)
+
+
+async def run_once(item, candidates):
+    '''
+    :return: (耗时,最终执行的SQL)
+    '''
+    ctx = QueryContext.build(item['question'], candidates=candidates, use_cache=False)
+    start = time.perf_counter()
+    final_sql = None
+    async for chunk in stream_sql_query(item['question'], ctx):
+        if chunk['type'] == 'query_id':
+            final_sql = approved_queries.get(chunk['content'])[0]
+    return time.perf_counter() - start, final_sql
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--candidates', type=int, nargs='+', default=[1, 3, 5])
+    parser.add_argument('--questions', default='benchmarks/offline_corpus.jsonl', help='带gold_sql的问题语料')
+    args = parser.parse_args()
+    corpus = load_corpus(args.questions)
+    if not any(item.get('gold_sql') for item in corpus):
+        parser.error(f'{args.questions}中没有带gold_sql的问题，无法计算准确率')
+    db = get_db()
+    for candidates in args.candidates:
+        latencies, matched, judged = [], 0, 0
+        for item in corpus:
+            elapsed, final_sql = await run_once(item, candidates)
+            latencies.append(elapsed)
+            if item.get('gold_sql'):
+                judged += 1
+                matched += bool(final_sql) and execution_match(db, final_sql, item['gold_sql'])
+        latencies.sort()
+        accuracy = f'{matched / judged:.2%}' if judged else 'n/a'
+        print(f'candidates={candidates}: n={len(latencies)} mean={statistics.mean(latencies):.3f}s '
+              f'p50={latencies[len(latencies) // 2]:.3f}s max={latencies[-1]:.3f}s '
+              f'execution_accuracy={accuracy} ({matched}/{judged})')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
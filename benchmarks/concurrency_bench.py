@@ -0,0 +1,82 @@
+"""
+text-to-sql并发压测：在1/10/50个并发流下统计首字节及完整响应的p50/p99延迟
+需要先启动服务(python manager.py)
+用法：python -m benchmarks.concurrency_bench [--url http://127.0.0.1:8000] [--levels 1 10 50] [--no-cache]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+import httpx
+
+
+def load_questions(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line)['question'] for line in f if line.strip()]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+async def one_stream(client, url, question, use_cache):
+    '''
+    发起一个流式请求
+    :return: (首字节耗时,总耗时)
+    '''
+    start = time.perf_counter()
+    first = None
+    async with client.stream('POST', url, json={'question': question, 'use_cache': use_cache}) as response:
+        response.raise_for_status()
+        async for _ in response.aiter_bytes():
+            if first is None:
+                first = time.perf_counter() - start
+    return first or 0.0, time.perf_counter() - start
+
+
+async def run_level(base_url, questions, concurrency, requests_per_worker, use_cache):
+    url = f'{base_url}/default/text-to-sql'
+    source = itertools.cycle(questions)
+    ttfb, total, errors = [], [], 0
+
+    async def worker(client):
+        nonlocal errors
+        for _ in range(requests_per_worker):
+            try:
+                first, elapsed = await one_stream(client, url, next(source), use_cache)
+                ttfb.append(first)
+                total.append(elapsed)
+            except Exception:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=600, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        wall = time.perf_counter() - start
+    if not total:
+        print(f'concurrency={concurrency:>3}: all {errors} requests failed')
+        return
+    print(f'concurrency={concurrency:>3} n={len(total)} errors={errors} qps={len(total) / wall:.2f} '
+          f'ttfb p50={percentile(ttfb, 50):.3f}s p99={percentile(ttfb, 99):.3f}s '
+          f'total p50={percentile(total, 50):.3f}s p99={percentile(total, 99):.3f}s')
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--requests', type=int, default=2, help='每个并发worker发起的请求数')
+    parser.add_argument('--questions', default='benchmarks/questions.jsonl')
+    parser.add_argument('--no-cache', action='store_true', help='关闭问题缓存，测量完整流程')
+    args = parser.parse_args()
+    questions = load_questions(args.questions)
+    for level in args.levels:
+        await run_level(args.url, questions, level, args.requests, not args.no_cache)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
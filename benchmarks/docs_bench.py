@@ -0,0 +1,218 @@
+"""
+文档解析吞吐基准测试
+按格式统计页(段)/秒及MB/秒，对比当前进程顺序解析(inline)与进程池并行解析(pool)，并报告解析进程的内存峰值
+未指定--dir时在benchmarks/.cache/docs下生成测试文档(HTML/TXT/MD无需依赖，DOCX/XLSX/PDF需安装对应的库)
+用法：python -m benchmarks.docs_bench [--dir samples] [--files 8] [--pages 50] [--workers 4] [--mode inline pool]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+import settings
+
+DEFAULT_DIR = 'benchmarks/.cache/docs'
+WORDS = ['营业收入', '净利润', '同比增长', '机构持仓', '资产负债率', '现金流', '市盈率', '股东', '季度', '公告',
+         'revenue', 'margin', 'holding', 'report', 'stock', 'fund']
+
+
+def _paragraph(rng, words=80):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def generate_samples(path, files, pages, seed=7):
+    '''
+    生成测试文档，每个文档约pages页(节)
+    :return: 生成的文件列表
+    '''
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    generated = []
+
+    def target(i, ext):
+        name = os.path.join(path, f'sample_{pages}_{i}{ext}')
+        generated.append(name)
+        return None if os.path.exists(name) else name
+
+    for i in range(files):
+        name = target(i, '.html')
+        if name:
+            with open(name, 'w', encoding='utf-8') as f:
+                f.write('<html><head><style>p{}</style></head><body>')
+                for p in range(pages):
+                    f.write(f'<h2>第{p + 1}节</h2>' + ''.join(f'<p>{_paragraph(rng)}</p>' for _ in range(6)))
+                f.write('</body></html>')
+        name = target(i, '.md')
+        if name:
+            with open(name, 'w', encoding='utf-8') as f:
+                for p in range(pages):
+                    f.write(f'## 第{p + 1}节\n' + '\n'.join(_paragraph(rng) for _ in range(6)) + '\n')
+    try:
+        import docx
+        for i in range(files):
+            name = target(i, '.docx')
+            if name:
+                document = docx.Document()
+                for p in range(pages):
+                    document.add_heading(f'第{p + 1}节', level=2)
+                    for _ in range(6):
+                        document.add_paragraph(_paragraph(rng))
+                document.save(name)
+    except ImportError:
+        print('未安装python-docx，跳过.docx', file=sys.stderr)
+    try:
+        import openpyxl
+        for i in range(files):
+            name = target(i, '.xlsx')
+            if name:
+                workbook = openpyxl.Workbook(write_only=True)
+                sheet = workbook.create_sheet('holding')
+                sheet.append(['stock_code', 'institution', 'shares', 'ratio', 'report_date'])
+                for r in range(pages * settings.docs['excel_rows_per_section']):
+                    sheet.append([f'{600000 + r % 3000}', rng.choice(WORDS), rng.randint(1, 10 ** 8),
+                                  round(rng.random(), 4), f'2024-{r % 4 * 3 + 3:02d}-30'])
+                workbook.save(name)
+    except ImportError:
+        print('未安装openpyxl，跳过.xlsx', file=sys.stderr)
+    try:
+        import fitz
+        for i in range(files):
+            name = target(i, '.pdf')
+            if name:
+                document = fitz.open()
+                for p in range(pages):
+                    page = document.new_page()
+                    page.insert_textbox(fitz.Rect(36, 36, 560, 800), '\n'.join(_paragraph(rng, 12) for _ in range(40)))
+                document.save(name)
+                document.close()
+    except ImportError:
+        print('未安装PyMuPDF，跳过.pdf', file=sys.stderr)
+    return generated
+
+
+def list_samples(path):
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+                  if os.path.isfile(os.path.join(path, name)) and not name.startswith('.'))
+
+
+def _peak_rss_mb(children=False):
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    #Linux单位为KB，macOS为字节
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_inline(files):
+    from core.biziness.docs.pipeline import iter_document_inline
+    results = []
+    for path in files:
+        start = time.perf_counter()
+        try:
+            sections = sum(1 for _ in iter_document_inline(path))
+            error = None
+        except Exception as e:
+            sections, error = 0, str(e)
+        results.append((path, sections, time.perf_counter() - start, error))
+    return results
+
+
+async def run_pool(files, concurrency):
+    from core.biziness.docs.pipeline import iter_document
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(path):
+        async with semaphore:
+            start = time.perf_counter()
+            sections, error = 0, None
+            try:
+                async for _ in iter_document(path):
+                    sections += 1
+            except Exception as e:
+                error = str(e)
+            return path, sections, time.perf_counter() - start, error
+
+    return await asyncio.gather(*(one(path) for path in files))
+
+
+def summarize(results, wall):
+    '''
+    按格式汇总
+    :param results: [(路径,段数,耗时,错误)]
+    :param wall: 总耗时
+    :return:
+    '''
+    groups = defaultdict(lambda: {'files': 0, 'errors': 0, 'sections': 0, 'bytes': 0, 'seconds': 0.0})
+    for path, sections, seconds, error in results:
+        group = groups[os.path.splitext(path)[1].lower()]
+        group['files'] += 1
+        group['errors'] += bool(error)
+        group['sections'] += sections
+        group['bytes'] += os.path.getsize(path)
+        group['seconds'] += seconds
+    report = {}
+    for ext, group in sorted(groups.items()):
+        mb = group['bytes'] / 1024 / 1024
+        report[ext] = {'files': group['files'], 'errors': group['errors'], 'sections': group['sections'],
+                       'mb': round(mb, 2), 'pages_per_s': round(group['sections'] / group['seconds'], 1),
+                       'mb_per_s': round(mb / group['seconds'], 2)}
+    total_mb = sum(os.path.getsize(r[0]) for r in results) / 1024 / 1024
+    report['total'] = {'files': len(results), 'sections': sum(r[1] for r in results), 'mb': round(total_mb, 2),
+                       'wall_seconds': round(wall, 3),
+                       'pages_per_s': round(sum(r[1] for r in results) / wall, 1),
+                       'mb_per_s': round(total_mb / wall, 2)}
+    return report
+
+
+def print_report(mode, report, peak_rss):
+    print(f'[{mode}] peak_rss={peak_rss}MB')
+    for ext, row in report.items():
+        if ext == 'total':
+            print(f"    {'total':<6} files={row['files']} sections={row['sections']} mb={row['mb']} "
+                  f"wall={row['wall_seconds']}s pages/s={row['pages_per_s']} MB/s={row['mb_per_s']}")
+        else:
+            print(f"    {ext:<6} files={row['files']} errors={row['errors']} sections={row['sections']} "
+                  f"mb={row['mb']} pages/s={row['pages_per_s']} MB/s={row['mb_per_s']}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', help='测试文档目录，默认生成测试文档')
+    parser.add_argument('--files', type=int, default=8, help='生成的每种格式文档数')
+    parser.add_argument('--pages', type=int, default=50, help='生成的每个文档页(节)数')
+    parser.add_argument('--workers', type=int, default=settings.docs['workers'], help='解析进程数')
+    parser.add_argument('--memory-limit', type=int, default=settings.docs['memory_limit_mb'],
+                        help='每个解析进程的内存上限(MB)')
+    parser.add_argument('--mode', nargs='+', choices=['inline', 'pool'], default=['inline', 'pool'])
+    args = parser.parse_args()
+    settings.docs['workers'] = args.workers
+    settings.docs['memory_limit_mb'] = args.memory_limit
+    if args.dir:
+        files = list_samples(args.dir)
+    else:
+        files = generate_samples(DEFAULT_DIR, args.files, args.pages)
+    if not files:
+        print('没有可解析的文档')
+        return
+    if 'inline' in args.mode:
+        start = time.perf_counter()
+        results = run_inline(files)
+        print_report('inline', summarize(results, time.perf_counter() - start), _peak_rss_mb())
+    if 'pool' in args.mode:
+        from core.biziness.docs.pipeline import shutdown, warmup
+        warmup()
+        start = time.perf_counter()
+        results = asyncio.run(run_pool(files, args.workers * 2))
+        wall = time.perf_counter() - start
+        #解析进程退出后才能取得其内存峰值
+        shutdown()
+        print_report(f'pool workers={args.workers}', summarize(results, wall), _peak_rss_mb(children=True))
+
+
+if __name__ == '__main__':
+    main()
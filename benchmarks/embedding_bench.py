@@ -0,0 +1,156 @@
+"""
+向量化服务吞吐基准测试
+1. 不同批大小下的texts/s，对比按长度分桶与按原顺序分批(填充到批内最长文本)
+2. 多个并发调用方逐条提交时，服务端微批合并后的texts/s及平均批大小
+3. 重复文本命中内容哈希缓存时的texts/s
+--simulate使用模拟后端(耗时与批大小x填充长度成正比)，无需模型即可验证分桶及合批效果
+用法：python -m benchmarks.embedding_bench [--backend torch|onnx] [--quantize] [--texts 2000]
+                                          [--batch-sizes 1 8 16 32 64] [--callers 32] [--chunks chunks.jsonl] [--simulate]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import threading
+import time
+
+import numpy as np
+
+import settings
+from core.biziness.embedding import EmbeddingRunner, EmbeddingService, get_embedding_service
+
+PHRASES = ['公司2024年第三季度营业收入同比增长', '机构投资者持仓比例变化', '根据公告披露的信息', '资产负债率',
+           '经营活动产生的现金流量净额', '本报告期内', '董事会审议通过了', '前十大股东', '募集资金使用情况', '净利润']
+
+
+def synthetic_texts(count, seed):
+    '''
+    长度呈对数正态分布的文本(模拟切片及问题长短混合)
+    '''
+    rng = random.Random(seed)
+    texts = []
+    for i in range(count):
+        words = max(1, int(rng.lognormvariate(2.5, 0.9)))
+        texts.append(f'{i} ' + '，'.join(rng.choice(PHRASES) for _ in range(words)))
+    return texts
+
+
+class _CharTokenizer:
+    """按字符计数的分词器(模拟后端使用)"""
+
+    def __call__(self, texts, padding=False, truncation=True, max_length=512, return_tensors=None,
+                 add_special_tokens=True):
+        ids = [[1] + [ord(c) % 30000 for c in text][:max_length - 2] + [2] for text in texts]
+        if not padding:
+            return {'input_ids': ids}
+        width = max(len(row) for row in ids)
+        input_ids = np.zeros((len(ids), width), dtype=np.int64)
+        mask = np.zeros((len(ids), width), dtype=np.int64)
+        for i, row in enumerate(ids):
+            input_ids[i, :len(row)] = row
+            mask[i, :len(row)] = 1
+        return {'input_ids': input_ids, 'attention_mask': mask}
+
+
+class SimulatedRunner(EmbeddingRunner):
+    """耗时=每次前向的固定开销+每个填充后token的开销，用于不加载模型时评估分桶及合批"""
+
+    def __init__(self, config, overhead=0.02, per_token=0.00001, dim=768):
+        self.config = config
+        self.tokenizer = _CharTokenizer()
+        self.max_length = config['max_length']
+        self.overhead, self.per_token, self.dim = overhead, per_token, dim
+
+    def _forward(self, encoded):
+        batch, seq = encoded['input_ids'].shape
+        time.sleep(self.overhead + self.per_token * batch * seq)
+        rng = np.random.default_rng(int(encoded['input_ids'].sum()) % (2 ** 32))
+        return rng.normal(size=(batch, seq, self.dim)).astype(np.float32)
+
+
+def bench_batch_sizes(runner, texts, batch_sizes):
+    for size in batch_sizes:
+        runner.config['max_batch_size'] = size
+        row = []
+        for bucketed in (True, False):
+            start = time.perf_counter()
+            runner.encode(texts, bucketed=bucketed)
+            row.append(len(texts) / (time.perf_counter() - start))
+        print(f'batch={size:>3} bucketed={row[0]:>8.1f} texts/s  unbucketed={row[1]:>8.1f} texts/s  '
+              f'({row[0] / row[1]:.2f}x)')
+
+
+def bench_callers(service, texts, callers):
+    '''
+    多个线程逐条提交，统计服务端合批效果
+    '''
+    chunks = [texts[i::callers] for i in range(callers)]
+
+    def caller(items):
+        for text in items:
+            service.embed([text])
+
+    threads = [threading.Thread(target=caller, args=(items,)) for items in chunks]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    stats = service.get_stats()
+    print(f'callers={callers:>3} {len(texts) / seconds:>8.1f} texts/s  batches={stats["batches"]} '
+          f'mean_batch={stats["mean_batch"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=['torch', 'onnx'], default=settings.embedding_service['backend'])
+    parser.add_argument('--quantize', action='store_true')
+    parser.add_argument('--texts', type=int, default=2000)
+    parser.add_argument('--chunks', help='使用入库产生的chunks.jsonl中的文本')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 16, 32, 64])
+    parser.add_argument('--callers', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--simulate', action='store_true', help='使用模拟后端')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+    if args.chunks:
+        with open(args.chunks, encoding='utf-8') as f:
+            texts = [json.loads(line)['text'] for line in f if line.strip()][:args.texts]
+    else:
+        texts = synthetic_texts(args.texts, args.seed)
+    cache_dir = 'benchmarks/.cache/embedding'
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    config = dict(settings.embedding_service, backend=args.backend, quantize=args.quantize,
+                  cache_path=os.path.join(cache_dir, 'cache.sqlite'))
+    if args.simulate:
+        runner = SimulatedRunner(dict(config))
+    else:
+        runner = get_embedding_service().runner.__class__(settings.embeddings[config['model']], dict(config))
+    print(f"backend={'simulate' if args.simulate else args.backend} quantize={args.quantize} texts={len(texts)} "
+          f"mean_chars={sum(map(len, texts)) / len(texts):.0f}")
+    print('-- 批大小')
+    bench_batch_sizes(runner, texts, args.batch_sizes)
+    print('-- 并发调用方(微批合并，不使用缓存)')
+    runner.config['max_batch_size'] = config['max_batch_size']
+    for callers in args.callers:
+        service = EmbeddingService(config['model'], dict(config, cache_path=None, memory_cache=0), runner=runner)
+        bench_callers(service, texts, callers)
+    print('-- 内容哈希缓存')
+    service = EmbeddingService(config['model'], config, runner=runner)
+    for label in ('首次', '重复'):
+        start = time.perf_counter()
+        for offset in range(0, len(texts), 256):
+            service.embed(texts[offset:offset + 256])
+        seconds = time.perf_counter() - start
+        print(f'{label} {len(texts) / seconds:>10.1f} texts/s  cache_hits={service.stats["cache_hits"]}')
+    #新进程(内存缓存为空)从SQLite读取
+    service = EmbeddingService(config['model'], config, runner=runner)
+    start = time.perf_counter()
+    for offset in range(0, len(texts), 256):
+        service.embed(texts[offset:offset + 256])
+    print(f'冷启动 {len(texts) / (time.perf_counter() - start):>10.1f} texts/s  cache_hits={service.stats["cache_hits"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+SQL执行模式对比：direct(直接执行+Agent兜底) vs agent(全部交给Agent)
+需要可用的MySQL及LLM服务，不使用问题缓存
+用法：python -m benchmarks.exec_mode_bench [--rounds 3] [--questions benchmarks/questions.jsonl]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from core.biziness.texttosql import stream_sql_query, QueryContext
+
+
+def load_questions(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line)['question'] for line in f if line.strip()]
+
+
+async def run_once(question, mode):
+    '''
+    执行一次查询
+    :return: (耗时,是否回退到Agent,是否出错)
+    '''
+    start = time.perf_counter()
+    fallback = failed = False
+    ctx = QueryContext.build(question, exec_mode=mode, use_cache=False)
+    async for chunk in stream_sql_query(question, ctx):
+        if chunk['type'] == 'progress' and '交由Agent修正' in chunk['content']:
+            fallback = True
+        if chunk['type'] == 'error' or '查询失败' in chunk['content']:
+            failed = True
+    return time.perf_counter() - start, fallback, failed
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--questions', default='benchmarks/questions.jsonl')
+    args = parser.parse_args()
+    questions = load_questions(args.questions)
+    for mode in ('agent', 'direct'):
+        latencies, fallbacks, failures = [], 0, 0
+        for _ in range(args.rounds):
+            for question in questions:
+                elapsed, fallback, failed = await run_once(question, mode)
+                latencies.append(elapsed)
+                fallbacks += fallback
+                failures += failed
+        latencies.sort()
+        print(f'{mode:>6}: n={len(latencies)} mean={statistics.mean(latencies):.3f}s '
+              f'p50={latencies[len(latencies) // 2]:.3f}s max={latencies[-1]:.3f}s '
+              f'agent_fallbacks={fallbacks} failures={failures}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
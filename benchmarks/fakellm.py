@@ -0,0 +1,100 @@
+"""
+回放录制回复的确定性模型，替代getllm()返回的ChatOpenAI
+按提示词中的用户问题查找语料中录制的SQL/总结，可模拟首token延迟及逐token输出耗时，
+并按估算的token数返回用量，便于离线统计各阶段耗时及token用量
+"""
+import asyncio
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from core.biziness.tableselect import estimate_tokens
+
+NO_DATA = '未查询到符合条件的数据'
+
+
+class RecordedChatModel(BaseChatModel):
+    responses: Dict[str, dict]  #问题->{'sql':生成的SQL,'summary':结果总结}
+    model: str = 'recorded'
+    ttft: float = 0.0  #首token延迟(秒)
+    prefill: float = 0.0  #每千个提示词token增加的首token延迟(秒)，模拟预填充耗时随提示词长度增长
+    tpot: float = 0.0  #每个输出块的耗时(秒)
+    chunk_chars: int = 4  #流式输出时每块的字符数
+
+    @property
+    def _llm_type(self) -> str:
+        return 'recorded'
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {'model': self.model}
+
+    def _find(self, prompt: str) -> Optional[dict]:
+        #取提示词中出现的最长问题，避免短问题是长问题子串时误匹配
+        matched = [q for q in self.responses if q in prompt]
+        return self.responses[max(matched, key=len)] if matched else None
+
+    def _respond(self, messages: List[BaseMessage]) -> tuple:
+        '''
+        :return: (提示词,回复)
+        '''
+        prompt = '\n'.join(str(m.content) for m in messages)
+        item = self._find(prompt) or {}
+        if 'SQLQuery' in prompt:
+            text = item.get('sql') or 'SELECT 1'
+        elif '执行的SQL：' in prompt:
+            text = item.get('summary') or NO_DATA
+        else:
+            #SQL Agent(ReAct)：直接给出最终答案
+            text = f"Thought: 已获得查询结果\nFinal Answer: {item.get('summary') or NO_DATA}"
+        return prompt, text
+
+    def _usage(self, prompt: str, text: str) -> dict:
+        input_tokens, output_tokens = estimate_tokens(prompt), estimate_tokens(text)
+        return {'input_tokens': input_tokens, 'output_tokens': output_tokens,
+                'total_tokens': input_tokens + output_tokens}
+
+    def _first_token_delay(self, prompt: str) -> float:
+        return self.ttft + self.prefill * estimate_tokens(prompt) / 1000
+
+    def _pieces(self, text: str) -> List[str]:
+        return [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)] or ['']
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        prompt, text = self._respond(messages)
+        time.sleep(self._first_token_delay(prompt) + self.tpot * len(self._pieces(text)))
+        message = AIMessage(content=text, usage_metadata=self._usage(prompt, text))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        prompt, text = self._respond(messages)
+        time.sleep(self._first_token_delay(prompt))
+        for piece in self._pieces(text):
+            time.sleep(self.tpot)
+            if run_manager:
+                run_manager.on_llm_new_token(piece)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+        yield ChatGenerationChunk(message=AIMessageChunk(content='', usage_metadata=self._usage(prompt, text)))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        prompt, text = self._respond(messages)
+        await asyncio.sleep(self._first_token_delay(prompt))
+        for piece in self._pieces(text):
+            await asyncio.sleep(self.tpot)
+            if run_manager:
+                await run_manager.on_llm_new_token(piece)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+        yield ChatGenerationChunk(message=AIMessageChunk(content='', usage_metadata=self._usage(prompt, text)))
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager=None, **kwargs: Any) -> ChatResult:
+        prompt, text = self._respond(messages)
+        await asyncio.sleep(self._first_token_delay(prompt) + self.tpot * len(self._pieces(text)))
+        message = AIMessage(content=text, usage_metadata=self._usage(prompt, text))
+        return ChatResult(generations=[ChatGeneration(message=message)])
@@ -0,0 +1,68 @@
+"""
+离线基准测试用的SQLite数据库
+表结构与text-to-sql线上库的股票/机构持仓数据一致，数据由固定随机种子生成，每次运行结果相同
+"""
+import os
+import random
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE stock_info (
+    stock_code TEXT PRIMARY KEY,
+    stock_name TEXT NOT NULL,
+    industry TEXT NOT NULL,
+    pe_ttm REAL,
+    total_market_cap REAL
+);
+CREATE TABLE institution_holding (
+    id INTEGER PRIMARY KEY,
+    stock_code TEXT NOT NULL REFERENCES stock_info (stock_code),
+    institution_name TEXT NOT NULL,
+    holding_ratio REAL,
+    holding_cost REAL
+);
+CREATE INDEX ix_holding_stock ON institution_holding (stock_code);
+"""
+INDUSTRIES = ['银行', '证券', '保险', '白酒', '医药', '半导体', '新能源', '汽车', '房地产', '电力', '钢铁', '软件']
+INSTITUTIONS = ['华夏基金', '易方达基金', '南方基金', '嘉实基金', '博时基金', '广发基金', '汇添富基金', '富国基金',
+                '招商基金', '中欧基金', '社保基金', '中央汇金', '香港中央结算', '高毅资产', '景林资产', '淡水泉']
+_name_chars = '华中国安泰康瑞达信通宏远鑫盛科创新能源电力银证保险药业城建恒丰永隆兴发'
+
+
+def build_sqlite_fixture(path: str, seed: int = 20240101, stocks: int = 500, holdings_per_stock: int = 6) -> str:
+    '''
+    生成SQLite测试库，已存在时直接复用
+    :param path: 数据库文件路径
+    :param seed: 随机种子
+    :param stocks: 股票数量
+    :param holdings_per_stock: 每只股票最多的持仓机构数
+    :return: sqlalchemy连接串
+    '''
+    uri = f'sqlite:///{os.path.abspath(path)}'
+    if os.path.exists(path):
+        return uri
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    rnd = random.Random(seed)
+    tmp_path = f'{path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript(SCHEMA)
+        stock_rows, holding_rows = [], []
+        for i in range(stocks):
+            code = f'{600000 + i:06d}'
+            name = ''.join(rnd.sample(_name_chars, 2)) + rnd.choice(['股份', '集团', '科技', '控股'])
+            pe = round(rnd.lognormvariate(3, 0.6), 2) if rnd.random() > 0.05 else None
+            cap = round(rnd.lognormvariate(5, 1.2), 2)  #亿元
+            stock_rows.append((code, name, rnd.choice(INDUSTRIES), pe, cap))
+            for institution in rnd.sample(INSTITUTIONS, rnd.randint(1, holdings_per_stock)):
+                holding_rows.append((code, institution, round(rnd.uniform(0.1, 15), 2), round(rnd.uniform(3, 300), 2)))
+        conn.executemany('INSERT INTO stock_info VALUES (?, ?, ?, ?, ?)', stock_rows)
+        conn.executemany('INSERT INTO institution_holding (stock_code, institution_name, holding_ratio, holding_cost) '
+                         'VALUES (?, ?, ?, ?)', holding_rows)
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+    return uri
@@ -0,0 +1,147 @@
+"""
+OpenAI兼容的本地模拟LLM服务，用于在不访问真实模型的情况下压测LLM网关(连接池、并发限制、限速及重试)
+可模拟首token延迟、逐token输出、按比例返回429(带Retry-After)/503，以及服务端并发上限
+用法：python -m benchmarks.llm_stub serve [--port 9000] [--ttft 0.2] [--tpot 0.01] [--fail-rate 0.1] [--max-concurrency 32]
+      python -m benchmarks.llm_stub bench [--model stub] [--concurrency 100] [--requests 500] [--stream]
+压测时settings.llm['stub']指向本服务
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+REPLY = 'SELECT stock_code, stock_name FROM stock_info LIMIT 5'
+
+
+def create_app(ttft=0.2, tpot=0.01, fail_rate=0.0, error_rate=0.0, max_concurrency=0):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse
+    from starlette.responses import StreamingResponse
+    app = FastAPI()
+    state = {'running': 0, 'requests': 0, 'rejected': 0}
+
+    def reject():
+        state['rejected'] += 1
+        return JSONResponse(status_code=429, headers={'Retry-After': '1'},
+                            content={'error': {'message': 'rate limited', 'type': 'rate_limit_error'}})
+
+    @app.post('/v1/chat/completions')
+    async def chat_completions(request: Request):
+        body = await request.json()
+        state['requests'] += 1
+        if max_concurrency and state['running'] >= max_concurrency:
+            return reject()
+        if random.random() < fail_rate:
+            return reject()
+        if random.random() < error_rate:
+            return JSONResponse(status_code=503, content={'error': {'message': 'overloaded'}})
+        model = body.get('model', 'stub')
+        prompt_tokens = sum(len(str(m.get('content', ''))) for m in body.get('messages', [])) // 2
+        pieces = REPLY.split(' ')
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(pieces),
+                 'total_tokens': prompt_tokens + len(pieces)}
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        created = int(time.time())
+        if not body.get('stream'):
+            state['running'] += 1
+            try:
+                await asyncio.sleep(ttft + tpot * len(pieces))
+            finally:
+                state['running'] -= 1
+            return {'id': completion_id, 'object': 'chat.completion', 'created': created, 'model': model,
+                    'choices': [{'index': 0, 'finish_reason': 'stop',
+                                 'message': {'role': 'assistant', 'content': REPLY}}],
+                    'usage': usage}
+
+        def frame(delta, finish_reason=None, **extra):
+            chunk = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                     'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}] if delta is not None else [],
+                     **extra}
+            return f'data: {json.dumps(chunk)}\n\n'
+
+        async def generate():
+            state['running'] += 1
+            try:
+                await asyncio.sleep(ttft)
+                yield frame({'role': 'assistant', 'content': ''})
+                for i, piece in enumerate(pieces):
+                    await asyncio.sleep(tpot)
+                    yield frame({'content': piece if i == 0 else ' ' + piece})
+                yield frame({}, 'stop')
+                if (body.get('stream_options') or {}).get('include_usage'):
+                    yield frame(None, usage=usage)
+                yield 'data: [DONE]\n\n'
+            finally:
+                state['running'] -= 1
+        return StreamingResponse(generate(), media_type='text/event-stream')
+
+    @app.get('/stats')
+    async def stats():
+        return state
+    return app
+
+
+async def bench(model, concurrency, requests, stream):
+    '''
+    通过网关并发调用模型，统计延迟、吞吐及网关的重试/限速情况
+    '''
+    from core.biziness.llmbase import getllm, get_gateway_stats
+    llm = getllm(model)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                if stream:
+                    async for _ in llm.astream(f'问题{i}\nSQLQuery: '):
+                        pass
+                else:
+                    await llm.ainvoke(f'问题{i}\nSQLQuery: ')
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    wall = time.perf_counter() - start
+    latencies.sort()
+    if latencies:
+        print(f'n={len(latencies)} errors={errors} qps={len(latencies) / wall:.2f} '
+              f'p50={latencies[len(latencies) // 2]:.3f}s p99={latencies[int(len(latencies) * 0.99)]:.3f}s')
+    else:
+        print(f'all {errors} requests failed')
+    print(json.dumps(get_gateway_stats(), ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    serve = sub.add_parser('serve')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=9000)
+    serve.add_argument('--ttft', type=float, default=0.2, help='首token延迟(秒)')
+    serve.add_argument('--tpot', type=float, default=0.01, help='每个token的输出耗时(秒)')
+    serve.add_argument('--fail-rate', type=float, default=0.0, help='返回429的比例')
+    serve.add_argument('--error-rate', type=float, default=0.0, help='返回503的比例')
+    serve.add_argument('--max-concurrency', type=int, default=0, help='服务端并发上限，超出返回429，0不限制')
+    load = sub.add_parser('bench')
+    load.add_argument('--model', default='stub', help='settings.llm中的配置名')
+    load.add_argument('--concurrency', type=int, default=100)
+    load.add_argument('--requests', type=int, default=500)
+    load.add_argument('--stream', action='store_true')
+    args = parser.parse_args()
+    if args.command == 'serve':
+        import uvicorn
+        uvicorn.run(create_app(args.ttft, args.tpot, args.fail_rate, args.error_rate, args.max_concurrency),
+                    host=args.host, port=args.port, log_level='warning')
+    else:
+        asyncio.run(bench(args.model, args.concurrency, args.requests, args.stream))
+
+
+if __name__ == '__main__':
+    main()
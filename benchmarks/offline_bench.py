@@ -0,0 +1,239 @@
+"""
+text-to-sql离线基准测试：不依赖MySQL及LLM服务
+数据库替换为固定种子生成的SQLite库(benchmarks/fixtures.py)，模型替换为回放录制回复的确定性模型(benchmarks/fakellm.py)，
+回放语料中的问题，统计各阶段耗时、不同并发下的端到端QPS及延迟、token用量和执行结果匹配准确率，
+结果可保存为JSON，与之前的运行结果对比
+用法：python -m benchmarks.offline_bench [--levels 1 10 50] [--rounds 3] [--ttft 0.3 --tpot 0.02 --prefill 0.1]
+                                        [--schema-format compact|full] [--output report.json] [--compare baseline.json]
+      python -m benchmarks.offline_bench --record   # 使用真实LLM在测试库上重新录制语料中的回复
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+from collections import defaultdict
+
+import settings
+from benchmarks.fixtures import build_sqlite_fixture
+from benchmarks.fakellm import RecordedChatModel
+
+DEFAULT_CORPUS = 'benchmarks/offline_corpus.jsonl'
+DEFAULT_DB = 'benchmarks/.cache/offline_bench.sqlite'
+
+
+def load_corpus(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))] if values else 0.0
+
+
+def configure(db_path, corpus=None, ttft=0.0, tpot=0.0, prefill=0.0):
+    '''
+    替换数据库及模型，必须在导入core.biziness.texttosql之前调用
+    :param db_path: SQLite测试库路径
+    :param corpus: 语料，为空时使用真实模型(录制模式)
+    :return:
+    '''
+    settings.db[settings.texttosql['db']] = build_sqlite_fixture(db_path)
+    settings.texttosql['answer_cache']['semantic'] = False
+    if corpus is not None:
+        from core.biziness import llmbase
+        model = RecordedChatModel(responses={item['question']: item for item in corpus}, ttft=ttft, tpot=tpot,
+                                  prefill=prefill)
+        llmbase.getllm = lambda name='qwen', purpose='text-to-sql': model
+
+
+async def run_request(item, index, exec_mode):
+    '''
+    执行一次查询
+    :return: {'seconds','ttft','timing','final_sql','error'}
+    '''
+    from core.biziness.texttosql import stream_sql_query, QueryContext
+    from core.biziness.resultstream import approved_queries
+    ctx = QueryContext.build(item['question'], exec_mode=exec_mode, use_cache=False, debug=True,
+                             user=f'bench-{index}')
+    start = time.perf_counter()
+    result = {'ttft': None, 'timing': None, 'final_sql': None, 'error': None}
+    async for chunk in stream_sql_query(item['question'], ctx):
+        if chunk['type'] == 'token' and result['ttft'] is None:
+            result['ttft'] = time.perf_counter() - start
+        elif chunk['type'] == 'timing':
+            result['timing'] = chunk['content']
+        elif chunk['type'] == 'query_id':
+            result['final_sql'] = approved_queries.get(chunk['content'])[0]
+        elif chunk['type'] == 'error':
+            result['error'] = chunk['content']
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+async def run_level(corpus, concurrency, rounds, exec_mode):
+    '''
+    以指定并发回放语料rounds轮
+    :return: 报告
+    '''
+    from benchmarks.candidates_bench import execution_match
+    from core.biziness.texttosql import get_db
+    jobs = [item for _ in range(rounds) for item in corpus]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(index, item):
+        async with semaphore:
+            return item, await run_request(item, index, exec_mode)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(i, item) for i, item in enumerate(jobs)))
+    wall = time.perf_counter() - start
+    db = get_db()
+    matches = {}  #(问题,最终SQL)->是否匹配
+    stages = defaultdict(list)
+    latencies, ttfts, prompt_tokens, completion_tokens, schema_tokens = [], [], [], [], []
+    errors = matched = judged = 0
+    for item, result in results:
+        latencies.append(result['seconds'])
+        if result['ttft'] is not None:
+            ttfts.append(result['ttft'])
+        errors += bool(result['error'])
+        timing = result['timing'] or {}
+        per_request = defaultdict(float)
+        for stage in timing.get('stages', []):
+            per_request[stage['stage']] += stage['seconds']
+        for name, seconds in per_request.items():
+            stages[name].append(seconds)
+        prompt_tokens.append(timing.get('prompt_tokens', 0))
+        completion_tokens.append(timing.get('completion_tokens', 0))
+        schema_tokens.append(timing.get('schema_tokens', 0))
+        if item.get('gold_sql'):
+            judged += 1
+            key = (item['question'], result['final_sql'])
+            if key not in matches:
+                matches[key] = bool(result['final_sql']) and execution_match(db, result['final_sql'], item['gold_sql'])
+            matched += matches[key]
+    return {
+        'concurrency': concurrency,
+        'requests': len(results),
+        'errors': errors,
+        'qps': round(len(results) / wall, 3),
+        'latency': {'p50': round(percentile(latencies, 50), 4), 'p95': round(percentile(latencies, 95), 4),
+                    'p99': round(percentile(latencies, 99), 4), 'mean': round(statistics.mean(latencies), 4)},
+        'ttft_p50': round(percentile(ttfts, 50), 4),
+        'stages': {name: {'p50': round(percentile(values, 50), 4), 'p95': round(percentile(values, 95), 4)}
+                   for name, values in sorted(stages.items())},
+        'tokens': {'prompt_mean': round(statistics.mean(prompt_tokens), 1),
+                   'completion_mean': round(statistics.mean(completion_tokens), 1),
+                   'schema_mean': round(statistics.mean(schema_tokens), 1)},
+        'execution_accuracy': round(matched / judged, 4) if judged else None,
+    }
+
+
+def print_report(report, baseline=None):
+    previous = {level['concurrency']: level for level in (baseline or {}).get('levels', [])}
+
+    def delta(value, old):
+        if old is None or value is None:
+            return ''
+        return f' ({(value - old) / old:+.1%})' if old else ''
+
+    for level in report['levels']:
+        old = previous.get(level['concurrency'], {})
+        old_latency = old.get('latency', {})
+        print(f"concurrency={level['concurrency']:>3} n={level['requests']} errors={level['errors']} "
+              f"qps={level['qps']}{delta(level['qps'], old.get('qps'))} "
+              f"p50={level['latency']['p50']}s{delta(level['latency']['p50'], old_latency.get('p50'))} "
+              f"p99={level['latency']['p99']}s{delta(level['latency']['p99'], old_latency.get('p99'))} "
+              f"ttft_p50={level['ttft_p50']}s{delta(level['ttft_p50'], old.get('ttft_p50'))} "
+              f"tokens={level['tokens']['prompt_mean']}"
+              f"{delta(level['tokens']['prompt_mean'], old.get('tokens', {}).get('prompt_mean'))}"
+              f"+{level['tokens']['completion_mean']} schema_tokens={level['tokens']['schema_mean']} "
+              f"accuracy={level['execution_accuracy']}")
+        old_stages = old.get('stages', {})
+        for name, values in level['stages'].items():
+            print(f"    {name:<20} p50={values['p50']}s{delta(values['p50'], old_stages.get(name, {}).get('p50'))} "
+                  f"p95={values['p95']}s")
+
+
+async def record(corpus, path):
+    '''
+    使用真实LLM回放语料，录制生成的SQL及结果总结
+    :param corpus: 语料
+    :param path: 保存路径
+    :return:
+    '''
+    from langchain_core.callbacks import BaseCallbackHandler
+    from core.biziness.texttosql import get_llm
+
+    class Recorder(BaseCallbackHandler):
+        def __init__(self):
+            self.item = None
+            self.prompts = {}
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+            self.prompts[run_id] = '\n'.join(str(m.content) for batch in messages for m in batch)
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            prompt = self.prompts.pop(run_id, '')
+            text = response.generations[0][0].text
+            if 'SQLQuery' in prompt:
+                self.item['sql'] = text
+            elif '执行的SQL：' in prompt:
+                self.item['summary'] = text
+
+    recorder = Recorder()
+    get_llm().callbacks = [recorder]
+    for index, item in enumerate(corpus):
+        recorder.item = item
+        await run_request(item, index, 'direct')
+    with open(path, 'w', encoding='utf-8') as f:
+        for item in corpus:
+            f.write(json.dumps(item, ensure_ascii=False) + '\n')
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--rounds', type=int, default=3, help='每个并发级别回放语料的轮数')
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS)
+    parser.add_argument('--db', default=DEFAULT_DB, help='SQLite测试库路径，不存在时生成')
+    parser.add_argument('--exec-mode', choices=['direct', 'agent'], default='direct')
+    parser.add_argument('--ttft', type=float, default=0.0, help='模拟的首token延迟(秒)')
+    parser.add_argument('--tpot', type=float, default=0.0, help='模拟的每个输出块耗时(秒)')
+    parser.add_argument('--prefill', type=float, default=0.0, help='模拟的每千个提示词token的预填充耗时(秒)')
+    parser.add_argument('--schema-format', choices=['compact', 'full'], help='提示词中的表结构形式，默认使用配置')
+    parser.add_argument('--output', help='报告保存路径(JSON)')
+    parser.add_argument('--compare', help='对比的历史报告(JSON)')
+    parser.add_argument('--record', action='store_true', help='使用真实LLM重新录制语料中的回复')
+    args = parser.parse_args()
+    corpus = load_corpus(args.corpus)
+    if args.record:
+        configure(args.db)
+        await record(corpus, args.corpus)
+        print(f'已录制{len(corpus)}条回复到{args.corpus}')
+        return
+    if args.schema_format:
+        settings.texttosql['schema_format'] = args.schema_format
+    configure(args.db, corpus, args.ttft, args.tpot, args.prefill)
+    from core.biziness.texttosql import warmup_workflows
+    await warmup_workflows()
+    report = {'created_at': time.strftime('%Y-%m-%d %H:%M:%S'), 'exec_mode': args.exec_mode,
+              'schema_format': settings.texttosql['schema_format'], 'ttft': args.ttft, 'tpot': args.tpot,
+              'prefill': args.prefill, 'corpus': os.path.basename(args.corpus), 'levels': []}
+    for level in args.levels:
+        report['levels'].append(await run_level(corpus, level, args.rounds, args.exec_mode))
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,152 @@
+"""
+知识库查询基准测试(关键词/向量/混合检索)
+合成语料：每个切片属于一个主题，正文为主题词及通用词组成的中文文本，并带有唯一的证券代码；
+向量为主题中心加噪声(模拟语义相近的切片向量相近)
+两类查询，目标均为某一个切片：
+  精确查询：证券代码+一个主题词，查询向量只接近目标所在主题(向量模型无法区分代码)
+  语义查询：只含同义表述(切片中未出现的词)，查询向量接近目标切片
+按文档分批经KnowledgeBase写入(切片存储、向量索引及关键词索引同步增量更新)，
+统计写入吞吐、索引大小，以及各检索方式的recall@k、p50/p99延迟(含融合及读取切片，查询向量预先给定)
+用法：python -m benchmarks.retrieval_bench [--n 1000000] [--dim 64] [--queries 500] [--compact] [--reuse]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import time
+
+import numpy as np
+
+import settings
+
+DEFAULT_DIR = 'benchmarks/.cache/retrieval'
+
+
+class Corpus:
+    def __init__(self, n, dim, topic_size, seed):
+        rng = np.random.default_rng(seed)
+        self.n, self.rng = n, rng
+        chars = np.array([chr(c) for c in rng.choice(np.arange(0x4e00, 0x9fa5), 1200, replace=False)])
+        topics = max(1, n // topic_size)
+
+        def words(count):
+            lengths = rng.integers(2, 4, count)
+            return [''.join(rng.choice(chars, length)) for length in lengths]
+        self.topic_words = np.array(words(topics * 8)).reshape(topics, 8)  #出现在正文中
+        self.synonyms = np.array(words(topics * 4)).reshape(topics, 4)  #只出现在查询中
+        self.common = np.array(words(300))
+        self.topic = rng.integers(0, topics, n)
+        self.centers = rng.normal(size=(topics, dim)).astype(np.float32)
+        self.vectors = self.centers[self.topic] + rng.normal(scale=0.5, size=(n, dim)).astype(np.float32)
+        self.vectors /= np.linalg.norm(self.vectors, axis=1, keepdims=True)
+
+    def code(self, i):
+        #7919与10^6互质，i<10^6时代码唯一
+        return f'{(i * 7919) % 1000000:06d}.{"sh" if i % 2 else "sz"}'
+
+    def texts(self, start, end):
+        rng = self.rng
+        result = []
+        for i in range(start, end):
+            picked = list(rng.choice(self.topic_words[self.topic[i]], 6, replace=False)) + \
+                list(rng.choice(self.common, 10))
+            rng.shuffle(picked)
+            result.append(''.join(picked[:8]) + f'（{self.code(i)}）' + '，'.join(picked[8:]) + '。')
+        return result
+
+    def queries(self, count, dim):
+        '''
+        :return: [(类型,查询文本,查询向量,目标行号)]
+        '''
+        rng = self.rng
+        result = []
+        for j, row in enumerate(rng.choice(self.n, count, replace=False)):
+            topic = self.topic[row]
+            if j % 2 == 0:
+                text = f'{self.code(row)} {rng.choice(self.topic_words[topic])}'
+                vector = self.centers[topic] + rng.normal(scale=0.5, size=dim)
+                result.append(('exact', text, vector.astype(np.float32), row))
+            else:
+                text = ''.join(rng.choice(self.synonyms[topic], 2, replace=False)) + rng.choice(self.common)
+                vector = self.vectors[row] + rng.normal(scale=0.05, size=dim)
+                result.append(('semantic', text, vector.astype(np.float32), row))
+        return result
+
+
+def build(kb, corpus, doc_size):
+    start = time.perf_counter()
+    for offset in range(0, corpus.n, doc_size):
+        end = min(offset + doc_size, corpus.n)
+        chunks = [{'text': text, 'title': None} for text in corpus.texts(offset, end)]
+        kb.add_document(f'doc-{offset // doc_size:07d}', f'doc-{offset // doc_size:07d}.txt', chunks,
+                        corpus.vectors[offset:end])
+        if (offset // doc_size) % 100 == 99:
+            print(f'  {end}/{corpus.n} {end / (time.perf_counter() - start):.0f} chunks/s', flush=True)
+    return time.perf_counter() - start
+
+
+def directory_mb(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files) / 1024 / 1024
+
+
+async def evaluate(kb, queries, k, mode, id_of_row):
+    from core.biziness.knowledge.retrieval import hybrid_search
+    latencies, hits, degraded = [], {}, 0
+    for kind, text, vector, row in queries:
+        start = time.perf_counter()
+        result = await hybrid_search(text, k, mode=mode, vector=vector, kb=kb)
+        latencies.append((time.perf_counter() - start) * 1000)
+        degraded += bool(result['degraded'])
+        found = id_of_row(row) in {item['id'] for item in result['results']}
+        hit, total = hits.get(kind, (0, 0))
+        hits[kind] = (hit + found, total + 1)
+    latencies = np.array(latencies)
+    recall = ' '.join(f'{kind}={hit / total:.3f}' for kind, (hit, total) in sorted(hits.items()))
+    print(f'[{mode:>7}] recall@{k} {recall}  p50={np.percentile(latencies, 50):.1f}ms '
+          f'p99={np.percentile(latencies, 99):.1f}ms  degraded={degraded}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n', type=int, default=1000000, help='切片数')
+    parser.add_argument('--dim', type=int, default=64)
+    parser.add_argument('--topic-size', type=int, default=100, help='每个主题的平均切片数')
+    parser.add_argument('--doc-size', type=int, default=1000, help='每个文档的切片数')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--compact', action='store_true', help='写入后合并全部段')
+    parser.add_argument('--reuse', action='store_true', help='复用已建好的索引，只执行查询')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--dir', default=DEFAULT_DIR)
+    args = parser.parse_args()
+    from core.biziness.knowledge.store import KnowledgeBase
+    #只统计检索本身的延迟，不受预算截断
+    settings.retrieval['budget_ms'] = 60000
+    corpus = Corpus(args.n, args.dim, args.topic_size, args.seed)
+    if not args.reuse:
+        shutil.rmtree(args.dir, ignore_errors=True)
+    kb = KnowledgeBase(args.dir)
+    if not args.reuse:
+        seconds = build(kb, corpus, args.doc_size)
+        print(f'n={args.n} build={args.n / seconds:.0f} chunks/s ({seconds:.1f}s)')
+        if args.compact:
+            start = time.perf_counter()
+            kb.index.compact()
+            kb.keywords.compact()
+            print(f'compact={time.perf_counter() - start:.1f}s')
+    keywords, vectors = kb.keywords.get_stats(), kb.index.get_stats()
+    print(f"keywords: segments={keywords['segments']} terms={keywords['terms']} postings={keywords['postings']} "
+          f"size={keywords['size_mb']}MB ({keywords['size_mb'] * 1024 * 1024 / max(keywords['count'], 1):.0f}B/chunk) "
+          f"analyzer={keywords['analyzer']}")
+    print(f"vectors: segments={vectors['segments']} ann_segments={vectors['ann_segments']} "
+          f"size={directory_mb(kb.index.directory):.1f}MB  "
+          f"chunks.sqlite={os.path.getsize(os.path.join(args.dir, 'chunks.sqlite')) / 1024 / 1024:.1f}MB")
+    #切片ID从1开始按写入顺序分配
+    first = min(int(s.ids[0]) for s in kb.index.segments)
+    queries = corpus.queries(args.queries, args.dim)
+    for mode in ('keyword', 'vector', 'hybrid'):
+        asyncio.run(evaluate(kb, queries, args.k, mode, lambda row: first + int(row)))
+
+
+if __name__ == '__main__':
+    main()
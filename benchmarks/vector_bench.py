@@ -0,0 +1,128 @@
+"""
+向量索引基准测试
+在合成语料(高斯混合分布的归一化向量)上按文档分批增量写入，统计写入吞吐、冷启动加载耗时，
+以及不过滤、按标签过滤(不同选择率)、删除部分文档后的recall@k及单查询QPS，真值为全量精确检索
+用法：python -m benchmarks.vector_bench [--n 200000] [--dim 256] [--k 10] [--queries 500] [--ef-search 32 64 128]
+"""
+import argparse
+import os
+import shutil
+import time
+
+import numpy as np
+
+import settings
+
+DEFAULT_DIR = 'benchmarks/.cache/vector_index'
+
+
+def synthetic_corpus(n, dim, clusters, seed):
+    '''
+    高斯混合分布的归一化向量，查询取自同一分布
+    :return: (语料,查询生成函数)
+    '''
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, n)
+    corpus = centers[labels] + rng.normal(scale=0.6, size=(n, dim)).astype(np.float32)
+    corpus /= np.linalg.norm(corpus, axis=1, keepdims=True)
+
+    def queries(count):
+        picked = rng.integers(0, clusters, count)
+        q = centers[picked] + rng.normal(scale=0.6, size=(count, dim)).astype(np.float32)
+        return q / np.linalg.norm(q, axis=1, keepdims=True)
+    return corpus, queries
+
+
+def ground_truth(corpus, ids, queries, k, allowed=None):
+    '''
+    精确检索真值
+    :param corpus: 向量(行号即ID-1)
+    :param ids: 当前存在的ID
+    :param allowed: 过滤后的ID
+    :return: 每个查询的真值ID集合
+    '''
+    candidates = ids if allowed is None else np.intersect1d(ids, allowed)
+    matrix = corpus[candidates - 1]
+    truth = []
+    for q in queries:
+        scores = matrix @ q
+        top = np.argpartition(-scores, min(k, scores.size - 1))[:k]
+        truth.append(set(candidates[top].tolist()))
+    return truth
+
+
+def measure(index, queries, truth, k, allowed=None):
+    hits, total = 0, 0
+    start = time.perf_counter()
+    results = [index.search(q, k, allowed)[1] for q in queries]
+    seconds = time.perf_counter() - start
+    for result, expected in zip(results, truth):
+        hits += len(expected & set(result.tolist()))
+        total += len(expected)
+    return {'recall': round(hits / total, 4) if total else None, 'qps': round(len(queries) / seconds, 1),
+            'latency_ms': round(seconds / len(queries) * 1000, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n', type=int, default=200000, help='向量数')
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--clusters', type=int, default=200)
+    parser.add_argument('--doc-size', type=int, default=1000, help='每个文档的切片数(每次写入的向量数)')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--ef-search', type=int, nargs='+', default=[settings.knowledge['ef_search']])
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--dir', default=DEFAULT_DIR)
+    args = parser.parse_args()
+    from core.biziness.knowledge.vectorindex import VectorIndex
+    shutil.rmtree(args.dir, ignore_errors=True)
+    corpus, make_queries = synthetic_corpus(args.n, args.dim, args.clusters, args.seed)
+    ids = np.arange(1, args.n + 1, dtype=np.int64)
+    doc_of = (ids - 1) // args.doc_size
+
+    index = VectorIndex(args.dir)
+    start = time.perf_counter()
+    for offset in range(0, args.n, args.doc_size):
+        index.add(ids[offset:offset + args.doc_size], corpus[offset:offset + args.doc_size])
+    build = time.perf_counter() - start
+    index.compact()
+    compact = time.perf_counter() - start - build
+    start = time.perf_counter()
+    index = VectorIndex(args.dir)
+    load = time.perf_counter() - start
+    stats = index.get_stats()
+    size_mb = sum(os.path.getsize(os.path.join(args.dir, f)) for f in os.listdir(args.dir)) / 1024 / 1024
+    print(f"n={args.n} dim={args.dim} backend={stats['ann_backend']} insert={args.n / build:.0f} vectors/s "
+          f"compact={compact:.2f}s load={load * 1000:.1f}ms disk={size_mb:.1f}MB segments={stats['segments']}")
+
+    queries = make_queries(args.queries)
+    truth = ground_truth(corpus, ids, queries, args.k)
+    for ef in args.ef_search:
+        settings.knowledge['ef_search'] = ef
+        for segment in index.segments:
+            if segment.ann is not None:
+                segment.ann.hnsw.efSearch = ef
+        print(f'[all] ef_search={ef} recall@{args.k}/qps', measure(index, queries, truth, args.k))
+
+    rng = np.random.default_rng(args.seed)
+    docs = doc_of.max() + 1
+    for selectivity in (0.01, 0.1, 0.5):
+        tagged = rng.choice(docs, max(1, int(docs * selectivity)), replace=False)
+        allowed = ids[np.isin(doc_of, tagged)]
+        truth_filtered = ground_truth(corpus, ids, queries, args.k, allowed)
+        print(f'[tag {selectivity:.0%}] recall@{args.k}/qps', measure(index, queries, truth_filtered, args.k, allowed))
+
+    removed = rng.choice(docs, max(1, docs // 10), replace=False)
+    start = time.perf_counter()
+    index.delete(ids[np.isin(doc_of, removed)])
+    delete = time.perf_counter() - start
+    remaining = ids[~np.isin(doc_of, removed)]
+    truth_deleted = ground_truth(corpus, remaining, queries, args.k)
+    print(f'[deleted 10% docs in {delete * 1000:.1f}ms] recall@{args.k}/qps',
+          measure(index, queries, truth_deleted, args.k))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import settings
 from settings import template
 class BaseView:
     def __init__(self):
@@ -8,4 +9,23 @@ class BaseView:
         权限校验
         :return:
         '''
-        pass
\ No newline at end of file
+        pass
+    def current_user(self,request):
+        '''
+        当前用户标识(并发查询数限制、上传人)
+        只有来自可信代理(settings.trusted_proxies)的请求才采用X-User(认证网关设置)及X-Forwarded-For，
+        否则客户端可以随意伪造；直连时使用客户端地址
+        :param request:
+        :return:
+        '''
+        host=request.client.host if request.client else None
+        if host in settings.trusted_proxies:
+            user=request.headers.get('X-User')
+            if user:
+                return user
+            forwarded=[item.strip() for item in request.headers.get('X-Forwarded-For','').split(',') if item.strip()]
+            #从右向左第一个非代理地址为真实客户端，左侧的地址可由客户端伪造
+            for address in reversed(forwarded):
+                if address not in settings.trusted_proxies:
+                    return address
+        return host or 'anonymous'
@@ -3,11 +3,12 @@ class AccoutInfo:
     def __init__(self):
         self.account=AccountInfo()
 
-    def  auth(self,user,pwd)-> bool:
+    async def  auth(self,user,pwd,session=None)-> bool:
         '''
         验证有效用户
         :param user:
         :param pwd:
+        :param session: 请求级的异步会话
         :return:
         '''
-        return self.account.auth_user(user,pwd)
\ No newline at end of file
+        return await self.account.auth_user(user,pwd,session)
@@ -0,0 +1,241 @@
+"""
+问题->SQL 两级缓存
+一级：规范化后的问题精确匹配
+二级：bge向量相似度匹配(阈值可配置，向量由core.biziness.embedding合批计算并缓存)，模型不可用时自动关闭
+精确匹配的问题另写入共享缓存(core.dataaccess.redis.cache)，多个worker之间互相命中
+命中后跳过LLM，直接执行缓存的SQL
+"""
+import hashlib
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from difflib import SequenceMatcher
+from typing import Optional
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+#小数点(两侧均为数字的.)不属于标点
+_punctuation = re.compile(r'[\s,;:!?，。；：！？、“”‘’"\'()（）]+|(?<!\d)\.|\.(?!\d)')
+_number = re.compile(r'\d+(?:\.\d+)?')
+#语义命中时两个问题只允许在这些不影响查询含义的词上不同；比较、否定、排序词及股票代码、名称等实体的差异都会改变SQL
+_STOP_WORDS = ['请问', '请', '帮我', '帮忙', '给我', '我想', '想', '知道', '一下', '查询', '查找', '查一下', '查', '列出',
+               '显示', '找出', '看看', '看', '所有', '全部', '的', '了', '吗', '呢', '吧', '啊', '哪些',
+               '是什么', '什么', '都', '分别', '一共', '总共']
+_filler = re.compile('(?:' + '|'.join(sorted(map(re.escape, _STOP_WORDS), key=len, reverse=True)) + ')+')
+
+
+def _strip_punctuation(match) -> str:
+    #数字之间的标点保留为空格，避免"10,20"与"1020"相同
+    text = match.string
+    if 0 < match.start() and match.end() < len(text) and text[match.start() - 1].isdigit() \
+            and text[match.end()].isdigit():
+        return ' '
+    return ''
+
+
+def differs_only_by_stop_words(a: str, b: str) -> bool:
+    '''
+    两个规范化问题的差异部分是否全部由_STOP_WORDS组成
+    :param a:
+    :param b:
+    :return:
+    '''
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            continue
+        for segment in (a[i1:i2], b[j1:j2]):
+            if segment and not _filler.fullmatch(segment):
+                return False
+    return True
+
+
+def normalize_question(question: str) -> str:
+    '''
+    规范化问题：全角转半角、小写、去除空白及标点(保留小数点，数字之间的标点保留为空格)
+    :param question:
+    :return:
+    '''
+    question = unicodedata.normalize('NFKC', question).lower()
+    return _punctuation.sub(_strip_punctuation, question)
+
+
+class AnswerCache:
+    """问题->SQL缓存，LRU+TTL淘汰"""
+
+    def __init__(self, max_entries: int = 1000, ttl: int = 3600, similarity: float = 0.92,
+                 embedding_model: Optional[str] = None, shared: bool = False):
+        '''
+        :param max_entries: 最大缓存条数
+        :param ttl: 缓存有效期(秒)
+        :param similarity: 语义缓存命中的余弦相似度阈值
+        :param embedding_model: 向量模型(settings.embeddings中的配置名)，为空时只启用精确缓存
+        :param shared: 是否同时使用共享缓存
+        '''
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.embedding_model = embedding_model
+        self.shared = shared
+        self._embedding_failed = embedding_model is None
+        self._entries = OrderedDict()  #(命名空间,规范化问题)->{'question','sql','vector','created'}
+        self._lock = threading.Lock()
+        self.stats = {'exact_hits': 0, 'semantic_hits': 0, 'shared_hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _embed(self, text: str):
+        '''
+        计算归一化向量，模型加载失败时返回None
+        :param text:
+        :return:
+        '''
+        if self._embedding_failed:
+            return None
+        from core.biziness.embedding import get_embedding_service
+        try:
+            return get_embedding_service(self.embedding_model).embed([text])[0]
+        except Exception as e:
+            logger.warning('语义缓存不可用，加载向量模型失败：%s', e)
+            self._embedding_failed = True
+            return None
+
+    def _expired(self, entry) -> bool:
+        return time.time() - entry['created'] > self.ttl
+
+    def lookup(self, question: str, namespace: str = '') -> Optional[dict]:
+        '''
+        查询缓存
+        :param question: 用户问题
+        :param namespace: 命名空间(如数据库配置名)，不同数据库的SQL互不命中
+        :return: {'sql','tier','question','score'}，未命中返回None
+        '''
+        key = (namespace, normalize_question(question))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and not self._expired(entry):
+                self._entries.move_to_end(key)
+                self.stats['exact_hits'] += 1
+                return {'sql': entry['sql'], 'tier': 'exact', 'question': entry['question'], 'score': 1.0}
+            if entry:
+                del self._entries[key]
+        vector = self._embed(key[1])
+        if vector is not None:
+            hit = self._semantic_lookup(key, vector)
+            if hit:
+                return hit
+        with self._lock:
+            self.stats['misses'] += 1
+        return None
+
+    def _semantic_lookup(self, key: str, vector) -> Optional[dict]:
+        '''
+        向量相似度查找；问题中的数字必须一致，避免"前10"命中"前20"，
+        且两个问题只能在语气、客套等停用词上不同，避免"大于30"命中"小于30"、"最高"命中"最低"
+        :param key:
+        :param vector:
+        :return:
+        '''
+        numbers = _number.findall(key[1])
+        best_key, best_score = None, self.similarity
+        with self._lock:
+            for cached_key, entry in self._entries.items():
+                if cached_key[0] != key[0] or entry['vector'] is None or self._expired(entry):
+                    continue
+                if _number.findall(cached_key[1]) != numbers or not differs_only_by_stop_words(key[1], cached_key[1]):
+                    continue
+                score = float(vector @ entry['vector'])
+                if score >= best_score:
+                    best_key, best_score = cached_key, score
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            entry = self._entries[best_key]
+            self.stats['semantic_hits'] += 1
+            return {'sql': entry['sql'], 'tier': 'semantic', 'question': entry['question'],
+                    'score': round(best_score, 4)}
+
+    def store(self, question: str, sql: str, namespace: str = ''):
+        '''
+        写入缓存
+        :param question: 用户问题
+        :param sql: 执行成功的SQL
+        :param namespace: 命名空间
+        :return:
+        '''
+        key = (namespace, normalize_question(question))
+        vector = self._embed(key[1])
+        with self._lock:
+            self._entries[key] = {'question': question, 'sql': sql, 'vector': vector, 'created': time.time()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def evict(self, question: str, namespace: str = ''):
+        '''
+        删除缓存(如缓存的SQL执行失败)
+        :param question:
+        :param namespace:
+        :return:
+        '''
+        with self._lock:
+            self._entries.pop((namespace, normalize_question(question)), None)
+
+    def _shared_key(self, question: str, namespace: str) -> str:
+        return f"{namespace}:{hashlib.sha1(normalize_question(question).encode('utf-8')).hexdigest()}"
+
+    async def shared_lookup(self, question: str, namespace: str = '') -> Optional[dict]:
+        '''
+        查询共享缓存(本进程未命中时)
+        :param question:
+        :param namespace:
+        :return: 同lookup
+        '''
+        if not self.shared:
+            return None
+        from core.dataaccess.redis.cache import get_cache
+        entry = await get_cache('answers', self.ttl).get(self._shared_key(question, namespace))
+        if entry is None:
+            return None
+        with self._lock:
+            self.stats['shared_hits'] += 1
+        return {'sql': entry['sql'], 'tier': 'shared', 'question': entry['question'], 'score': 1.0}
+
+    async def shared_store(self, question: str, sql: str, namespace: str = ''):
+        if self.shared:
+            from core.dataaccess.redis.cache import get_cache
+            await get_cache('answers', self.ttl).set(self._shared_key(question, namespace),
+                                                     {'question': question, 'sql': sql})
+
+    async def shared_evict(self, question: str, namespace: str = ''):
+        if self.shared:
+            from core.dataaccess.redis.cache import get_cache
+            await get_cache('answers', self.ttl).delete(self._shared_key(question, namespace))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> dict:
+        '''
+        命中率统计
+        :return:
+        '''
+        with self._lock:
+            stats = dict(self.stats, entries=len(self._entries))
+        #misses为本进程未命中数，其中shared_hits条由共享缓存命中
+        total = stats['exact_hits'] + stats['semantic_hits'] + stats['misses']
+        hits = stats['exact_hits'] + stats['semantic_hits'] + stats['shared_hits']
+        stats['hit_rate'] = round(hits / total, 4) if total else 0.0
+        return stats
+
+
+_config = settings.texttosql['answer_cache']
+answer_cache = AnswerCache(max_entries=_config['max_entries'],
+                           ttl=_config['ttl'],
+                           similarity=_config['similarity'],
+                           embedding_model=settings.embedding_service['model'] if _config['semantic'] else None,
+                           shared=_config['shared'])
@@ -0,0 +1,153 @@
+"""
+查询成本保护
+执行前根据EXPLAIN FORMAT=JSON的估算扫描行数及成本拒绝或改写大查询(改写后的SQL重新EXPLAIN，仍超限时拒绝)，
+并限制每个用户同时执行的查询数，避免LLM生成的笛卡尔积等查询拖垮数据库
+生成、缓存命中、Agent修正及结果导出执行的SQL都经过check_query_cost
+"""
+import asyncio
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from langchain_community.agent_toolkits import SQLDatabaseToolkit
+from langchain_community.tools.sql_database.tool import QuerySQLDatabaseTool
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+
+import settings
+from core.biziness.sqlvalidator import DIALECTS, get_limit, parse_sql, validate_select
+from core.dataaccess.sql.executor import explain_sql
+
+
+@dataclass
+class GuardResult:
+    action: str  #ok(放行)/rewrite(改写后放行)/reject(拒绝)
+    sql: Optional[str] = None  #放行时执行的SQL
+    reason: Optional[str] = None
+
+
+def _can_stop_early(sql: str, dialect: str) -> bool:
+    '''
+    无排序/分组/聚合/去重的查询，数据库取够LIMIT行即可停止扫描，收紧LIMIT能有效降低代价
+    :param sql:
+    :param dialect:
+    :return:
+    '''
+    tree = parse_sql(sql, DIALECTS.get(dialect, dialect))[0]
+    if not isinstance(tree, exp.Select):
+        return False
+    if tree.args.get('order') or tree.args.get('group') or tree.args.get('distinct') or tree.args.get('having'):
+        return False
+    return not any(isinstance(node, exp.AggFunc) for node in tree.find_all(exp.AggFunc))
+
+
+def _over_limit(plan: dict, config: dict) -> Optional[str]:
+    reasons = []
+    if plan.get('rows') is not None and plan['rows'] > config['max_rows_examined']:
+        reasons.append(f"估算扫描行数{int(plan['rows'])}超过上限{config['max_rows_examined']}")
+    if plan.get('cost') is not None and plan['cost'] > config['max_query_cost']:
+        reasons.append(f"估算成本{plan['cost']}超过上限{config['max_query_cost']}")
+    return '，'.join(reasons) or None
+
+
+def guard_query(sql: str, plan: dict, dialect: str, config: Optional[dict] = None) -> GuardResult:
+    '''
+    根据执行计划判断查询是否允许执行
+    :param sql: 已校验的SQL
+    :param plan: explain_sql的返回值
+    :param dialect: sqlalchemy方言名
+    :param config: 阈值配置，默认settings.texttosql['cost_guard']
+    :return:
+    '''
+    config = config or settings.texttosql['cost_guard']
+    reason = _over_limit(plan, config)
+    if reason is None:
+        return GuardResult('ok', sql=sql)
+    if config['action'] == 'rewrite' and _can_stop_early(sql, dialect):
+        read = DIALECTS.get(dialect, dialect)
+        tree = parse_sql(sql, read)[0]
+        current = get_limit(tree)
+        limit = config['rewrite_limit'] if current is None or current < 0 else min(current, config['rewrite_limit'])
+        rewritten = tree.limit(limit).sql(dialect=read)
+        return GuardResult('rewrite', sql=rewritten, reason=f"{reason}，已将返回行数限制为{limit}")
+    return GuardResult('reject', reason=reason)
+
+
+def check_query_cost(db, sql: str, plan: Optional[dict] = None, allow_rewrite: bool = True,
+                     config: Optional[dict] = None) -> Tuple[GuardResult, dict]:
+    '''
+    EXPLAIN并判断查询是否允许执行；改写后的SQL重新EXPLAIN，改写未能使估算降到阈值内时拒绝
+    :param db: SQLDatabase
+    :param sql: 已校验的SQL
+    :param plan: 已有的explain_sql结果(如候选SQL试运行的结果)，为空时执行EXPLAIN
+    :param allow_rewrite: 为False时超限直接拒绝(结果导出需要完整结果，不能收紧LIMIT)
+    :param config: 阈值配置，默认settings.texttosql['cost_guard']
+    :return: (GuardResult,执行计划)，EXPLAIN失败时plan['ok']为False，GuardResult为reject
+    '''
+    config = config or settings.texttosql['cost_guard']
+    plan = plan or explain_sql(db, sql)
+    if not plan['ok']:
+        return GuardResult('reject', reason=f"SQL试运行失败：{plan['error']}"), plan
+    if not allow_rewrite:
+        config = dict(config, action='reject')
+    guard = guard_query(sql, plan, db.dialect, config)
+    if guard.action != 'rewrite':
+        return guard, plan
+    rewritten_plan = explain_sql(db, guard.sql)
+    reason = _over_limit(rewritten_plan, config) if rewritten_plan['ok'] else rewritten_plan['error']
+    if reason is not None:
+        return GuardResult('reject', reason=f"{guard.reason}，改写后仍不满足：{reason}"), rewritten_plan
+    return guard, rewritten_plan
+
+
+class GuardedQuerySQLDatabaseTool(QuerySQLDatabaseTool):
+    """Agent的sql_db_query工具：执行前校验SQL(只允许单条安全的SELECT)并检查成本，不通过时把原因作为错误返回，由Agent修正SQL"""
+
+    def _run(self, query: str, run_manager=None):
+        check = validate_select(query, self.db.dialect, self.db.get_schema_columns())
+        if not check.ok:
+            return f'Error: {check.error}'
+        try:
+            guard, _ = check_query_cost(self.db, check.sql)
+        except SqlglotError as e:
+            return f'Error: SQL语法错误：{str(e).splitlines()[0]}'
+        if guard.action == 'reject':
+            return f'Error: {guard.reason}'
+        return super()._run(guard.sql, run_manager)
+
+
+class GuardedSQLDatabaseToolkit(SQLDatabaseToolkit):
+    """执行查询的工具替换为GuardedQuerySQLDatabaseTool，其余工具不变"""
+
+    def get_tools(self):
+        return [GuardedQuerySQLDatabaseTool(db=tool.db, description=tool.description)
+                if isinstance(tool, QuerySQLDatabaseTool) else tool for tool in super().get_tools()]
+
+
+class UserQueryLimiter:
+    """每个用户同时执行的查询数限制，超限时立即拒绝而不是排队"""
+
+    def __init__(self, max_concurrent: int = 2):
+        self.max_concurrent = max_concurrent
+        self._running: Dict[str, int] = {}
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, user: str) -> bool:
+        async with self._lock:
+            if self._running.get(user, 0) >= self.max_concurrent:
+                return False
+            self._running[user] = self._running.get(user, 0) + 1
+            return True
+
+    async def release(self, user: str):
+        async with self._lock:
+            count = self._running.get(user, 0) - 1
+            if count > 0:
+                self._running[user] = count
+            else:
+                self._running.pop(user, None)
+
+    def running(self) -> Dict[str, int]:
+        return dict(self._running)
+
+
+user_limiter = UserQueryLimiter(settings.texttosql['cost_guard']['max_concurrent_per_user'])
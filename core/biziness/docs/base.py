@@ -0,0 +1,109 @@
+"""
+文档解析基础定义
+各格式的解析器以生成器逐页/逐表/逐节产出内容，不一次性加载整个文档的解析结果；
+解析器按扩展名注册，新增格式时实现Extractor并调用register_extractor
+"""
+import codecs
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, Type
+
+
+@dataclass
+class Section:
+    text: str
+    kind: str  #page(PDF页)/sheet(工作表的一段行)/section(按标题划分的章节)
+    index: int  #在文档中的序号(从0开始)
+    title: str = ''  #章节标题或工作表名
+    metadata: dict = field(default_factory=dict)  #页码、行范围等
+
+
+class DocumentError(Exception):
+    pass
+
+
+class UnsupportedDocument(DocumentError):
+    pass
+
+
+def detect_encoding(path: str, sample_size: int = 64 * 1024) -> str:
+    '''
+    判断文本文件编码：有BOM时按BOM，开头部分是合法UTF-8时为UTF-8，否则按GB18030(兼容GBK/GB2312，中文语料中常见)
+    :param path: 文件路径
+    :param sample_size: 读取的字节数
+    :return: 编码名，可直接用于open
+    '''
+    with open(path, 'rb') as f:
+        sample = f.read(sample_size)
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    try:
+        #final=False：样本末尾被截断的多字节字符不算错误
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'gb18030'
+
+
+class Extractor:
+    """解析器基类，子类实现iter_sections"""
+    extensions = ()
+
+    def iter_sections(self, path: str) -> Iterator[Section]:
+        raise NotImplementedError
+
+
+_extractors: Dict[str, Type[Extractor]] = {}
+
+
+def register_extractor(cls: Type[Extractor]) -> Type[Extractor]:
+    '''
+    注册解析器，可作为类装饰器使用
+    :param cls: 解析器类
+    :return:
+    '''
+    for ext in cls.extensions:
+        _extractors[ext.lower()] = cls
+    return cls
+
+
+def get_extractor(path: str) -> Extractor:
+    '''
+    按扩展名获取解析器
+    :param path: 文件路径
+    :return:
+    '''
+    #导入各格式模块以完成注册
+    from core.biziness.docs import pdf, word, excel, html, text  # noqa: F401
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in _extractors:
+        raise UnsupportedDocument(f'不支持解析的文件类型：{ext}')
+    return _extractors[ext]()
+
+
+def split_by_headings(blocks, kind: str = 'section', max_chars: int = 20000) -> Iterator[Section]:
+    '''
+    将(是否标题,标题级别,文本)块按标题划分为章节，过长的章节按max_chars拆分
+    :param blocks: 可迭代的(is_heading,level,text)
+    :param kind: 章节类型
+    :param max_chars: 单个章节最大字符数
+    :return:
+    '''
+    index = 0
+    title, parts, size = '', [], 0
+    for is_heading, level, text in blocks:
+        text = text.strip()
+        if not text:
+            continue
+        if (is_heading and parts) or size + len(text) > max_chars and parts:
+            yield Section(text='\n'.join(parts), kind=kind, index=index, title=title)
+            index += 1
+            parts, size = [], 0
+        if is_heading:
+            title = text
+        parts.append(text)
+        size += len(text)
+    if parts:
+        yield Section(text='\n'.join(parts), kind=kind, index=index, title=title)
@@ -0,0 +1,89 @@
+"""
+Excel解析：逐个工作表按行读取，每rows_per_section行产出一段
+.xlsx使用openpyxl只读模式(流式读取，不加载整个工作簿)；.xls使用xlrd
+"""
+from typing import Iterator, Optional
+
+import settings
+from core.biziness.docs.base import Extractor, Section, UnsupportedDocument, register_extractor
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+try:
+    import xlrd
+except ImportError:
+    xlrd = None
+
+
+def _format_row(values) -> Optional[str]:
+    cells = ['' if v is None else str(v).strip() for v in values]
+    return '\t'.join(cells).rstrip('\t') or None
+
+
+def _iter_rows_sections(sheets, rows_per_section: int) -> Iterator[Section]:
+    '''
+    :param sheets: 可迭代的(工作表名,行迭代器)
+    :param rows_per_section: 每段行数，首行(表头)在每段重复
+    :return:
+    '''
+    index = 0
+    for sheet_index, (name, rows) in enumerate(sheets):
+        header, lines, start, row_no, emitted = None, [], 1, 0, 0
+        for row_no, values in enumerate(rows, 1):
+            line = _format_row(values)
+            if line is None:
+                continue
+            if header is None:
+                header, start = line, row_no + 1
+                continue
+            lines.append(line)
+            if len(lines) >= rows_per_section:
+                yield Section(text='\n'.join([header] + lines), kind='sheet', index=index, title=name,
+                              metadata={'sheet': sheet_index, 'rows': [start, row_no]})
+                index += 1
+                emitted += 1
+                lines, start = [], row_no + 1
+        if lines or (header is not None and not emitted):
+            yield Section(text='\n'.join([header] + lines), kind='sheet', index=index, title=name,
+                          metadata={'sheet': sheet_index, 'rows': [start, row_no]})
+            index += 1
+
+
+@register_extractor
+class ExcelExtractor(Extractor):
+    extensions = ('.xlsx', '.xls')
+
+    def __init__(self, rows_per_section: Optional[int] = None):
+        self.rows_per_section = rows_per_section or settings.docs['excel_rows_per_section']
+
+    def iter_sections(self, path: str) -> Iterator[Section]:
+        if path.lower().endswith('.xls'):
+            yield from self._iter_xls(path)
+        else:
+            yield from self._iter_xlsx(path)
+
+    def _iter_xlsx(self, path: str) -> Iterator[Section]:
+        if openpyxl is None:
+            raise UnsupportedDocument('解析.xlsx需要安装openpyxl')
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            sheets = ((ws.title, ws.iter_rows(values_only=True)) for ws in workbook.worksheets)
+            yield from _iter_rows_sections(sheets, self.rows_per_section)
+        finally:
+            workbook.close()
+
+    def _iter_xls(self, path: str) -> Iterator[Section]:
+        if xlrd is None:
+            raise UnsupportedDocument('解析.xls需要安装xlrd')
+        workbook = xlrd.open_workbook(path, on_demand=True)
+        try:
+            def sheets():
+                for i in range(workbook.nsheets):
+                    sheet = workbook.sheet_by_index(i)
+                    yield sheet.name, (sheet.row_values(r) for r in range(sheet.nrows))
+                    workbook.unload_sheet(i)
+            yield from _iter_rows_sections(sheets(), self.rows_per_section)
+        finally:
+            workbook.release_resources()
@@ -0,0 +1,83 @@
+"""
+HTML解析：增量读取文件并按h1-h6标题划分章节，跳过script/style等非正文内容
+使用标准库html.parser，无需额外依赖
+"""
+from html.parser import HTMLParser
+from typing import Iterator, List, Tuple
+
+import settings
+from core.biziness.docs.base import Extractor, Section, detect_encoding, register_extractor, split_by_headings
+
+_SKIP = {'script', 'style', 'noscript', 'template', 'svg', 'head'}
+_BLOCK = {'p', 'div', 'li', 'tr', 'br', 'table', 'section', 'article', 'pre', 'blockquote', 'ul', 'ol', 'dd', 'dt'}
+_HEADINGS = {'h1': 1, 'h2': 2, 'h3': 3, 'h4': 4, 'h5': 5, 'h6': 6}
+
+
+class _BlockParser(HTMLParser):
+    """将HTML转换为(是否标题,标题级别,文本)块，已完成的块保存在blocks中由调用方取走"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks: List[Tuple[bool, int, str]] = []
+        self._skip = 0
+        self._heading = 0
+        self._buffer: List[str] = []
+
+    def _flush(self):
+        #单元格以制表符分隔，其余空白合并
+        cells = [' '.join(cell.split()) for cell in ''.join(self._buffer).split('\t')]
+        text = '\t'.join(cells).strip('\t')
+        self._buffer = []
+        if text:
+            self.blocks.append((bool(self._heading), self._heading, text))
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP:
+            self._skip += 1
+        elif tag in _HEADINGS:
+            self._flush()
+            self._heading = _HEADINGS[tag]
+        elif tag in _BLOCK:
+            self._flush()
+        elif tag in ('td', 'th'):
+            self._buffer.append('\t')
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP:
+            self._skip = max(self._skip - 1, 0)
+        elif tag in _HEADINGS:
+            self._flush()
+            self._heading = 0
+        elif tag in _BLOCK:
+            self._flush()
+
+    def handle_data(self, data):
+        if not self._skip:
+            self._buffer.append(data)
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+@register_extractor
+class HtmlExtractor(Extractor):
+    extensions = ('.html', '.htm')
+
+    def iter_sections(self, path: str) -> Iterator[Section]:
+        yield from split_by_headings(self._iter_blocks(path))
+
+    @staticmethod
+    def _iter_blocks(path: str):
+        parser = _BlockParser()
+        chunk_size = settings.docs['read_chunk_size']
+        with open(path, encoding=detect_encoding(path), errors='replace') as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                parser.feed(data)
+                yield from parser.blocks
+                parser.blocks = []
+        parser.close()
+        yield from parser.blocks
@@ -0,0 +1,48 @@
+"""
+PDF解析：逐页产出文本
+优先使用PyMuPDF(速度快、内存占用低)，未安装时使用pypdf
+"""
+from typing import Iterator
+
+from core.biziness.docs.base import Extractor, Section, UnsupportedDocument, register_extractor
+
+try:
+    import fitz  #PyMuPDF
+except ImportError:
+    fitz = None
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+
+@register_extractor
+class PdfExtractor(Extractor):
+    extensions = ('.pdf',)
+
+    def iter_sections(self, path: str) -> Iterator[Section]:
+        if fitz is not None:
+            yield from self._iter_fitz(path)
+        elif PdfReader is not None:
+            yield from self._iter_pypdf(path)
+        else:
+            raise UnsupportedDocument('解析PDF需要安装PyMuPDF或pypdf')
+
+    @staticmethod
+    def _iter_fitz(path: str) -> Iterator[Section]:
+        with fitz.open(path) as doc:
+            total = doc.page_count
+            for index in range(total):
+                #逐页加载，处理完即释放
+                page = doc.load_page(index)
+                text = page.get_text('text')
+                yield Section(text=text, kind='page', index=index, metadata={'page': index + 1, 'pages': total})
+
+    @staticmethod
+    def _iter_pypdf(path: str) -> Iterator[Section]:
+        with open(path, 'rb') as f:
+            reader = PdfReader(f)
+            total = len(reader.pages)
+            for index in range(total):
+                text = reader.pages[index].extract_text() or ''
+                yield Section(text=text, kind='page', index=index, metadata={'page': index + 1, 'pages': total})
@@ -0,0 +1,183 @@
+"""
+文档解析任务
+解析在独立的进程池中执行(PDF/Excel解析为CPU密集型，不占用API进程的事件循环及GIL)，
+每个解析进程限制内存上限，处理一定数量的文档后重启以回收内存；
+解析结果经有界队列分批回传，调用方按页/表/节逐段消费，消费慢时解析进程等待
+"""
+import multiprocessing
+import queue
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import AsyncIterator, Iterator, List
+
+import settings
+from core.biziness.docs.base import DocumentError, Section, get_extractor
+from utils.asyncutils import run_blocking
+
+try:
+    import resource
+except ImportError:  #Windows不支持按进程限制内存
+    resource = None
+
+_pool = None
+_manager = None
+_lock = threading.Lock()
+
+
+def _init_worker(memory_limit_mb: int):
+    if resource is not None and memory_limit_mb:
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _put(q, cancel, item) -> bool:
+    '''
+    放入回传队列，队列满时等待，调用方已放弃时返回False
+    '''
+    while not cancel.is_set():
+        try:
+            q.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _extract_worker(path: str, q, cancel, batch_size: int):
+    '''
+    在解析进程中执行：逐段解析并分批放入队列
+    消息格式：('sections',[Section])/('done',段数)/('error',错误信息)
+    '''
+    count, batch = 0, []
+    try:
+        for section in get_extractor(path).iter_sections(path):
+            batch.append(section)
+            count += 1
+            if len(batch) >= batch_size:
+                if not _put(q, cancel, ('sections', batch)):
+                    return
+                batch = []
+        if batch and not _put(q, cancel, ('sections', batch)):
+            return
+        _put(q, cancel, ('done', count))
+    except MemoryError:
+        _put(q, cancel, ('error', f"解析超过内存上限({settings.docs['memory_limit_mb']}MB)"))
+    except Exception as e:
+        _put(q, cancel, ('error', f'{type(e).__name__}: {e}'))
+
+
+def _get_pool():
+    global _pool, _manager
+    with _lock:
+        if _pool is None:
+            config = settings.docs
+            #spawn：解析进程不继承API进程的连接池、线程等状态
+            context = multiprocessing.get_context('spawn')
+            kwargs = {}
+            if sys.version_info >= (3, 11):
+                kwargs['max_tasks_per_child'] = config['max_tasks_per_child']
+            _pool = ProcessPoolExecutor(max_workers=config['workers'], mp_context=context,
+                                        initializer=_init_worker, initargs=(config['memory_limit_mb'],), **kwargs)
+            if _manager is None:
+                _manager = context.Manager()
+        return _pool, _manager
+
+
+def _reset_pool(pool):
+    '''
+    解析进程异常退出(如原生库崩溃或超过内存上限被终止)后进程池不可再用，下次使用时重建
+    '''
+    global _pool
+    with _lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def warmup():
+    '''
+    预先启动全部解析进程(spawn启动较慢)
+    :return:
+    '''
+    pool, _ = _get_pool()
+    for future in [pool.submit(abs, 0) for _ in range(settings.docs['workers'])]:
+        future.result()
+
+
+def shutdown():
+    '''
+    关闭进程池
+    :return:
+    '''
+    global _pool, _manager
+    with _lock:
+        pool, manager, _pool, _manager = _pool, _manager, None, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+    if manager is not None:
+        manager.shutdown()
+
+
+async def iter_document(path: str) -> AsyncIterator[Section]:
+    '''
+    在进程池中解析文档，逐段产出
+    提前停止迭代时解析进程随之停止
+    :param path: 文件路径
+    :return:
+    '''
+    pool, manager = _get_pool()
+    q = manager.Queue(maxsize=settings.docs['queue_size'])
+    cancel = manager.Event()
+    try:
+        future = pool.submit(_extract_worker, path, q, cancel, settings.docs['batch_size'])
+    except BrokenProcessPool:
+        _reset_pool(pool)
+        raise DocumentError('解析进程池不可用，请重试')
+    try:
+        while True:
+            try:
+                kind, payload = await run_blocking(q.get, True, 1)
+            except queue.Empty:
+                if not future.done():
+                    continue
+                try:
+                    future.result()
+                except BrokenProcessPool:
+                    _reset_pool(pool)
+                    raise DocumentError('解析进程异常退出，文档可能过大或已损坏')
+                #解析进程正常结束：等待超时后才写入的最后几批仍在队列中
+                try:
+                    kind, payload = await run_blocking(q.get_nowait)
+                except queue.Empty:
+                    raise DocumentError('解析进程异常退出')
+            if kind == 'sections':
+                for section in payload:
+                    yield section
+            elif kind == 'error':
+                raise DocumentError(payload)
+            else:
+                break
+    finally:
+        cancel.set()
+        if not future.done():
+            future.cancel()
+
+
+async def extract_document(path: str) -> List[Section]:
+    '''
+    在进程池中解析整个文档
+    :param path: 文件路径
+    :return:
+    '''
+    return [section async for section in iter_document(path)]
+
+
+def iter_document_inline(path: str) -> Iterator[Section]:
+    '''
+    在当前进程中解析(脚本、解析进程内部及基准测试对照使用)，不要在事件循环中直接调用
+    :param path: 文件路径
+    :return:
+    '''
+    return get_extractor(path).iter_sections(path)
@@ -0,0 +1,27 @@
+"""
+纯文本/Markdown解析：逐行读取(编码见detect_encoding)，Markdown按#标题划分章节
+"""
+import re
+from typing import Iterator
+
+from core.biziness.docs.base import Extractor, Section, detect_encoding, register_extractor, split_by_headings
+
+_MD_HEADING = re.compile(r'^(#{1,6})\s+(.*)$')
+
+
+@register_extractor
+class TextExtractor(Extractor):
+    extensions = ('.txt', '.md')
+
+    def iter_sections(self, path: str) -> Iterator[Section]:
+        yield from split_by_headings(self._iter_blocks(path, path.lower().endswith('.md')))
+
+    @staticmethod
+    def _iter_blocks(path: str, markdown: bool):
+        with open(path, encoding=detect_encoding(path), errors='replace') as f:
+            for line in f:
+                match = _MD_HEADING.match(line) if markdown else None
+                if match:
+                    yield True, len(match.group(1)), match.group(2)
+                else:
+                    yield False, 0, line
@@ -0,0 +1,81 @@
+"""
+Word解析：按标题划分章节，段落与表格保持文档中的顺序
+.docx使用python-docx；.doc先用LibreOffice转换为.docx
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+from typing import Iterator
+
+from core.biziness.docs.base import Extractor, Section, UnsupportedDocument, register_extractor, split_by_headings
+
+try:
+    import docx
+    from docx.table import Table
+    from docx.text.paragraph import Paragraph
+except ImportError:
+    docx = None
+
+
+def _heading_level(paragraph) -> int:
+    '''
+    段落的标题级别，非标题返回0
+    :param paragraph:
+    :return:
+    '''
+    name = (paragraph.style.name if paragraph.style is not None else '') or ''
+    if name == 'Title':
+        return 1
+    if name.startswith('Heading') or name.startswith('标题'):
+        digits = ''.join(c for c in name if c.isdigit())
+        return int(digits) if digits else 1
+    return 0
+
+
+def _iter_blocks(document):
+    '''
+    按文档顺序产出(是否标题,标题级别,文本)，表格逐行以制表符拼接
+    :param document: docx.Document
+    :return:
+    '''
+    for child in document.element.body.iterchildren():
+        tag = child.tag.rsplit('}', 1)[-1]
+        if tag == 'p':
+            paragraph = Paragraph(child, document)
+            level = _heading_level(paragraph)
+            yield bool(level), level, paragraph.text
+        elif tag == 'tbl':
+            table = Table(child, document)
+            rows = ['\t'.join(cell.text.strip() for cell in row.cells) for row in table.rows]
+            yield False, 0, '\n'.join(rows)
+
+
+def _convert_doc(path: str, outdir: str) -> str:
+    soffice = shutil.which('soffice') or shutil.which('libreoffice')
+    if soffice is None:
+        raise UnsupportedDocument('解析.doc文件需要安装LibreOffice')
+    subprocess.run([soffice, '--headless', '--convert-to', 'docx', '--outdir', outdir, path],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=300)
+    converted = os.path.join(outdir, os.path.splitext(os.path.basename(path))[0] + '.docx')
+    if not os.path.exists(converted):
+        raise UnsupportedDocument('.doc文件转换失败')
+    return converted
+
+
+@register_extractor
+class WordExtractor(Extractor):
+    extensions = ('.docx', '.doc')
+
+    def iter_sections(self, path: str) -> Iterator[Section]:
+        if docx is None:
+            raise UnsupportedDocument('解析Word需要安装python-docx')
+        if path.lower().endswith('.doc'):
+            with tempfile.TemporaryDirectory() as outdir:
+                yield from self._iter_docx(_convert_doc(path, outdir))
+        else:
+            yield from self._iter_docx(path)
+
+    @staticmethod
+    def _iter_docx(path: str) -> Iterator[Section]:
+        yield from split_by_headings(_iter_blocks(docx.Document(path)))
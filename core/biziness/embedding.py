@@ -0,0 +1,413 @@
+"""
+向量化服务
+并发调用方提交的文本在后台线程中合并为微批(最多max_batch_size条或等待max_wait_ms)，按token长度分桶后逐桶推理，
+每桶只填充到桶内最长文本，避免短文本随长文本一起填充到最大长度；
+推理后端：torch(transformers，可选int8动态量化)或onnx(onnxruntime，可使用量化模型)；
+向量按(模型,文本)的SHA256缓存在SQLite中，并在内存中保留最近使用的向量，重复入库的切片及重复的问题不再计算
+导出ONNX模型：python -m core.biziness.embedding export [--quantize]
+"""
+import argparse
+import hashlib
+import inspect
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import settings
+
+
+class EmbeddingRunner:
+    """推理后端：分词、按长度分桶、前向计算及池化"""
+
+    def __init__(self, model_path: str, config: dict):
+        from transformers import AutoTokenizer
+        self.model_path = model_path
+        self.config = config
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.max_length = config['max_length']
+
+    def _forward(self, encoded: Dict[str, np.ndarray]) -> np.ndarray:
+        '''
+        :param encoded: input_ids/attention_mask等(batch,seq)
+        :return: 最后一层隐状态(batch,seq,hidden)
+        '''
+        raise NotImplementedError
+
+    def _pool(self, hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        if self.config['pooling'] == 'mean':
+            mask = mask[..., None].astype(np.float32)
+            vectors = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        else:
+            #bge使用[CLS]向量
+            vectors = hidden[:, 0]
+        vectors = vectors.astype(np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def buckets(self, texts: List[str]) -> List[List[int]]:
+        '''
+        按token长度排序后切分批次，每批不超过max_batch_size条且填充后的token数不超过max_batch_tokens
+        :param texts:
+        :return: 每批文本的下标
+        '''
+        lengths = [min(len(ids), self.max_length) for ids in
+                   self.tokenizer(texts, add_special_tokens=True, truncation=True, max_length=self.max_length)['input_ids']]
+        order = sorted(range(len(texts)), key=lambda i: lengths[i])
+        batches, current = [], []
+        for i in order:
+            #已按长度升序，加入后的填充长度即当前文本长度
+            if current and (len(current) >= self.config['max_batch_size'] or
+                            (len(current) + 1) * lengths[i] > self.config['max_batch_tokens']):
+                batches.append(current)
+                current = []
+            current.append(i)
+        if current:
+            batches.append(current)
+        return batches
+
+    def encode(self, texts: List[str], bucketed: bool = True) -> np.ndarray:
+        '''
+        计算归一化向量
+        :param texts:
+        :param bucketed: 按长度分桶，False时按原顺序每max_batch_size条一批(基准测试对照)
+        :return: (len(texts),dim)
+        '''
+        result = [None] * len(texts)
+        size = self.config['max_batch_size']
+        batches = self.buckets(texts) if bucketed else \
+            [list(range(start, min(start + size, len(texts)))) for start in range(0, len(texts), size)]
+        for batch in batches:
+            encoded = self.tokenizer([texts[i] for i in batch], padding=True, truncation=True,
+                                     max_length=self.max_length, return_tensors='np')
+            vectors = self._pool(self._forward(dict(encoded)), encoded['attention_mask'])
+            for i, vector in zip(batch, vectors):
+                result[i] = vector
+        return np.stack(result) if result else np.empty((0, 0), dtype=np.float32)
+
+
+class TorchRunner(EmbeddingRunner):
+    def __init__(self, model_path: str, config: dict):
+        super().__init__(model_path, config)
+        import torch
+        from transformers import AutoModel
+        self.torch = torch
+        if config.get('threads'):
+            torch.set_num_threads(config['threads'])
+        model = AutoModel.from_pretrained(model_path).eval()
+        if config['quantize']:
+            #Linear层int8动态量化，CPU推理约快2倍，向量与原模型的余弦相似度通常在0.99以上
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+
+    def _forward(self, encoded):
+        with self.torch.inference_mode():
+            inputs = {name: self.torch.from_numpy(value) for name, value in encoded.items()}
+            return self.model(**inputs).last_hidden_state.float().numpy()
+
+
+class OnnxRunner(EmbeddingRunner):
+    def __init__(self, model_path: str, config: dict):
+        super().__init__(model_path, config)
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if config.get('threads'):
+            options.intra_op_num_threads = config['threads']
+        path = onnx_model_path(model_path, config)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'ONNX模型不存在：{path}，请先执行python -m core.biziness.embedding export')
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.inputs = {item.name for item in self.session.get_inputs()}
+
+    def _forward(self, encoded):
+        feed = {name: value.astype(np.int64) for name, value in encoded.items() if name in self.inputs}
+        return self.session.run(None, feed)[0]
+
+
+def onnx_model_path(model_path: str, config: dict) -> str:
+    if config.get('onnx_path'):
+        return config['onnx_path']
+    return os.path.join(model_path, 'onnx', 'model_quantized.onnx' if config['quantize'] else 'model.onnx')
+
+
+def export_onnx(model_path: str, quantize: bool = False) -> str:
+    '''
+    导出ONNX模型到模型目录的onnx下，quantize时另导出int8动态量化模型
+    :param model_path: 模型目录
+    :param quantize:
+    :return: 导出的模型路径
+    '''
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+    out_dir = os.path.join(model_path, 'onnx')
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, 'model.onnx')
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModel.from_pretrained(model_path).eval()
+    sample = tokenizer(['向量化服务'], return_tensors='pt')
+    #按forward的参数顺序位置传参(分词器的顺序为input_ids,token_type_ids,attention_mask，与BERT的forward不同)
+    params = list(inspect.signature(model.forward).parameters)
+    names = [name for name in params if name in sample]
+    if names != params[:len(names)] or len(names) != len(sample):
+        raise ValueError(f'无法按位置传入分词结果：{list(sample.keys())}，forward参数：{params[:len(sample) + 2]}')
+    axes = {name: {0: 'batch', 1: 'sequence'} for name in names}
+    axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+    with torch.inference_mode():
+        torch.onnx.export(model, tuple(sample[name] for name in names), path, input_names=names,
+                          output_names=['last_hidden_state'], dynamic_axes=axes, opset_version=14)
+    verify_onnx(model_path, path)
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantized = os.path.join(out_dir, 'model_quantized.onnx')
+        quantize_dynamic(path, quantized, weight_type=QuantType.QInt8)
+        return quantized
+    return path
+
+
+def verify_onnx(model_path: str, path: str, threshold: float = 0.99):
+    '''
+    比较ONNX模型与torch模型在样例文本(含填充)上的向量，余弦相似度低于threshold时报错
+    :param model_path: 模型目录
+    :param path: ONNX模型文件
+    :param threshold:
+    :return:
+    '''
+    texts = ['向量化服务', '按token长度分桶后逐桶推理，每桶只填充到桶内最长文本', 'bge-base-zh-v1.5']
+    config = dict(settings.embedding_service, quantize=False, onnx_path=path)
+    expected = TorchRunner(model_path, config).encode(texts)
+    actual = OnnxRunner(model_path, config).encode(texts)
+    similarity = float((expected * actual).sum(axis=1).min())
+    if similarity < threshold:
+        raise RuntimeError(f'导出的ONNX模型与torch模型输出不一致(最低余弦相似度{similarity:.4f})：{path}')
+
+
+class VectorCache:
+    """内容哈希->向量的持久化缓存，前面加一层内存LRU"""
+
+    def __init__(self, path: Optional[str], memory_entries: int):
+        self.path = path
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._conn().execute('CREATE TABLE IF NOT EXISTS vectors(key TEXT PRIMARY KEY, vector BLOB NOT NULL)')
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key: str, vector: np.ndarray):
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        with self._lock:
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vector
+        missing = [key for key in keys if key not in found]
+        if self.path and missing:
+            conn = self._conn()
+            for start in range(0, len(missing), 500):
+                batch = missing[start:start + 500]
+                sql = f'SELECT key,vector FROM vectors WHERE key IN ({",".join("?" * len(batch))})'
+                for key, blob in conn.execute(sql, batch):
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    found[key] = vector
+                    self._remember(key, vector)
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray]):
+        for key, vector in items.items():
+            self._remember(key, vector)
+        if self.path and items:
+            conn = self._conn()
+            conn.execute('BEGIN')
+            conn.executemany('INSERT OR REPLACE INTO vectors(key,vector) VALUES(?,?)',
+                             [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items.items()])
+            conn.execute('COMMIT')
+
+
+class EmbeddingService:
+    def __init__(self, name: str, config: Optional[dict] = None, runner: Optional[EmbeddingRunner] = None):
+        '''
+        :param name: settings.embeddings中的模型配置名
+        :param config: 默认settings.embedding_service
+        :param runner: 推理后端，默认按配置创建
+        '''
+        self.name = name
+        self.config = config or settings.embedding_service
+        self._runner = runner
+        self._runner_lock = threading.Lock()
+        #模型标识参与缓存键，更换模型或量化方式后不会命中旧向量
+        self.model_id = f'{name}:{self.config["backend"]}:{int(self.config["quantize"])}:{self.config["pooling"]}'
+        self.cache = VectorCache(self.config['cache_path'], self.config['memory_cache'])
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = None
+        self.stats = {'requests': 0, 'texts': 0, 'cache_hits': 0, 'computed': 0, 'batches': 0,
+                      'compute_seconds': 0.0}
+
+    @property
+    def runner(self) -> EmbeddingRunner:
+        with self._runner_lock:
+            if self._runner is None:
+                model_path = settings.embeddings[self.name]
+                runner_class = OnnxRunner if self.config['backend'] == 'onnx' else TorchRunner
+                self._runner = runner_class(model_path, self.config)
+        return self._runner
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f'{self.model_id}\0{text}'.encode('utf-8')).hexdigest()
+
+    def _ensure_thread(self):
+        with self._runner_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name=f'embedding-{self.name}', daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        '''
+        后台合批：取到第一个请求后最多等待max_wait_ms，凑满max_batch_size条即开始计算
+        '''
+        max_batch, max_wait = self.config['max_batch_size'], self.config['max_wait_ms'] / 1000
+        while True:
+            requests = [self._queue.get()]
+            size = len(requests[0][0])
+            deadline = time.monotonic() + max_wait
+            while size < max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                requests.append(request)
+                size += len(request[0])
+            self._compute(requests)
+
+    def _compute(self, requests):
+        #同一批中重复的文本只计算一次
+        texts = list(dict.fromkeys(text for texts, _ in requests for text in texts))
+        try:
+            start = time.perf_counter()
+            vectors = self.runner.encode(texts)
+            self.stats['compute_seconds'] += time.perf_counter() - start
+            self.stats['batches'] += 1
+            self.stats['computed'] += len(texts)
+            computed = dict(zip(texts, vectors))
+        except BaseException as e:
+            for _, future in requests:
+                future.set_exception(e)
+            return
+        for texts, future in requests:
+            future.set_result(computed)
+
+    def submit(self, texts: List[str]) -> Future:
+        '''
+        提交文本，返回结果为原顺序的向量矩阵的Future
+        :param texts:
+        :return:
+        '''
+        self.stats['requests'] += 1
+        self.stats['texts'] += len(texts)
+        result: Future = Future()
+        keys = [self._key(text) for text in texts]
+        try:
+            cached = self.cache.get_many(keys)
+        except sqlite3.Error:
+            cached = {}
+        self.stats['cache_hits'] += sum(key in cached for key in keys)
+        missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in cached))
+        if not missing:
+            result.set_result(self._assemble(keys, cached))
+            return result
+        pending: Future = Future()
+
+        def done(future: Future):
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+                return
+            computed = future.result()
+            fresh = {self._key(text): computed[text] for text in missing}
+            try:
+                self.cache.put_many(fresh)
+            except sqlite3.Error:
+                pass
+            result.set_result(self._assemble(keys, dict(cached, **fresh)))
+        pending.add_done_callback(done)
+        self._ensure_thread()
+        self._queue.put((missing, pending))
+        return result
+
+    @staticmethod
+    def _assemble(keys: List[str], vectors: Dict[str, np.ndarray]) -> np.ndarray:
+        return np.stack([vectors[key] for key in keys]) if keys else np.empty((0, 0), dtype=np.float32)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        '''
+        同步计算(在线程中调用，与其他调用方合批)
+        :param texts:
+        :return: (len(texts),dim)归一化向量
+        '''
+        return self.submit(texts).result()
+
+    async def aembed(self, texts: List[str]) -> np.ndarray:
+        import asyncio
+        return await asyncio.wrap_future(self.submit(texts))
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats, compute_seconds=round(self.stats['compute_seconds'], 3), model=self.model_id)
+        stats['texts_per_second'] = round(stats['computed'] / self.stats['compute_seconds'], 1) \
+            if self.stats['compute_seconds'] else None
+        stats['mean_batch'] = round(stats['computed'] / stats['batches'], 1) if stats['batches'] else None
+        return stats
+
+
+_services: Dict[str, EmbeddingService] = {}
+_lock = threading.Lock()
+
+
+def get_embedding_service(name: Optional[str] = None) -> EmbeddingService:
+    '''
+    :param name: settings.embeddings中的模型配置名，默认settings.embedding_service['model']
+    :return:
+    '''
+    name = name or settings.embedding_service['model']
+    with _lock:
+        if name not in _services:
+            _services[name] = EmbeddingService(name)
+        return _services[name]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    export = sub.add_parser('export', help='导出ONNX模型')
+    export.add_argument('--model', default=settings.embedding_service['model'])
+    export.add_argument('--quantize', action='store_true', help='同时导出int8动态量化模型')
+    args = parser.parse_args()
+    print(export_onnx(settings.embeddings[args.model], args.quantize))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+关键词检索的分词
+文本NFKC归一化(全角转半角)并转小写；字母数字串(证券代码、编号、型号、英文名)整体作为一个词，
+含分隔符或字母数字混合时另拆出各部分(不少于两个字符)，如600519.sh→600519.sh/600519/sh，查询600519即可命中；
+中文连续片段：analyzer为jieba时按搜索引擎模式分词，为bigram时切分为相邻两字，单字片段保留单字
+"""
+import re
+import unicodedata
+from typing import List
+
+try:
+    import jieba
+except ImportError:
+    jieba = None
+
+_token = re.compile(r'[0-9a-z]+(?:[._\-/:][0-9a-z]+)*|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+_parts = re.compile(r'[a-z]+|[0-9]+')
+MAX_TERM_LENGTH = 64
+
+
+def resolve_analyzer(name: str) -> str:
+    '''
+    :param name: jieba/bigram/auto(已安装jieba时使用jieba)
+    :return: 实际使用的分词方式
+    '''
+    if name == 'auto':
+        return 'jieba' if jieba is not None else 'bigram'
+    if name == 'jieba' and jieba is None:
+        raise RuntimeError('关键词索引使用jieba分词，请安装jieba或以bigram重建索引')
+    if name not in ('jieba', 'bigram'):
+        raise ValueError(f'不支持的分词方式：{name}')
+    return name
+
+
+def analyze(text: str, analyzer: str = 'bigram') -> List[str]:
+    '''
+    :param text:
+    :param analyzer: jieba/bigram
+    :return: 词(含重复，用于统计词频)
+    '''
+    terms = []
+    for token in _token.findall(unicodedata.normalize('NFKC', text or '').lower()):
+        if token[0] < '\u0080':
+            terms.append(token[:MAX_TERM_LENGTH])
+            parts = _parts.findall(token)
+            if len(parts) > 1:
+                terms.extend(part[:MAX_TERM_LENGTH] for part in parts if len(part) > 1)
+        elif analyzer == 'jieba':
+            terms.extend(word for word in jieba.cut_for_search(token) if word.strip())
+        elif len(token) == 1:
+            terms.append(token)
+        else:
+            terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+    return terms
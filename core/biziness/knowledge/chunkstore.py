@@ -0,0 +1,216 @@
+"""
+切片存储
+切片文本、所属文档及文档标签保存在本地SQLite(WAL模式，多进程可同时读)，切片ID即向量索引及关键词索引中的ID；
+ID自增且不复用，删除后索引中残留的墓碑不会误指向新切片
+"""
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS documents(
+    doc_id TEXT PRIMARY KEY,
+    filename TEXT,
+    tags TEXT NOT NULL DEFAULT '[]',
+    chunks INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS document_tags(
+    tag TEXT NOT NULL,
+    doc_id TEXT NOT NULL,
+    PRIMARY KEY(tag, doc_id)
+);
+CREATE TABLE IF NOT EXISTS chunks(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    doc_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    title TEXT,
+    text TEXT NOT NULL,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_chunks_doc ON chunks(doc_id, position);
+'''
+
+
+def normalize_tags(tags) -> List[str]:
+    return sorted({tag.strip() for tag in tags or [] if tag and tag.strip()})
+
+
+class ChunkStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        '''
+        每个线程一个连接
+        '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def add_chunks(self, doc_id: str, chunks: List[dict]) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        写入文档的新切片，原有切片保留到commit_document，替换过程中新旧切片都可以检索到
+        :param doc_id: 文档ID(文件内容的SHA256)
+        :param chunks: [{'text','title','metadata'}]
+        :return: (新切片ID,原有切片ID)
+        '''
+        with self._conn() as conn:
+            old = [row[0] for row in conn.execute('SELECT id FROM chunks WHERE doc_id=?', (doc_id,))]
+            conn.executemany('INSERT INTO chunks(doc_id,position,title,text,metadata) VALUES(?,?,?,?,?)',
+                             [(doc_id, i, chunk.get('title'), chunk['text'],
+                               json.dumps(chunk.get('metadata') or {}, ensure_ascii=False))
+                              for i, chunk in enumerate(chunks)])
+            #ID自增，新切片的ID均大于原有切片
+            ids = [row[0] for row in conn.execute('SELECT id FROM chunks WHERE doc_id=? AND id>? ORDER BY position',
+                                                  (doc_id, max(old, default=0)))]
+        return np.asarray(ids, dtype=np.int64), np.asarray(old, dtype=np.int64)
+
+    def commit_document(self, doc_id: str, filename: str, tags, ids, old):
+        '''
+        新切片写入索引后登记文档并删除原有切片
+        :param doc_id:
+        :param filename: 文件名
+        :param tags: 标签
+        :param ids: add_chunks返回的新切片ID
+        :param old: add_chunks返回的原有切片ID
+        :return:
+        '''
+        tags = normalize_tags(tags)
+        with self._conn() as conn:
+            self._delete_ids(conn, old)
+            conn.execute('DELETE FROM document_tags WHERE doc_id=?', (doc_id,))
+            conn.execute('DELETE FROM documents WHERE doc_id=?', (doc_id,))
+            conn.execute('INSERT INTO documents(doc_id,filename,tags,chunks,created_at) VALUES(?,?,?,?,?)',
+                         (doc_id, filename, json.dumps(tags, ensure_ascii=False), len(ids), time.time()))
+            conn.executemany('INSERT INTO document_tags(tag,doc_id) VALUES(?,?)', [(tag, doc_id) for tag in tags])
+
+    def delete_chunks(self, ids):
+        '''
+        删除未登记的新切片(写入索引失败时)
+        :param ids:
+        :return:
+        '''
+        with self._conn() as conn:
+            self._delete_ids(conn, ids)
+
+    @staticmethod
+    def _delete_ids(conn, ids):
+        ids = [int(i) for i in ids]
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            conn.execute(f"DELETE FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch)
+
+    @staticmethod
+    def _delete(conn, doc_id: str) -> np.ndarray:
+        ids = [row[0] for row in conn.execute('SELECT id FROM chunks WHERE doc_id=?', (doc_id,))]
+        conn.execute('DELETE FROM chunks WHERE doc_id=?', (doc_id,))
+        conn.execute('DELETE FROM document_tags WHERE doc_id=?', (doc_id,))
+        conn.execute('DELETE FROM documents WHERE doc_id=?', (doc_id,))
+        return np.asarray(ids, dtype=np.int64)
+
+    def delete_document(self, doc_id: str) -> np.ndarray:
+        '''
+        删除文档及其切片
+        :param doc_id:
+        :return: 被删除的切片ID
+        '''
+        with self._conn() as conn:
+            return self._delete(conn, doc_id)
+
+    def set_tags(self, doc_id: str, tags) -> bool:
+        '''
+        :param doc_id:
+        :param tags:
+        :return: 文档不存在返回False
+        '''
+        tags = normalize_tags(tags)
+        with self._conn() as conn:
+            updated = conn.execute('UPDATE documents SET tags=? WHERE doc_id=?',
+                                   (json.dumps(tags, ensure_ascii=False), doc_id)).rowcount
+            if updated:
+                conn.execute('DELETE FROM document_tags WHERE doc_id=?', (doc_id,))
+                conn.executemany('INSERT INTO document_tags(tag,doc_id) VALUES(?,?)', [(tag, doc_id) for tag in tags])
+        return bool(updated)
+
+    def ids_for_tags(self, tags, match_all: bool = False) -> np.ndarray:
+        '''
+        带有指定标签的文档的切片ID
+        :param tags:
+        :param match_all: True时须包含全部标签，否则包含任一标签即可
+        :return: 升序ID
+        '''
+        tags = normalize_tags(tags)
+        if not tags:
+            return np.empty(0, dtype=np.int64)
+        marks = ','.join('?' * len(tags))
+        having = f' GROUP BY doc_id HAVING COUNT(*)={len(tags)}' if match_all else ''
+        sql = (f'SELECT id FROM chunks WHERE doc_id IN (SELECT doc_id FROM document_tags WHERE tag IN ({marks}){having}) '
+               f'ORDER BY id')
+        return np.fromiter((row[0] for row in self._conn().execute(sql, tags)), dtype=np.int64)
+
+    def get_chunks(self, ids) -> Dict[int, dict]:
+        '''
+        :param ids: 切片ID
+        :return: ID->切片，已删除的ID不在结果中
+        '''
+        ids = [int(i) for i in ids]
+        result = {}
+        conn = self._conn()
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            sql = (f'SELECT c.id,c.doc_id,c.position,c.title,c.text,c.metadata,d.filename,d.tags FROM chunks c '
+                   f'JOIN documents d ON d.doc_id=c.doc_id WHERE c.id IN ({",".join("?" * len(batch))})')
+            for row in conn.execute(sql, batch):
+                result[row['id']] = {'id': row['id'], 'doc_id': row['doc_id'], 'position': row['position'],
+                                     'title': row['title'], 'text': row['text'],
+                                     'metadata': json.loads(row['metadata'] or '{}'), 'filename': row['filename'],
+                                     'tags': json.loads(row['tags'])}
+        return result
+
+    def iter_chunks(self, batch_size: int = 10000) -> Iterator[List[dict]]:
+        '''
+        按ID顺序分批读取全部切片(重建索引)
+        :param batch_size:
+        :return: [{'id','title','text'}]
+        '''
+        last = 0
+        while True:
+            rows = self._conn().execute('SELECT id,title,text FROM chunks WHERE id>? ORDER BY id LIMIT ?',
+                                        (last, batch_size)).fetchall()
+            if not rows:
+                return
+            last = rows[-1]['id']
+            yield [dict(row) for row in rows]
+
+    def get_document(self, doc_id: str) -> Optional[dict]:
+        row = self._conn().execute('SELECT * FROM documents WHERE doc_id=?', (doc_id,)).fetchone()
+        return dict(row, tags=json.loads(row['tags'])) if row else None
+
+    def documents(self, limit: int = 100, offset: int = 0, tag: Optional[str] = None) -> List[dict]:
+        if tag:
+            rows = self._conn().execute('SELECT d.* FROM documents d JOIN document_tags t ON t.doc_id=d.doc_id '
+                                        'WHERE t.tag=? ORDER BY d.created_at DESC LIMIT ? OFFSET ?',
+                                        (tag, limit, offset))
+        else:
+            rows = self._conn().execute('SELECT * FROM documents ORDER BY created_at DESC LIMIT ? OFFSET ?',
+                                        (limit, offset))
+        return [dict(row, tags=json.loads(row['tags'])) for row in rows]
+
+    def get_stats(self) -> dict:
+        conn = self._conn()
+        return {'documents': conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0],
+                'chunks': conn.execute('SELECT COUNT(*) FROM chunks').fetchone()[0],
+                'tags': conn.execute('SELECT COUNT(DISTINCT tag) FROM document_tags').fetchone()[0]}
@@ -0,0 +1,259 @@
+"""
+关键词索引(BM25)
+段式存储(见segments)，每个段为倒排表：
+词典为词的64位哈希(升序，不保存词本身)及倒排表偏移量，倒排记录为行号(uint32)及词频(uint8)，每条5字节，
+另保存每行的词数(BM25的文档长度归一化)；检索时按哈希二分查找，只读取查询词的倒排记录
+文档频率及平均长度取所有段之和(含未清除的已删除切片，合并后准确)
+"""
+import hashlib
+import os
+from collections import Counter
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+import settings
+from core.biziness.knowledge.analyzer import analyze, resolve_analyzer
+from core.biziness.knowledge.segments import BaseSegment, SegmentIndex
+
+_FILES = ('ids', 'len', 'terms', 'offsets', 'rows', 'tf')
+
+
+def term_hashes(terms: List[str]) -> np.ndarray:
+    return np.fromiter((int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+                        for term in terms), dtype=np.uint64, count=len(terms))
+
+
+def _load(directory: str, name: str, suffix: str) -> np.ndarray:
+    path = os.path.join(directory, f'{name}.{suffix}.npy')
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        #空数组无法映射
+        return np.load(path)
+
+
+class KeywordSegment(BaseSegment):
+    def __init__(self, directory: str, meta: dict):
+        super().__init__(directory, meta)
+        self.lengths = _load(directory, self.name, 'len')
+        self.terms = _load(directory, self.name, 'terms')
+        self.offsets = _load(directory, self.name, 'offsets')
+        self.rows = _load(directory, self.name, 'rows')
+        self.tf = _load(directory, self.name, 'tf')
+        self.total_length = meta['total_length']
+
+    def lookup(self, hashes: np.ndarray) -> np.ndarray:
+        '''
+        :param hashes: 查询词的哈希
+        :return: 在词典中的位置，不存在为-1
+        '''
+        if not self.terms.size:
+            return np.full(hashes.size, -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.terms, hashes), self.terms.size - 1)
+        return np.where(np.asarray(self.terms[positions]) == hashes, positions, -1)
+
+    def df(self, position: int) -> int:
+        return int(self.offsets[position + 1] - self.offsets[position]) if position >= 0 else 0
+
+    def postings(self, position: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return np.asarray(self.rows[start:end]), np.asarray(self.tf[start:end])
+
+
+class KeywordIndex(SegmentIndex):
+    segment_class = KeywordSegment
+
+    def _manifest_defaults(self) -> dict:
+        return {'analyzer': None}
+
+    @property
+    def analyzer(self) -> str:
+        '''
+        索引建立时记录分词方式，之后以记录的为准，更换分词方式须重建索引
+        '''
+        return resolve_analyzer(self.manifest['analyzer'] or settings.knowledge['analyzer'])
+
+    @staticmethod
+    def _invert(texts: List[str], analyzer: str):
+        '''
+        分词并统计词频
+        :return: (每条倒排记录的词哈希,行号,词频,每行的词数)
+        '''
+        vocabulary, term_ids, rows, tf = {}, [], [], []
+        lengths = np.zeros(len(texts), dtype=np.uint32)
+        for row, text in enumerate(texts):
+            terms = analyze(text, analyzer)
+            lengths[row] = len(terms)
+            counts = Counter(terms)
+            term_ids.extend(vocabulary.setdefault(term, len(vocabulary)) for term in counts)
+            rows.extend([row] * len(counts))
+            tf.extend(counts.values())
+        hashes = term_hashes(list(vocabulary))[np.asarray(term_ids, dtype=np.int64)] if term_ids else \
+            np.empty(0, dtype=np.uint64)
+        return hashes, np.asarray(rows, dtype=np.int64), np.minimum(np.asarray(tf, dtype=np.int64), 255), lengths
+
+    def _write_segment(self, manifest: dict, ids: np.ndarray, data) -> dict:
+        terms, rows, tf, lengths = data
+        name = self._next_name(manifest)
+        order = np.argsort(ids, kind='stable')
+        #行号改为按ID排序后的位置
+        position = np.empty_like(order)
+        position[order] = np.arange(order.size)
+        rows = position[rows]
+        sort = np.lexsort((rows, terms))
+        terms, rows, tf = terms[sort], rows[sort], tf[sort]
+        starts = np.flatnonzero(np.r_[True, terms[1:] != terms[:-1]]) if terms.size else np.empty(0, dtype=np.int64)
+        arrays = {'ids': np.ascontiguousarray(ids[order], dtype=np.int64),
+                  'len': np.ascontiguousarray(lengths[order], dtype=np.uint32),
+                  'terms': terms[starts].astype(np.uint64),
+                  'offsets': np.r_[starts, terms.size].astype(np.int64),
+                  'rows': rows.astype(np.uint32), 'tf': tf.astype(np.uint8)}
+        for suffix, array in arrays.items():
+            np.save(os.path.join(self.directory, f'{name}.{suffix}.npy'), array)
+        return {'name': name, 'count': int(ids.size), 'terms': int(starts.size), 'postings': int(rows.size),
+                'total_length': int(lengths.sum())}
+
+    def _segment_files(self, meta: dict) -> List[str]:
+        return [f'{meta["name"]}.{suffix}.npy' for suffix in _FILES]
+
+    def _is_small(self, segment: KeywordSegment) -> bool:
+        return segment.count < settings.knowledge['keyword_merge_docs']
+
+    def _merge_data(self, segments: List[KeywordSegment]):
+        ids, terms, rows, tf, lengths = [], [], [], [], []
+        base = 0
+        for s in segments:
+            keep = s.alive_rows()
+            new_rows = np.full(s.count, -1, dtype=np.int64)
+            new_rows[keep] = base + np.arange(keep.size)
+            segment_terms = np.repeat(np.asarray(s.terms), np.diff(np.asarray(s.offsets)))
+            segment_rows, segment_tf = np.asarray(s.rows).astype(np.int64), np.asarray(s.tf)
+            if s.alive is not None:
+                alive = s.alive[segment_rows]
+                segment_terms, segment_rows, segment_tf = segment_terms[alive], segment_rows[alive], segment_tf[alive]
+            terms.append(segment_terms)
+            rows.append(new_rows[segment_rows])
+            tf.append(segment_tf)
+            ids.append(np.asarray(s.ids)[keep])
+            lengths.append(np.asarray(s.lengths)[keep])
+            base += keep.size
+        return np.concatenate(ids), (np.concatenate(terms), np.concatenate(rows), np.concatenate(tf),
+                                     np.concatenate(lengths))
+
+    def add(self, ids, texts: List[str]):
+        '''
+        写入切片文本
+        :param ids: int64 ID，由调用方分配且不重复
+        :param texts: 与ids逐条对应
+        :return:
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(texts) != ids.size:
+            raise ValueError(f'ID数({ids.size})与文本数({len(texts)})不一致')
+        if not ids.size:
+            return
+        self.reload()
+        analyzer = self.analyzer
+        #分词不占用写锁
+        data = self._invert(texts, analyzer)
+        with self._write_lock():
+            manifest = self._copy_manifest()
+            if manifest['analyzer'] is None:
+                manifest['analyzer'] = analyzer
+            elif manifest['analyzer'] != analyzer:
+                data = self._invert(texts, manifest['analyzer'])
+            self._append_segment(manifest, ids, data)
+
+    def clear(self):
+        '''
+        删除全部段(重建索引前调用)，分词方式重新按配置确定
+        :return:
+        '''
+        with self._write_lock():
+            manifest = self._copy_manifest()
+            obsolete = [f for meta in manifest['segments'] for f in self._segment_files(meta)]
+            if manifest['deleted']:
+                obsolete.append(manifest['deleted'])
+            manifest.update(segments=[], deleted=None, analyzer=None)
+            self._commit(manifest, obsolete)
+
+    def search(self, query: str, k: int = 10, allowed=None,
+               max_postings: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        BM25检索
+        :param query: 查询文本
+        :param k: 返回条数
+        :param allowed: 只在这些ID中检索，为None不限制
+        :param max_postings: 最多读取的倒排记录数(延迟预算)，超出时从最常见的词开始跳过，至少保留最罕见的词
+        :return: (得分降序,ID)
+        '''
+        self.reload()
+        segments = self.segments
+        allowed = self._check_allowed(allowed)
+        empty = np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        terms = list(dict.fromkeys(analyze(query, self.analyzer)))
+        if not segments or not terms or (allowed is not None and not allowed.size):
+            return empty
+        hashes = term_hashes(terms)
+        positions = [segment.lookup(hashes) for segment in segments]
+        df = np.array([sum(segment.df(int(pos[i])) for segment, pos in zip(segments, positions))
+                       for i in range(len(terms))], dtype=np.int64)
+        count = sum(segment.count for segment in segments)
+        docs = max(count - int(self.deleted.size), 1)
+        avgdl = max(sum(segment.total_length for segment in segments) / max(count, 1), 1.0)
+        idf = np.log(1 + (docs - df + 0.5) / (df + 0.5))
+        max_postings = max_postings or settings.knowledge['keyword_max_postings']
+        selected, budget = [], 0
+        for i in np.argsort(df, kind='stable'):
+            if not df[i]:
+                continue
+            if selected and budget + df[i] > max_postings:
+                break
+            selected.append(i)
+            budget += df[i]
+        if not selected:
+            return empty
+        k1, b = settings.knowledge['bm25_k1'], settings.knowledge['bm25_b']
+        best_scores, best_ids = [], []
+        for segment, pos in zip(segments, positions):
+            rows, weights = [], []
+            for i in selected:
+                if pos[i] < 0:
+                    continue
+                term_rows, tf = segment.postings(int(pos[i]))
+                tf = tf.astype(np.float32)
+                norm = k1 * (1 - b + b * np.asarray(segment.lengths[term_rows], dtype=np.float32) / avgdl)
+                rows.append(term_rows)
+                weights.append(idf[i] * tf * (k1 + 1) / (tf + norm))
+            if not rows:
+                continue
+            scores = np.bincount(np.concatenate(rows), weights=np.concatenate(weights), minlength=segment.count)
+            candidates = np.flatnonzero(scores)
+            if segment.alive is not None:
+                candidates = candidates[segment.alive[candidates]]
+            candidate_ids = np.asarray(segment.ids)[candidates]
+            if allowed is not None:
+                found = np.minimum(np.searchsorted(allowed, candidate_ids), allowed.size - 1)
+                keep = allowed[found] == candidate_ids
+                candidates, candidate_ids = candidates[keep], candidate_ids[keep]
+            scores = scores[candidates]
+            if scores.size > k:
+                top = np.argpartition(-scores, k)[:k]
+                scores, candidate_ids = scores[top], candidate_ids[top]
+            best_scores.append(scores)
+            best_ids.append(candidate_ids)
+        if not best_scores:
+            return empty
+        scores, ids = np.concatenate(best_scores).astype(np.float32), np.concatenate(best_ids)
+        order = np.argsort(-scores, kind='stable')[:k]
+        return scores[order], ids[order]
+
+    def get_stats(self) -> dict:
+        stats = super().get_stats()
+        size = sum(os.path.getsize(os.path.join(self.directory, f)) for meta in self.manifest['segments']
+                   for f in self._segment_files(meta))
+        return dict(stats, analyzer=self.manifest['analyzer'],
+                    terms=sum(meta['terms'] for meta in self.manifest['segments']),
+                    postings=sum(meta['postings'] for meta in self.manifest['segments']),
+                    size_mb=round(size / 1024 / 1024, 1))
@@ -0,0 +1,120 @@
+"""
+知识库查询：关键词(BM25)与向量检索并行执行，按倒数排名融合(RRF)
+向量检索可补充同义表述，关键词检索保证代码、股票代码、人名等精确匹配不被遗漏；
+延迟预算：查询向量化超过embed_budget_ms、或某一路超过总预算budget_ms未返回时，该路不参与融合，
+结果中degraded标明缺失的一路及原因，timings为各阶段耗时
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import settings
+from core.biziness.embedding import get_embedding_service
+from core.biziness.knowledge.store import KnowledgeBase, get_knowledge_base
+from utils.asyncutils import run_blocking
+
+logger = logging.getLogger(__name__)
+
+MODES = ('hybrid', 'keyword', 'vector')
+
+
+def reciprocal_rank_fusion(rankings: Dict[str, Sequence[int]], rrf_k: int = 60,
+                           weights: Optional[Dict[str, float]] = None) -> List[Tuple[int, float, Dict[str, int]]]:
+    '''
+    倒数排名融合，只使用名次，不依赖各路得分的量纲
+    :param rankings: 检索方式->按得分降序的ID
+    :param rrf_k: 平滑常数，越大名次靠后的结果权重衰减越慢
+    :param weights: 检索方式->权重，默认1
+    :return: [(ID,融合得分,检索方式->名次)]，按融合得分降序
+    '''
+    fused = {}
+    for name, ids in rankings.items():
+        weight = (weights or {}).get(name, 1.0)
+        for rank, doc in enumerate(ids, 1):
+            entry = fused.setdefault(int(doc), [0.0, {}])
+            entry[0] += weight / (rrf_k + rank)
+            entry[1][name] = rank
+    return sorted(((doc, score, ranks) for doc, (score, ranks) in fused.items()), key=lambda item: -item[1])
+
+
+def _elapsed_ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+async def _keyword(kb: KnowledgeBase, query: str, candidates: int, allowed, timings: dict):
+    start = time.perf_counter()
+    result = await run_blocking(kb.keywords.search, query, candidates, allowed)
+    timings['keyword_ms'] = _elapsed_ms(start)
+    return result
+
+
+async def _vector(kb: KnowledgeBase, query: str, vector, candidates: int, allowed, timings: dict):
+    if vector is None:
+        start = time.perf_counter()
+        #超时后向量化仍在后台完成并写入缓存，相同问题再次查询时直接命中
+        vectors = await asyncio.wait_for(asyncio.shield(get_embedding_service().aembed([query])),
+                                         settings.retrieval['embed_budget_ms'] / 1000)
+        vector = vectors[0]
+        timings['embed_ms'] = _elapsed_ms(start)
+    start = time.perf_counter()
+    result = await run_blocking(kb.index.search, vector, candidates, allowed)
+    timings['vector_ms'] = _elapsed_ms(start)
+    return result
+
+
+async def hybrid_search(query: str, k: int = 10, tags=None, match_all: bool = False, mode: Optional[str] = None,
+                        vector: Optional[np.ndarray] = None, kb: Optional[KnowledgeBase] = None) -> dict:
+    '''
+    知识库查询
+    :param query: 查询文本
+    :param k: 返回条数
+    :param tags: 只检索带有这些标签的文档
+    :param match_all: True时须包含全部标签
+    :param mode: hybrid/keyword/vector，默认settings.retrieval['mode']
+    :param vector: 已计算的查询向量，为空时调用向量化服务
+    :param kb: 默认get_knowledge_base()
+    :return: {'mode','results','timings','degraded'}
+    '''
+    config = settings.retrieval
+    mode = mode or config['mode']
+    if mode not in MODES:
+        raise ValueError(f'不支持的检索方式：{mode}')
+    kb = kb or get_knowledge_base()
+    start = time.perf_counter()
+    timings = {}
+    allowed = await run_blocking(kb.allowed_ids, tags, match_all) if tags else None
+    candidates = max(k, config['candidates'])
+    tasks = {}
+    if mode in ('hybrid', 'keyword'):
+        tasks['keyword'] = asyncio.ensure_future(_keyword(kb, query, candidates, allowed, timings))
+    if mode in ('hybrid', 'vector'):
+        tasks['vector'] = asyncio.ensure_future(_vector(kb, query, vector, candidates, allowed, timings))
+    remaining = config['budget_ms'] / 1000 - (time.perf_counter() - start)
+    done, _ = await asyncio.wait(tasks.values(), timeout=max(remaining, 0))
+    rankings, scores, degraded = {}, {}, {}
+    for name, task in tasks.items():
+        if task not in done:
+            task.cancel()
+            degraded[name] = 'timeout'
+            continue
+        error = task.exception()
+        if error is not None:
+            degraded[name] = 'timeout' if isinstance(error, asyncio.TimeoutError) else 'error'
+            if degraded[name] == 'error':
+                logger.warning('知识库%s检索失败：%s', name, error)
+            continue
+        values, ids = task.result()
+        rankings[name] = ids.tolist()
+        scores[name] = dict(zip(rankings[name], values.tolist()))
+    fusion_start = time.perf_counter()
+    fused = reciprocal_rank_fusion(rankings, config['rrf_k'], config['weights'])[:k]
+    chunks = await run_blocking(kb.chunks.get_chunks, [doc for doc, _, _ in fused])
+    results = [dict(chunks[doc], score=round(score, 6), ranks=ranks,
+                    scores={name: round(scores[name][doc], 4) for name in ranks})
+               for doc, score, ranks in fused if doc in chunks]
+    timings['fusion_ms'] = _elapsed_ms(fusion_start)
+    timings['total_ms'] = _elapsed_ms(start)
+    return {'mode': mode, 'results': results, 'timings': timings, 'degraded': degraded}
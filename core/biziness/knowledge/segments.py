@@ -0,0 +1,241 @@
+"""
+段式索引的公共部分(向量索引及关键词索引)
+索引由磁盘上不可变的段组成，每个段有升序的ID数组，文件以np.load(mmap_mode='r')映射加载，启动时不读入内存
+写入：每次add写一个新段，段数超过max_segments时合并小段；删除只记录在墓碑中，检索时过滤，合并时清除
+清单文件manifest.json记录当前的段及墓碑，写入时原子替换，其他进程检索前发现清单变化即重新加载
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import List, Tuple
+
+import numpy as np
+
+import settings
+
+try:
+    import fcntl
+except ImportError:  #Windows只支持单个写入进程
+    fcntl = None
+
+
+class BaseSegment:
+    def __init__(self, directory: str, meta: dict):
+        self.name = meta['name']
+        self.count = meta['count']
+        self.ids = np.load(os.path.join(directory, f'{self.name}.ids.npy'), mmap_mode='r')
+        self.alive = None  #未删除的行，无删除时为None
+
+    def set_deleted(self, deleted: np.ndarray):
+        if deleted.size and self.count:
+            alive = ~np.isin(self.ids, deleted)
+            self.alive = None if alive.all() else alive
+        else:
+            self.alive = None
+
+    def rows_of(self, ids: np.ndarray) -> np.ndarray:
+        '''
+        ID在本段中的行号，不在本段的ID忽略
+        '''
+        if not self.count or not ids.size:
+            return np.empty(0, dtype=np.int64)
+        ids = ids[(ids >= self.ids[0]) & (ids <= self.ids[-1])]
+        rows = np.searchsorted(self.ids, ids)
+        return rows[np.asarray(self.ids)[rows] == ids]
+
+    def alive_rows(self) -> np.ndarray:
+        return np.arange(self.count) if self.alive is None else np.flatnonzero(self.alive)
+
+
+class SegmentIndex:
+    segment_class = BaseSegment
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._manifest_path = os.path.join(directory, 'manifest.json')
+        self._lock = threading.RLock()
+        self._loaded = None  #已加载清单的(inode,修改时间,大小)，清单原子替换后inode改变
+        self.manifest = dict({'version': 0, 'segments': [], 'deleted': None, 'seq': 0}, **self._manifest_defaults())
+        self.segments: List[BaseSegment] = []
+        self.deleted = np.empty(0, dtype=np.int64)
+        self.reload()
+
+    def _manifest_defaults(self) -> dict:
+        '''
+        子类清单中的其他字段
+        '''
+        return {}
+
+    def _write_segment(self, manifest: dict, ids: np.ndarray, data) -> dict:
+        '''
+        写入一个段
+        :param manifest: 待提交的清单
+        :param ids: 段中的ID(未排序)
+        :param data: 与ids对应的数据
+        :return: 段信息
+        '''
+        raise NotImplementedError
+
+    def _merge_data(self, segments: List[BaseSegment]) -> Tuple[np.ndarray, object]:
+        '''
+        合并段中未删除的数据
+        :return: (ID,数据)，格式与_write_segment的参数相同
+        '''
+        raise NotImplementedError
+
+    def _segment_files(self, meta: dict) -> List[str]:
+        return [f'{meta["name"]}.ids.npy']
+
+    def _is_small(self, segment: BaseSegment) -> bool:
+        '''
+        段数过多时只合并小段
+        '''
+        raise NotImplementedError
+
+    @contextmanager
+    def _write_lock(self):
+        '''
+        写入时进程内及进程间互斥，并以磁盘上的最新清单为准
+        '''
+        with self._lock:
+            if fcntl is None:
+                self.reload()
+                yield
+                return
+            with open(os.path.join(self.directory, 'index.lock'), 'w') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    self.reload()
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def reload(self, force: bool = False):
+        '''
+        清单有变化时重新加载
+        :param force:
+        :return:
+        '''
+        try:
+            stat = os.stat(self._manifest_path)
+        except FileNotFoundError:
+            return
+        state = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if state == self._loaded and not force:
+            return
+        with self._lock:
+            with open(self._manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+            previous = {segment.name: segment for segment in self.segments}
+            segments = [previous.get(meta['name']) or self.segment_class(self.directory, meta)
+                        for meta in manifest['segments']]
+            deleted = np.load(os.path.join(self.directory, manifest['deleted'])) if manifest['deleted'] else \
+                np.empty(0, dtype=np.int64)
+            for segment in segments:
+                segment.set_deleted(deleted)
+            self.manifest, self.segments, self.deleted, self._loaded = manifest, segments, deleted, state
+
+    def _copy_manifest(self) -> dict:
+        return json.loads(json.dumps(self.manifest))
+
+    def _commit(self, manifest: dict, obsolete: List[str] = ()):
+        manifest['version'] += 1
+        tmp_path = self._manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self._manifest_path)
+        self.reload(force=True)
+        for name in obsolete:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                #Windows下其他进程仍在映射的文件无法删除，下次合并时再清理
+                pass
+
+    def _next_name(self, manifest: dict) -> str:
+        manifest['seq'] += 1
+        return f'seg-{manifest["seq"]:06d}'
+
+    def _append_segment(self, manifest: dict, ids: np.ndarray, data):
+        '''
+        写入新段并提交，段数过多时合并小段(须持有写锁)
+        '''
+        manifest['segments'].append(self._write_segment(manifest, ids, data))
+        self._commit(manifest)
+        if len(manifest['segments']) > settings.knowledge['max_segments']:
+            self._compact(small_only=True)
+
+    def delete(self, ids):
+        '''
+        删除(写入墓碑，合并段时清除)
+        :param ids:
+        :return:
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        if not ids.size:
+            return
+        with self._write_lock():
+            manifest = self._copy_manifest()
+            deleted = np.union1d(self.deleted, ids)
+            name = f'deleted-{manifest["version"] + 1:08d}.npy'
+            np.save(os.path.join(self.directory, name), deleted)
+            obsolete = [manifest['deleted']] if manifest['deleted'] else []
+            manifest['deleted'] = name
+            self._commit(manifest, obsolete)
+            total = sum(meta['count'] for meta in manifest['segments'])
+            if total and deleted.size / total > settings.knowledge['compact_deleted_ratio']:
+                self._compact(small_only=False)
+
+    def compact(self):
+        '''
+        合并全部段并清除已删除的数据
+        :return:
+        '''
+        with self._write_lock():
+            self._compact(small_only=False)
+
+    def _compact(self, small_only: bool):
+        manifest = self._copy_manifest()
+        selected = [s for s in self.segments if not small_only or self._is_small(s)]
+        if len(selected) < 2 and not (selected and selected[0].alive is not None):
+            return
+        ids, data = self._merge_data(selected)
+        names = {s.name for s in selected}
+        kept = [meta for meta in manifest['segments'] if meta['name'] not in names]
+        obsolete = [f for meta in manifest['segments'] if meta['name'] in names for f in self._segment_files(meta)]
+        if ids.size:
+            kept.append(self._write_segment(manifest, ids, data))
+        manifest['segments'] = kept
+        #只保留未合并段中的墓碑
+        live = [s for s in self.segments if s.name not in names]
+        remaining = np.empty(0, dtype=np.int64)
+        if live and self.deleted.size:
+            remaining = self.deleted[np.isin(self.deleted, np.concatenate([np.asarray(s.ids) for s in live]))]
+        if remaining.size != self.deleted.size:
+            if manifest['deleted']:
+                obsolete.append(manifest['deleted'])
+            manifest['deleted'] = None
+            if remaining.size:
+                manifest['deleted'] = f'deleted-{manifest["version"] + 1:08d}.npy'
+                np.save(os.path.join(self.directory, manifest['deleted']), remaining)
+        self._commit(manifest, obsolete)
+
+    @staticmethod
+    def _check_allowed(allowed):
+        '''
+        检索时的ID过滤条件，转为升序无重复的数组
+        '''
+        if allowed is None:
+            return None
+        allowed = np.asarray(allowed, dtype=np.int64)
+        #切片存储返回的ID已升序，无需再排序去重
+        if allowed.size > 1 and not (allowed[1:] > allowed[:-1]).all():
+            allowed = np.unique(allowed)
+        return allowed
+
+    def get_stats(self) -> dict:
+        self.reload()
+        return {'version': self.manifest['version'], 'segments': len(self.segments),
+                'count': sum(s.count for s in self.segments), 'deleted': int(self.deleted.size)}
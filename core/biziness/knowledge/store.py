@@ -0,0 +1,149 @@
+"""
+知识库：切片存储+向量索引+关键词索引
+按文档整体写入、替换及删除，两个索引同步增量更新，检索时可按标签过滤
+重建关键词索引(更换分词方式或升级前已入库的数据)：python -m core.biziness.knowledge.store rebuild-keywords
+"""
+import argparse
+import json
+import os
+import threading
+from typing import List, Optional
+
+import numpy as np
+
+import settings
+from core.biziness.knowledge.chunkstore import ChunkStore
+from core.biziness.knowledge.keywordindex import KeywordIndex
+from core.biziness.knowledge.vectorindex import VectorIndex
+
+
+def index_text(chunk: dict) -> str:
+    '''
+    切片参与关键词检索的文本(标题+正文)
+    '''
+    return f"{chunk['title']}\n{chunk['text']}" if chunk.get('title') else chunk['text']
+
+
+class KnowledgeBase:
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.chunks = ChunkStore(os.path.join(directory, 'chunks.sqlite'))
+        self.index = VectorIndex(os.path.join(directory, 'vectors'))
+        self.keywords = KeywordIndex(os.path.join(directory, 'keywords'))
+
+    def add_document(self, doc_id: str, filename: str, chunks: List[dict], vectors, tags=None) -> int:
+        '''
+        写入文档，已存在时替换
+        :param doc_id: 文档ID
+        :param filename: 文件名
+        :param chunks: 切片，与vectors逐行对应
+        :param vectors: (切片数,dim)
+        :param tags: 标签
+        :return: 切片数
+        '''
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(chunks) != len(vectors):
+            raise ValueError(f'切片数({len(chunks)})与向量数({len(vectors)})不一致')
+        ids, old = self.chunks.add_chunks(doc_id, chunks)
+        #先写入新切片及两个索引，都成功后再登记文档并删除旧切片：替换过程中旧切片仍可检索，
+        #失败时只撤销新切片，原文档保持不变
+        written = []
+        try:
+            self.index.add(ids, vectors)
+            written.append(self.index)
+            self.keywords.add(ids, [index_text(chunk) for chunk in chunks])
+            written.append(self.keywords)
+            self.chunks.commit_document(doc_id, filename, tags, ids, old)
+        except Exception:
+            for index in written:
+                index.delete(ids)
+            self.chunks.delete_chunks(ids)
+            raise
+        self.index.delete(old)
+        self.keywords.delete(old)
+        return len(ids)
+
+    def delete_document(self, doc_id: str) -> int:
+        ids = self.chunks.delete_document(doc_id)
+        self.index.delete(ids)
+        self.keywords.delete(ids)
+        return len(ids)
+
+    def set_tags(self, doc_id: str, tags) -> bool:
+        return self.chunks.set_tags(doc_id, tags)
+
+    def has_document(self, doc_id: str) -> bool:
+        return self.chunks.get_document(doc_id) is not None
+
+    def allowed_ids(self, tags=None, match_all: bool = False) -> Optional[np.ndarray]:
+        '''
+        按标签过滤的切片ID，不过滤返回None
+        '''
+        return self.chunks.ids_for_tags(tags, match_all) if tags else None
+
+    def _resolve(self, scores, ids) -> List[dict]:
+        chunks = self.chunks.get_chunks(ids)
+        return [dict(chunks[int(i)], score=float(score)) for score, i in zip(scores, ids) if int(i) in chunks]
+
+    def search(self, vector, k: int = 10, tags=None, match_all: bool = False) -> List[dict]:
+        '''
+        向量检索
+        :param vector: 查询向量
+        :param k: 返回条数
+        :param tags: 只检索带有这些标签的文档
+        :param match_all: True时须包含全部标签
+        :return: 切片(含score)，按相似度降序
+        '''
+        return self._resolve(*self.index.search(vector, k, self.allowed_ids(tags, match_all)))
+
+    def keyword_search(self, query: str, k: int = 10, tags=None, match_all: bool = False) -> List[dict]:
+        '''
+        关键词(BM25)检索，参数同search
+        '''
+        return self._resolve(*self.keywords.search(query, k, self.allowed_ids(tags, match_all)))
+
+    def rebuild_keywords(self, batch_size: int = 50000) -> int:
+        '''
+        按切片存储重建关键词索引，重建期间关键词检索结果不完整
+        :param batch_size: 每个段的切片数
+        :return: 切片数
+        '''
+        self.keywords.clear()
+        total = 0
+        for batch in self.chunks.iter_chunks(batch_size):
+            self.keywords.add([chunk['id'] for chunk in batch], [index_text(chunk) for chunk in batch])
+            total += len(batch)
+        self.keywords.compact()
+        return total
+
+    def get_stats(self) -> dict:
+        return dict(self.chunks.get_stats(), index=self.index.get_stats(), keywords=self.keywords.get_stats())
+
+
+_kb: Optional[KnowledgeBase] = None
+_lock = threading.Lock()
+
+
+def get_knowledge_base() -> KnowledgeBase:
+    global _kb
+    with _lock:
+        if _kb is None:
+            _kb = KnowledgeBase(settings.knowledge['dir'])
+    return _kb
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['rebuild-keywords', 'compact', 'stats'])
+    args = parser.parse_args()
+    kb = get_knowledge_base()
+    if args.command == 'rebuild-keywords':
+        print(f'已重建{kb.rebuild_keywords()}条切片的关键词索引')
+    elif args.command == 'compact':
+        kb.index.compact()
+        kb.keywords.compact()
+    print(json.dumps(kb.get_stats(), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+向量索引
+段式存储(见segments)，每个段为向量矩阵(float32，已归一化，按内积即余弦相似度检索)及对应的ID数组(升序)；
+向量数达到ann_min_vectors的段另建FAISS HNSW索引，未安装faiss或小段时分块精确检索
+"""
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+import settings
+from core.biziness.knowledge.segments import BaseSegment, SegmentIndex
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+class Segment(BaseSegment):
+    def __init__(self, directory: str, meta: dict):
+        super().__init__(directory, meta)
+        self.vectors = np.load(os.path.join(directory, f'{self.name}.vec.npy'), mmap_mode='r')
+        self.ann = None
+        if meta.get('ann') and faiss is not None:
+            path = os.path.join(directory, f'{self.name}.hnsw')
+            try:
+                self.ann = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError:
+                self.ann = faiss.read_index(path)
+            self.ann.hnsw.efSearch = settings.knowledge['ef_search']
+
+    def _exact(self, query: np.ndarray, k: int, rows: Optional[np.ndarray] = None,
+               mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        分块精确检索
+        :param rows: 只计算这些行
+        :param mask: 全段计算后只保留为True的行
+        '''
+        block = settings.knowledge['exact_block_rows']
+        valid = self.alive if mask is None else (mask if self.alive is None else mask & self.alive)
+        best_scores, best_rows = np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        total = self.count if rows is None else rows.size
+        for start in range(0, total, block):
+            if rows is None:
+                block_rows = np.arange(start, min(start + block, total))
+                scores = np.asarray(self.vectors[start:start + block]) @ query
+            else:
+                block_rows = rows[start:start + block]
+                scores = np.asarray(self.vectors[block_rows]) @ query
+            if valid is not None:
+                scores = np.where(valid[block_rows], scores, -np.inf)
+            if scores.size > k:
+                top = np.argpartition(-scores, k)[:k]
+                scores, block_rows = scores[top], block_rows[top]
+            best_scores = np.concatenate([best_scores, scores.astype(np.float32)])
+            best_rows = np.concatenate([best_rows, block_rows])
+            if best_scores.size > k:
+                top = np.argpartition(-best_scores, k)[:k]
+                best_scores, best_rows = best_scores[top], best_rows[top]
+        keep = np.isfinite(best_scores)
+        return best_scores[keep], np.asarray(self.ids)[best_rows[keep]]
+
+    def search(self, query: np.ndarray, k: int, allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        :param query: 归一化的查询向量
+        :param k: 返回条数
+        :param allowed: 只在这些ID中检索(升序)，为None不限制
+        :return: (相似度,ID)
+        '''
+        if allowed is not None:
+            rows = self.rows_of(allowed)
+            if rows.size <= settings.knowledge['exact_filter_threshold'] or self.ann is None:
+                if rows.size * 4 < self.count:
+                    return self._exact(query, k, rows=rows)
+                #过滤后仍占段的多数时，全段连续计算比按行取向量快
+                mask = np.zeros(self.count, dtype=bool)
+                mask[rows] = True
+                return self._exact(query, k, mask=mask)
+        if self.ann is None:
+            return self._exact(query, k)
+        #删除或过滤掉的结果在HNSW返回后剔除，按比例多取
+        fetch = min(self.count, k * settings.knowledge['overfetch'])
+        scores, rows = self.ann.search(query.reshape(1, -1), fetch)
+        scores, rows = scores[0], rows[0]
+        keep = rows >= 0
+        if self.alive is not None:
+            keep &= self.alive[np.where(keep, rows, 0)]
+        scores, rows = scores[keep], rows[keep]
+        ids = np.asarray(self.ids)[rows]
+        if allowed is not None:
+            mask = np.isin(ids, allowed)
+            scores, ids = scores[mask], ids[mask]
+        return scores[:k], ids[:k]
+
+
+class VectorIndex(SegmentIndex):
+    segment_class = Segment
+
+    def _manifest_defaults(self) -> dict:
+        return {'dim': None}
+
+    def _write_segment(self, manifest: dict, ids: np.ndarray, vectors: np.ndarray) -> dict:
+        name = self._next_name(manifest)
+        order = np.argsort(ids)
+        np.save(os.path.join(self.directory, f'{name}.vec.npy'), np.ascontiguousarray(vectors[order], dtype=np.float32))
+        np.save(os.path.join(self.directory, f'{name}.ids.npy'), np.ascontiguousarray(ids[order], dtype=np.int64))
+        meta = {'name': name, 'count': int(ids.size), 'ann': False,
+                'min_id': int(ids.min()) if ids.size else 0, 'max_id': int(ids.max()) if ids.size else 0}
+        if faiss is not None and ids.size >= settings.knowledge['ann_min_vectors']:
+            config = settings.knowledge
+            ann = faiss.IndexHNSWFlat(vectors.shape[1], config['hnsw_m'], faiss.METRIC_INNER_PRODUCT)
+            ann.hnsw.efConstruction = config['ef_construction']
+            ann.add(np.ascontiguousarray(vectors[order], dtype=np.float32))
+            faiss.write_index(ann, os.path.join(self.directory, f'{name}.hnsw'))
+            meta['ann'] = True
+        return meta
+
+    def _segment_files(self, meta: dict) -> List[str]:
+        names = [f'{meta["name"]}.vec.npy', f'{meta["name"]}.ids.npy']
+        return names + [f'{meta["name"]}.hnsw'] if meta.get('ann') else names
+
+    def _is_small(self, segment: Segment) -> bool:
+        return segment.count < settings.knowledge['ann_min_vectors']
+
+    def _merge_data(self, segments: List[Segment]):
+        ids = np.concatenate([np.asarray(s.ids) if s.alive is None else np.asarray(s.ids)[s.alive] for s in segments])
+        vectors = np.concatenate([np.asarray(s.vectors) if s.alive is None else np.asarray(s.vectors)[s.alive]
+                                  for s in segments]) if ids.size else \
+            np.empty((0, self.manifest['dim']), np.float32)
+        return ids, vectors
+
+    @staticmethod
+    def normalize(vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def add(self, ids, vectors):
+        '''
+        写入向量
+        :param ids: int64 ID，由调用方分配且不重复
+        :param vectors: (n,dim)
+        :return:
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = self.normalize(vectors)
+        if not ids.size:
+            return
+        with self._write_lock():
+            manifest = self._copy_manifest()
+            if manifest['dim'] is None:
+                manifest['dim'] = int(vectors.shape[1])
+            elif manifest['dim'] != vectors.shape[1]:
+                raise ValueError(f'向量维度不一致：索引为{manifest["dim"]}，写入为{vectors.shape[1]}')
+            self._append_segment(manifest, ids, vectors)
+
+    def search(self, query, k: int = 10, allowed=None) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        检索最相似的k个向量
+        :param query: 查询向量(dim,)
+        :param k: 返回条数
+        :param allowed: 只在这些ID中检索，为None不限制
+        :return: (相似度降序,ID)
+        '''
+        self.reload()
+        segments = self.segments
+        allowed = self._check_allowed(allowed)
+        if not segments or (allowed is not None and not allowed.size):
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        query = self.normalize(query).reshape(-1)
+        results = [segment.search(query, k, allowed) for segment in segments]
+        scores = np.concatenate([r[0] for r in results])
+        ids = np.concatenate([r[1] for r in results])
+        order = np.argsort(-scores)[:k]
+        return scores[order], ids[order]
+
+    def get_stats(self) -> dict:
+        stats = super().get_stats()
+        return {'version': stats['version'], 'dim': self.manifest['dim'], 'segments': stats['segments'],
+                'vectors': stats['count'], 'deleted': stats['deleted'],
+                'ann_segments': sum(s.ann is not None for s in self.segments),
+                'ann_backend': 'faiss-hnsw' if faiss is not None else 'exact'}
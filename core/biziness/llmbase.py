@@ -1,7 +1,335 @@
+"""
+LLM网关
+所有模型共享同一组HTTP连接池(keep-alive)，按settings.llm中的配置路由到各自的服务地址，
+每个模型独立限制并发数、令牌桶限速，429/5xx及连接错误按指数退避+随机抖动重试
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+import httpx
 from langchain_openai import ChatOpenAI
+
 import settings
-def getllm():
-    model=settings.llm.get('qwen').get('model')
-    temperature=settings.llm.get('qwen').get('temperature').get('text-to-sql')
-    llm=ChatOpenAI(model=model, temperature=temperature)
-    return llm
\ No newline at end of file
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def model_config(name: str) -> dict:
+    '''
+    模型配置：settings.llm_gateway的默认值被settings.llm[name]中的同名配置覆盖
+    :param name: settings.llm中的配置名
+    :return:
+    '''
+    if name not in settings.llm:
+        raise ValueError(f'未配置的模型：{name}')
+    defaults = settings.llm_gateway
+    config = settings.llm[name]
+    return {key: config.get(key, defaults[key]) for key in
+            ('timeout', 'max_concurrency', 'rate_per_second', 'burst', 'max_retries', 'backoff_base', 'backoff_max')}
+
+
+class TokenBucket:
+    """令牌桶限速，同时提供线程(同步客户端)及协程(异步客户端)两种等待方式"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self) -> float:
+        '''
+        取一个令牌
+        :return: 需要等待的秒数，0表示已取到
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self) -> float:
+        waited = 0.0
+        while self.rate > 0:
+            wait = self._take()
+            if not wait:
+                break
+            time.sleep(wait)
+            waited += wait
+        return waited
+
+    async def aacquire(self) -> float:
+        waited = 0.0
+        while self.rate > 0:
+            wait = self._take()
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+            waited += wait
+        return waited
+
+
+class ModelLimiter:
+    """单个模型的并发、限速及重试策略和统计"""
+
+    def __init__(self, name: str, config: dict):
+        self.name = name
+        self.config = config
+        self.bucket = TokenBucket(config['rate_per_second'], config['burst'])
+        self._semaphore = threading.BoundedSemaphore(config['max_concurrency'])
+        self._async_semaphore = None  #首次在事件循环中使用时创建
+        self.stats = {'requests': 0, 'retries': 0, 'errors': 0, 'in_flight': 0, 'rate_limited_seconds': 0.0}
+
+    @property
+    def async_semaphore(self) -> asyncio.Semaphore:
+        if self._async_semaphore is None:
+            self._async_semaphore = asyncio.Semaphore(self.config['max_concurrency'])
+        return self._async_semaphore
+
+    def backoff(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        '''
+        重试等待时间：优先使用Retry-After，否则指数退避并加全量随机抖动
+        :param attempt: 第几次重试(从0开始)
+        :param response: 失败的响应
+        :return:
+        '''
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.config['backoff_max'])
+            except ValueError:
+                try:
+                    return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0),
+                               self.config['backoff_max'])
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.config['backoff_max'], self.config['backoff_base'] * 2 ** attempt))
+
+    def get_stats(self) -> dict:
+        return dict(self.stats, rate_limited_seconds=round(self.stats['rate_limited_seconds'], 3),
+                    max_concurrency=self.config['max_concurrency'], rate_per_second=self.config['rate_per_second'])
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """响应读取完毕或关闭时释放并发名额(流式输出期间连接一直被占用)"""
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._release()
+
+
+class _AsyncReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._release()
+
+
+def _once(func):
+    called = []
+
+    def wrapper():
+        if not called:
+            called.append(True)
+            func()
+    return wrapper
+
+
+class GatewayTransport(httpx.BaseTransport):
+    """同步传输层：共享底层连接池，按模型限制并发、限速及重试"""
+
+    def __init__(self, pool: httpx.BaseTransport, limiter: ModelLimiter):
+        self.pool = pool
+        self.limiter = limiter
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        limiter = self.limiter
+        limiter.stats['requests'] += 1
+        attempt = 0
+        while True:
+            limiter.stats['rate_limited_seconds'] += limiter.bucket.acquire()
+            limiter._semaphore.acquire()
+            limiter.stats['in_flight'] += 1
+
+            def release():
+                limiter.stats['in_flight'] -= 1
+                limiter._semaphore.release()
+            release = _once(release)
+            try:
+                response = self.pool.handle_request(request)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError):
+                release()
+                if attempt >= limiter.config['max_retries']:
+                    limiter.stats['errors'] += 1
+                    raise
+                time.sleep(limiter.backoff(attempt))
+            except BaseException:
+                release()
+                raise
+            else:
+                if response.status_code not in RETRY_STATUS or attempt >= limiter.config['max_retries']:
+                    if response.status_code >= 400:
+                        limiter.stats['errors'] += 1
+                    return httpx.Response(status_code=response.status_code, headers=response.headers,
+                                          stream=_ReleasingStream(response.stream, release),
+                                          extensions=response.extensions, request=request)
+                wait = limiter.backoff(attempt, response)
+                response.close()
+                release()
+                time.sleep(wait)
+            attempt += 1
+            limiter.stats['retries'] += 1
+
+    def close(self):
+        #底层连接池由所有模型共享，不随单个客户端关闭
+        pass
+
+
+class AsyncGatewayTransport(httpx.AsyncBaseTransport):
+    """异步传输层：共享底层连接池，按模型限制并发、限速及重试"""
+
+    def __init__(self, pool: httpx.AsyncBaseTransport, limiter: ModelLimiter):
+        self.pool = pool
+        self.limiter = limiter
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        limiter = self.limiter
+        limiter.stats['requests'] += 1
+        attempt = 0
+        while True:
+            limiter.stats['rate_limited_seconds'] += await limiter.bucket.aacquire()
+            semaphore = limiter.async_semaphore
+            await semaphore.acquire()
+            limiter.stats['in_flight'] += 1
+
+            def release():
+                limiter.stats['in_flight'] -= 1
+                semaphore.release()
+            release = _once(release)
+            try:
+                response = await self.pool.handle_async_request(request)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError):
+                release()
+                if attempt >= limiter.config['max_retries']:
+                    limiter.stats['errors'] += 1
+                    raise
+                await asyncio.sleep(limiter.backoff(attempt))
+            except BaseException:
+                release()
+                raise
+            else:
+                if response.status_code not in RETRY_STATUS or attempt >= limiter.config['max_retries']:
+                    if response.status_code >= 400:
+                        limiter.stats['errors'] += 1
+                    return httpx.Response(status_code=response.status_code, headers=response.headers,
+                                          stream=_AsyncReleasingStream(response.stream, release),
+                                          extensions=response.extensions, request=request)
+                wait = limiter.backoff(attempt, response)
+                await response.aclose()
+                release()
+                await asyncio.sleep(wait)
+            attempt += 1
+            limiter.stats['retries'] += 1
+
+    async def aclose(self):
+        pass
+
+
+#进程内共享的连接池及各模型的限流器
+_pools: Dict[str, object] = {}
+_limiters: Dict[str, ModelLimiter] = {}
+_lock = threading.Lock()
+
+
+def _pool_limits() -> httpx.Limits:
+    pool = settings.llm_gateway['pool']
+    return httpx.Limits(max_connections=pool['max_connections'],
+                        max_keepalive_connections=pool['max_keepalive_connections'],
+                        keepalive_expiry=pool['keepalive_expiry'])
+
+
+def get_limiter(name: str) -> ModelLimiter:
+    with _lock:
+        if name not in _limiters:
+            _limiters[name] = ModelLimiter(name, model_config(name))
+        return _limiters[name]
+
+
+def get_http_clients(name: str):
+    '''
+    模型使用的同步/异步HTTP客户端，底层连接池所有模型共享
+    :param name: settings.llm中的配置名
+    :return: (httpx.Client,httpx.AsyncClient)
+    '''
+    limiter = get_limiter(name)
+    with _lock:
+        if 'sync' not in _pools:
+            _pools['sync'] = httpx.HTTPTransport(limits=_pool_limits())
+            _pools['async'] = httpx.AsyncHTTPTransport(limits=_pool_limits())
+    timeout = httpx.Timeout(limiter.config['timeout'], connect=10)
+    return (httpx.Client(transport=GatewayTransport(_pools['sync'], limiter), timeout=timeout),
+            httpx.AsyncClient(transport=AsyncGatewayTransport(_pools['async'], limiter), timeout=timeout))
+
+
+def getllm(name='qwen', purpose='text-to-sql'):
+    '''
+    获取模型
+    :param name: settings.llm中的配置名
+    :param purpose: 用途，决定使用的温度
+    :return:
+    '''
+    config = settings.llm.get(name)
+    if config is None:
+        raise ValueError(f'未配置的模型：{name}')
+    model = config.get('model')
+    temperature = config.get('temperature').get(purpose)
+    http_client, http_async_client = get_http_clients(name)
+    kwargs = {}
+    #未配置时沿用OPENAI_BASE_URL/OPENAI_API_KEY环境变量
+    if config.get('base_url'):
+        kwargs['base_url'] = config['base_url']
+    if config.get('api_key_env'):
+        kwargs['api_key'] = os.environ.get(config['api_key_env'])
+    elif config.get('api_key'):
+        kwargs['api_key'] = config['api_key']
+    #重试由网关统一处理(含429的Retry-After)，关闭SDK自带的重试避免叠加
+    #stream_usage：流式调用时同样返回token用量，用于指标统计
+    llm = ChatOpenAI(model=model, temperature=temperature, stream_usage=True, max_retries=0,
+                     timeout=model_config(name)['timeout'], http_client=http_client,
+                     http_async_client=http_async_client, **kwargs)
+    return llm
+
+
+def get_gateway_stats() -> dict:
+    '''
+    各模型的请求数、重试次数、当前并发及限速等待时间
+    :return:
+    '''
+    return {name: limiter.get_stats() for name, limiter in _limiters.items()}
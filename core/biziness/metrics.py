@@ -0,0 +1,248 @@
+"""
+text-to-sql 运行指标
+记录各阶段耗时、LLM调用耗时/首token耗时/token用量、Agent迭代次数及重试次数：
+- Prometheus指标(依赖prometheus_client，未安装时不记录)，通过 /metrics 暴露
+- OpenTelemetry链路(依赖opentelemetry-sdk，settings.telemetry['otlp_endpoint']配置后启用)
+- 每个请求的耗时汇总，调试模式下追加到流式输出
+"""
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import AsyncCallbackHandler
+
+import settings
+
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+except ImportError:
+    Counter = Histogram = generate_latest = None
+    CONTENT_TYPE_LATEST = 'text/plain; charset=utf-8'
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, value=1):
+        pass
+
+
+def _histogram(name, documentation, labels=(), buckets=None):
+    if Histogram is None:
+        return _NoopMetric()
+    kwargs = {'buckets': buckets} if buckets else {}
+    return Histogram(name, documentation, labels, **kwargs)
+
+
+def _counter(name, documentation, labels=()):
+    if Counter is None:
+        return _NoopMetric()
+    return Counter(name, documentation, labels)
+
+
+_latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+STAGE_SECONDS = _histogram('texttosql_stage_seconds', '各阶段耗时(秒)', ['stage'], _latency_buckets)
+LLM_SECONDS = _histogram('texttosql_llm_seconds', 'LLM调用耗时(秒)', ['model'], _latency_buckets)
+LLM_TTFT_SECONDS = _histogram('texttosql_llm_ttft_seconds', 'LLM首token耗时(秒)', ['model'], _latency_buckets)
+LLM_TOKENS = _counter('texttosql_llm_tokens_total', 'LLM token用量', ['model', 'kind'])
+AGENT_ITERATIONS = _histogram('texttosql_agent_iterations', 'Agent迭代次数', buckets=(0, 1, 2, 3, 4, 5, 6, 8))
+RETRIES = _histogram('texttosql_retries', 'SQL重新生成次数', buckets=(0, 1, 2, 3))
+REQUESTS = _counter('texttosql_requests_total', 'text-to-sql请求数', ['outcome'])
+
+_tracer = None
+
+
+def setup_tracing():
+    '''
+    配置OpenTelemetry，导出到OTLP收集器(如本地的otel-collector/jaeger)，应用启动时调用
+    :return:
+    '''
+    global _tracer
+    endpoint = settings.telemetry.get('otlp_endpoint')
+    if otel_trace is None or not endpoint:
+        return
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    provider = TracerProvider(resource=Resource.create({'service.name': settings.telemetry['service_name']}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+    otel_trace.set_tracer_provider(provider)
+    _tracer = otel_trace.get_tracer('kghub.texttosql')
+
+
+def metrics_payload():
+    '''
+    Prometheus文本格式的指标
+    :return: (内容,content-type)
+    '''
+    if generate_latest is None:
+        return b'# prometheus_client not installed\n', CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class RequestTrace:
+    """单个请求的耗时及用量记录"""
+
+    def __init__(self, name: str = 'text-to-sql', **attributes):
+        self.started = time.perf_counter()
+        self.stages: List[dict] = []  #[{'stage','seconds'}]
+        self.llm_calls: List[dict] = []  #[{'model','seconds','ttft','prompt_tokens','completion_tokens'}]
+        self.agent_iterations = 0
+        self.agent_ran = False  #未调用Agent的请求不计入迭代次数分布
+        self.retries = 0
+        self.outcome = 'ok'  #ok/error/rejected/cache_hit/throttled
+        self.attributes: Dict[str, Any] = {}  #请求级附加信息，如提示词大小、前缀哈希
+        self._span = _tracer.start_span(name, attributes=attributes) if _tracer else None
+
+    def start_span(self, name: str, **attributes):
+        '''
+        创建请求span的子span，未启用链路时返回None，调用方负责end
+        :param name:
+        :return:
+        '''
+        if not (_tracer and self._span):
+            return None
+        return _tracer.start_span(name, context=otel_trace.set_span_in_context(self._span), attributes=attributes)
+
+    @contextmanager
+    def stage(self, name: str, **attributes):
+        '''
+        记录一个阶段的耗时
+        :param name: 阶段名，如generate_sql、db.execute
+        :return:
+        '''
+        span = self.start_span(name, **attributes)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.stages.append({'stage': name, 'seconds': round(seconds, 4)})
+            STAGE_SECONDS.labels(name).observe(seconds)
+            if span:
+                span.end()
+
+    def annotate(self, **attributes):
+        '''
+        记录请求级附加信息
+        :return:
+        '''
+        self.attributes.update(attributes)
+        if self._span:
+            self._span.set_attributes({k: v for k, v in attributes.items() if isinstance(v, (str, bool, int, float))})
+
+    def record_llm(self, model: str, seconds: float, ttft: Optional[float], prompt_tokens: int,
+                   completion_tokens: int):
+        self.llm_calls.append({'model': model, 'seconds': round(seconds, 4),
+                               'ttft': round(ttft, 4) if ttft is not None else None,
+                               'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens})
+        LLM_SECONDS.labels(model).observe(seconds)
+        if ttft is not None:
+            LLM_TTFT_SECONDS.labels(model).observe(ttft)
+        LLM_TOKENS.labels(model, 'prompt').inc(prompt_tokens)
+        LLM_TOKENS.labels(model, 'completion').inc(completion_tokens)
+
+    def record_agent(self, iterations: int):
+        self.agent_ran = True
+        self.agent_iterations = iterations
+
+    def finish(self, outcome: Optional[str] = None):
+        '''
+        请求结束，记录请求级指标
+        :param outcome: 请求结果，为空时使用self.outcome
+        :return:
+        '''
+        self.outcome = outcome or self.outcome
+        if self.agent_ran:
+            AGENT_ITERATIONS.observe(self.agent_iterations)
+        RETRIES.observe(self.retries)
+        REQUESTS.labels(self.outcome).inc()
+        if self._span:
+            self._span.set_attribute('outcome', self.outcome)
+            self._span.end()
+
+    def summary(self) -> dict:
+        '''
+        请求耗时汇总
+        :return:
+        '''
+        return {
+            'outcome': self.outcome,
+            'total_seconds': round(time.perf_counter() - self.started, 4),
+            'stages': self.stages,
+            'llm_calls': self.llm_calls,
+            'prompt_tokens': sum(c['prompt_tokens'] for c in self.llm_calls),
+            'completion_tokens': sum(c['completion_tokens'] for c in self.llm_calls),
+            'agent_iterations': self.agent_iterations,
+            'retries': self.retries,
+            **self.attributes,
+        }
+
+
+class TraceCallbackHandler(AsyncCallbackHandler):
+    """LangChain回调：记录请求内每次LLM调用的耗时、首token耗时及token用量，启用链路时每次调用一个子span"""
+
+    def __init__(self, trace: RequestTrace):
+        self.trace = trace
+        self._runs: Dict[UUID, dict] = {}
+
+    def _start(self, run_id, serialized, kwargs):
+        params = kwargs.get('invocation_params') or {}
+        model = params.get('model') or params.get('model_name') or (serialized or {}).get('name', 'unknown')
+        self._runs[run_id] = {'model': model, 'start': time.perf_counter(), 'first': None,
+                              'span': self.trace.start_span('llm', model=str(model))}
+
+    async def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id, serialized, kwargs)
+
+    async def on_llm_start(self, serialized, prompts, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id, serialized, kwargs)
+
+    async def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.get(run_id)
+        if run and run['first'] is None:
+            run['first'] = time.perf_counter()
+
+    async def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        prompt_tokens = completion_tokens = 0
+        usage = (response.llm_output or {}).get('token_usage') or {}
+        if usage:
+            prompt_tokens = usage.get('prompt_tokens', 0)
+            completion_tokens = usage.get('completion_tokens', 0)
+        else:
+            #流式调用时用量在消息的usage_metadata中
+            for generations in response.generations:
+                for generation in generations:
+                    metadata = getattr(getattr(generation, 'message', None), 'usage_metadata', None) or {}
+                    prompt_tokens += metadata.get('input_tokens', 0)
+                    completion_tokens += metadata.get('output_tokens', 0)
+        now = time.perf_counter()
+        ttft = run['first'] - run['start'] if run['first'] else None
+        self.trace.record_llm(run['model'], now - run['start'], ttft, prompt_tokens, completion_tokens)
+        if run['span']:
+            attributes = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens}
+            if ttft is not None:
+                attributes['ttft_seconds'] = round(ttft, 4)
+            run['span'].set_attributes(attributes)
+            run['span'].end()
+
+    async def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.pop(run_id, None)
+        if run and run['span']:
+            run['span'].record_exception(error)
+            run['span'].set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, str(error)))
+            run['span'].end()
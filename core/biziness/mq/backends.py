@@ -0,0 +1,182 @@
+"""
+任务队列后端
+memory：进程内(单进程部署及测试，重启后任务丢失)
+database：settings.db中的PostgreSQL表ingest_jobs，多个工作进程按状态条件更新领取任务
+redis：每个阶段一个按优先级排序的有序集合，延迟重试的任务保存在单独的有序集合中，到期后转入
+"""
+import heapq
+import itertools
+import json
+import time
+from typing import Dict, List, Optional
+
+import settings
+from core.biziness.mq.base import Job, QueueBackend, QUEUED, RUNNING
+from utils.asyncutils import run_blocking
+
+
+class MemoryBackend(QueueBackend):
+    def __init__(self):
+        self._jobs: Dict[str, Job] = {}
+        self._ready: Dict[str, list] = {}  #阶段->[(-优先级,序号,任务ID)]
+        self._delayed: Dict[str, list] = {}  #阶段->[(可执行时间,序号,任务ID)]
+        self._seq = itertools.count()
+
+    async def push(self, job: Job) -> None:
+        job.updated_at = time.time()
+        self._jobs[job.id] = job
+        if job.status != QUEUED:
+            return
+        if job.available_at > time.time():
+            heapq.heappush(self._delayed.setdefault(job.stage, []), (job.available_at, next(self._seq), job.id))
+        else:
+            heapq.heappush(self._ready.setdefault(job.stage, []), (-job.priority, next(self._seq), job.id))
+
+    async def pop(self, stage: str) -> Optional[Job]:
+        now = time.time()
+        delayed = self._delayed.get(stage, [])
+        ready = self._ready.setdefault(stage, [])
+        while delayed and delayed[0][0] <= now:
+            _, seq, job_id = heapq.heappop(delayed)
+            heapq.heappush(ready, (-self._jobs[job_id].priority, seq, job_id))
+        while ready:
+            _, _, job_id = heapq.heappop(ready)
+            job = self._jobs.get(job_id)
+            if job is not None and job.status == QUEUED and job.stage == stage:
+                job.status, job.updated_at = RUNNING, now
+                return job
+        return None
+
+    async def save(self, job: Job) -> None:
+        job.updated_at = time.time()
+        self._jobs[job.id] = job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def recent(self, limit: int = 50) -> List[Job]:
+        return sorted(self._jobs.values(), key=lambda job: job.created_at, reverse=True)[:limit]
+
+    async def stale(self, before: float) -> List[Job]:
+        #进程内的任务随进程退出，不存在遗留的运行中任务
+        return []
+
+
+class DatabaseBackend(QueueBackend):
+    def __init__(self):
+        from core.dataaccess.orm.Job import JobInfo
+        self.info = JobInfo()
+
+    async def push(self, job: Job) -> None:
+        await self.save(job)
+
+    async def pop(self, stage: str) -> Optional[Job]:
+        data = await run_blocking(self.info.claim, stage)
+        return Job.from_dict(data) if data else None
+
+    async def save(self, job: Job) -> None:
+        job.updated_at = time.time()
+        await run_blocking(self.info.save, job.to_dict())
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        data = await run_blocking(self.info.get, job_id)
+        return Job.from_dict(data) if data else None
+
+    async def recent(self, limit: int = 50) -> List[Job]:
+        return [Job.from_dict(data) for data in await run_blocking(self.info.recent, limit)]
+
+    async def stale(self, before: float) -> List[Job]:
+        return [Job.from_dict(data) for data in await run_blocking(self.info.stale, before)]
+
+
+class RedisBackend(QueueBackend):
+    #优先级相同时按入队顺序领取，有序集合分数=-优先级*_SPAN+序号
+    _SPAN = 10 ** 10
+
+    def __init__(self, prefix: str = 'kghub:mq:'):
+        from core.dataaccess.redis.client import get_redis
+        self.redis = get_redis()
+        self.prefix = prefix
+        self.job_ttl = settings.mq['finished_ttl']
+
+    def _key(self, *parts) -> str:
+        return self.prefix + ':'.join(parts)
+
+    async def push(self, job: Job) -> None:
+        await self.save(job)
+        if job.status != QUEUED:
+            return
+        if job.available_at > time.time():
+            await self.redis.zadd(self._key('delayed', job.stage), {job.id: job.available_at})
+        else:
+            seq = await self.redis.incr(self._key('seq'))
+            await self.redis.zadd(self._key('ready', job.stage), {job.id: -job.priority * self._SPAN + seq})
+
+    async def pop(self, stage: str) -> Optional[Job]:
+        delayed = self._key('delayed', stage)
+        for job_id in await self.redis.zrangebyscore(delayed, 0, time.time()):
+            #ZREM成功的进程负责转入，避免重复入队
+            if await self.redis.zrem(delayed, job_id):
+                job = await self.get(job_id)
+                if job is not None:
+                    job.available_at = time.time()
+                    await self.push(job)
+        while True:
+            popped = await self.redis.zpopmin(self._key('ready', stage))
+            if not popped:
+                return None
+            job = await self.get(popped[0][0])
+            if job is not None and job.status == QUEUED and job.stage == stage:
+                job.status = RUNNING
+                await self.save(job)
+                return job
+
+    async def save(self, job: Job) -> None:
+        job.updated_at = time.time()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(self._key('job', job.id), json.dumps(job.to_dict(), ensure_ascii=False),
+                     ex=self.job_ttl if job.finished else None)
+            pipe.zadd(self._key('jobs'), {job.id: job.created_at})
+            if job.status == RUNNING:
+                pipe.zadd(self._key('running'), {job.id: job.updated_at})
+            else:
+                pipe.zrem(self._key('running'), job.id)
+            await pipe.execute()
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        data = await self.redis.get(self._key('job', job_id))
+        return Job.from_dict(json.loads(data)) if data else None
+
+    async def recent(self, limit: int = 50) -> List[Job]:
+        jobs = []
+        for job_id in await self.redis.zrevrange(self._key('jobs'), 0, limit - 1):
+            job = await self.get(job_id)
+            if job is None:
+                #已过期的任务
+                await self.redis.zrem(self._key('jobs'), job_id)
+            else:
+                jobs.append(job)
+        return jobs
+
+    async def stale(self, before: float) -> List[Job]:
+        jobs = []
+        for job_id in await self.redis.zrangebyscore(self._key('running'), 0, before):
+            job = await self.get(job_id)
+            if job is not None and job.status == RUNNING:
+                jobs.append(job)
+        return jobs
+
+
+def create_backend(name: Optional[str] = None) -> QueueBackend:
+    '''
+    :param name: memory/database/redis，默认settings.mq['backend']
+    :return:
+    '''
+    name = name or settings.mq['backend']
+    if name == 'memory':
+        return MemoryBackend()
+    if name == 'database':
+        return DatabaseBackend()
+    if name == 'redis':
+        return RedisBackend()
+    raise ValueError(f'未知的任务队列后端：{name}')
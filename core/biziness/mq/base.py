@@ -0,0 +1,73 @@
+"""
+任务队列基础定义
+任务按阶段流转：每个阶段有独立的队列，阶段完成后任务进入下一阶段的队列；
+后端只负责保存任务及按优先级领取，重试、进度及阶段流转由core.biziness.mq.worker处理
+"""
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+@dataclass
+class Job:
+    stage: str  #当前阶段
+    payload: dict
+    priority: int = 0  #越大越优先
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = QUEUED
+    result: dict = field(default_factory=dict)  #阶段名->阶段结果
+    attempts: int = 0  #当前阶段已尝试次数
+    progress: float = 0.0  #整体进度0-1
+    message: Optional[str] = None
+    error: Optional[str] = None
+    available_at: float = field(default_factory=time.time)  #可被领取的时间，重试时延后
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Job':
+        return cls(**{name: data[name] for name in cls.__dataclass_fields__ if name in data})
+
+
+class QueueBackend:
+    """
+    任务队列后端
+    push：保存任务，状态为queued时加入所在阶段的队列；pop：领取阶段中可执行的优先级最高的任务并标记为running
+    """
+
+    async def push(self, job: Job) -> None:
+        raise NotImplementedError
+
+    async def pop(self, stage: str) -> Optional[Job]:
+        raise NotImplementedError
+
+    async def save(self, job: Job) -> None:
+        '''
+        更新任务状态及进度(运行中的任务同时作为心跳)
+        '''
+        raise NotImplementedError
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        raise NotImplementedError
+
+    async def recent(self, limit: int = 50) -> List[Job]:
+        raise NotImplementedError
+
+    async def stale(self, before: float) -> List[Job]:
+        '''
+        超过指定时间未更新的运行中任务
+        '''
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,198 @@
+"""
+文档入库：解析->切片->向量化->写入知识库
+上传接口保存文件后提交任务立即返回，各阶段在工作协程中执行，产物保存在上传目录的artifacts下并登记到文件内容，
+相同内容再次上传时已完成的阶段直接复用
+"""
+import json
+import os
+import re
+from dataclasses import asdict
+from typing import Iterator, List, Optional
+
+import settings
+from core.biziness.docs.pipeline import iter_document
+from core.biziness.embedding import get_embedding_service
+from core.biziness.knowledge.store import get_knowledge_base
+from core.biziness.mq.base import Job
+from core.biziness.mq.worker import JobContext, JobQueue
+from core.biziness.upload import StoredFile, artifact_dir, get_upload_info
+from utils.asyncutils import run_blocking
+
+ingest_queue = JobQueue()
+
+_sentence_end = re.compile(r'(?<=[。！？；!?;\n])')
+
+
+async def _reusable(sha256: str, stage: str) -> Optional[dict]:
+    '''
+    已完成且产物文件仍存在的阶段结果
+    '''
+    artifact = (await run_blocking(get_upload_info().get_artifacts, sha256)).get(stage)
+    if artifact and os.path.exists(artifact.get('path', '')):
+        return artifact
+    return None
+
+
+async def _register_artifact(sha256: str, stage: str, value: dict):
+    await run_blocking(get_upload_info().set_artifact, sha256, stage, value)
+
+
+def _write_lines(f, lines: List[str]):
+    f.writelines(lines)
+
+
+def _iter_jsonl(path: str) -> Iterator[dict]:
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def split_text(text: str, size: int, overlap: int) -> List[str]:
+    '''
+    按句子边界切分文本，每片不超过size个字符，相邻切片重叠overlap个字符
+    :param text:
+    :param size: 切片最大字符数
+    :param overlap: 重叠字符数，须小于size
+    :return:
+    '''
+    if not 0 <= overlap < size:
+        raise ValueError(f'切片重叠字符数({overlap})须小于切片最大字符数({size})')
+    pieces, current = [], ''
+    for sentence in _sentence_end.split(text):
+        while len(sentence) > size:
+            #超长句子按长度硬切
+            head, sentence = sentence[:size - len(current)], sentence[size - len(current):]
+            pieces.append(current + head)
+            current = pieces[-1][-overlap:] if overlap else ''
+        if len(current) + len(sentence) > size and current:
+            pieces.append(current)
+            current = current[-overlap:] if overlap else ''
+        current += sentence
+    if current.strip():
+        pieces.append(current)
+    return [piece.strip() for piece in pieces if piece.strip()]
+
+
+def _chunk_file(sha256: str, sections_path: str, chunks_path: str) -> int:
+    size, overlap = settings.ingest['chunk_size'], settings.ingest['chunk_overlap']
+    count = 0
+    tmp_path = chunks_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for section in _iter_jsonl(sections_path):
+            for text in split_text(section['text'], size, overlap):
+                chunk = {'id': f'{sha256}:{count}', 'text': text, 'title': section['title'], 'kind': section['kind'],
+                         'section': section['index'], 'metadata': section['metadata']}
+                f.write(json.dumps(chunk, ensure_ascii=False) + '\n')
+                count += 1
+    os.replace(tmp_path, chunks_path)
+    return count
+
+
+@ingest_queue.stage('parse')
+async def parse(job: Job, ctx: JobContext) -> dict:
+    '''
+    在解析进程池中逐段解析，结果按行写入sections.jsonl
+    '''
+    sha256 = job.payload['sha256']
+    reused = await _reusable(sha256, 'parse')
+    if reused:
+        return dict(reused, reused=True)
+    out_dir = artifact_dir(sha256)
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, 'sections.jsonl')
+    tmp_path = path + '.tmp'
+    f = await run_blocking(open, tmp_path, 'w', encoding='utf-8')
+    count, lines = 0, []
+    try:
+        async for section in iter_document(job.payload['file_path']):
+            lines.append(json.dumps(asdict(section), ensure_ascii=False) + '\n')
+            count += 1
+            if len(lines) >= 64:
+                await run_blocking(_write_lines, f, lines)
+                lines = []
+            pages = section.metadata.get('pages')
+            #页数未知的格式按段数上报
+            await ctx.report(count / pages if pages else 0.5, f'已解析{count}段')
+        await run_blocking(_write_lines, f, lines)
+    finally:
+        await run_blocking(f.close)
+    await run_blocking(os.replace, tmp_path, path)
+    value = {'path': path, 'sections': count}
+    await _register_artifact(sha256, 'parse', value)
+    return value
+
+
+@ingest_queue.stage('chunk')
+async def chunk(job: Job, ctx: JobContext) -> dict:
+    sha256 = job.payload['sha256']
+    reused = await _reusable(sha256, 'chunk')
+    if reused:
+        return dict(reused, reused=True)
+    path = os.path.join(artifact_dir(sha256), 'chunks.jsonl')
+    count = await run_blocking(_chunk_file, sha256, job.result['parse']['path'], path)
+    value = {'path': path, 'chunks': count, 'chunk_size': settings.ingest['chunk_size'],
+             'chunk_overlap': settings.ingest['chunk_overlap']}
+    await _register_artifact(sha256, 'chunk', value)
+    return value
+
+
+@ingest_queue.stage('embed')
+async def embed(job: Job, ctx: JobContext) -> dict:
+    '''
+    分批计算切片向量，保存为与chunks.jsonl逐行对应的vectors.npy
+    向量服务按内容缓存，重复的切片(如其他文档中相同的段落)不再计算
+    '''
+    import numpy as np
+    sha256 = job.payload['sha256']
+    reused = await _reusable(sha256, 'embed')
+    if reused:
+        return dict(reused, reused=True)
+    texts = [item['text'] for item in await run_blocking(lambda: list(_iter_jsonl(job.result['chunk']['path'])))]
+    service = get_embedding_service(settings.ingest['embed_model'])
+    batch_size = settings.ingest['embed_batch_size']
+    vectors = []
+    for start in range(0, len(texts), batch_size):
+        vectors.append(await service.aembed(texts[start:start + batch_size]))
+        done = min(start + batch_size, len(texts))
+        await ctx.report(done / len(texts), f'已向量化{done}/{len(texts)}')
+    path = os.path.join(artifact_dir(sha256), 'vectors.npy')
+    matrix = np.concatenate(vectors) if vectors else np.zeros((0, 0), dtype='float32')
+    await run_blocking(np.save, path, matrix)
+    value = {'path': path, 'vectors': int(matrix.shape[0]), 'model': settings.ingest['embed_model']}
+    await _register_artifact(sha256, 'embed', value)
+    return value
+
+
+def _load_document(chunks_path: str, vectors_path: str):
+    import numpy as np
+    return list(_iter_jsonl(chunks_path)), np.load(vectors_path)
+
+
+@ingest_queue.stage('index')
+async def index(job: Job, ctx: JobContext) -> dict:
+    '''
+    切片及向量写入知识库，文档已存在时整体替换(标签以本次上传为准)
+    '''
+    chunks, vectors = await run_blocking(_load_document, job.result['chunk']['path'], job.result['embed']['path'])
+    count = await run_blocking(get_knowledge_base().add_document, job.payload['sha256'], job.payload['filename'],
+                               chunks, vectors, job.payload.get('tags'))
+    return {'chunks': count}
+
+
+async def submit_ingest(stored: StoredFile, priority: int = 0, tags: Optional[List[str]] = None) -> Optional[Job]:
+    '''
+    提交入库任务，文档已在知识库中时只更新标签，不再提交
+    :param stored: 已保存的上传文件
+    :param priority: 优先级，越大越优先
+    :param tags: 文档标签
+    :return: 任务，无需入库时返回None
+    '''
+    kb = get_knowledge_base()
+    if await run_blocking(kb.has_document, stored.sha256):
+        if tags:
+            await run_blocking(kb.set_tags, stored.sha256, tags)
+        return None
+    return await ingest_queue.submit({'sha256': stored.sha256, 'file_path': stored.file_path,
+                                      'filename': stored.filename, 'ext': stored.ext, 'tags': tags or []},
+                                     priority=priority)
@@ -0,0 +1,232 @@
+"""
+任务队列工作协程
+按阶段注册处理函数，每个阶段按配置的并发数启动工作协程；阶段失败时按指数退避重试，超过次数后任务失败；
+运行中的任务长时间未更新进度视为所在工作进程已退出，重新排队
+工作协程可随API进程启动(settings.mq['run_workers'])，也可单独运行多个进程以提高吞吐(需使用database/redis后端)：
+python -m core.biziness.mq.worker [--stages parse chunk embed]
+"""
+import argparse
+import asyncio
+import logging
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import settings
+from core.biziness.mq.backends import create_backend
+from core.biziness.mq.base import Job, QueueBackend, DONE, FAILED, QUEUED, RUNNING
+
+logger = logging.getLogger(__name__)
+
+
+class JobContext:
+    """传给阶段处理函数，用于上报进度"""
+
+    def __init__(self, queue: 'JobQueue', job: Job, stage_index: int):
+        self.queue = queue
+        self.job = job
+        self._stage_index = stage_index
+        self._reported = 0.0
+
+    async def report(self, fraction: float, message: Optional[str] = None, force: bool = False):
+        '''
+        上报当前阶段的进度，同时作为心跳；为减少后端写入，相邻两次上报至少间隔1秒
+        :param fraction: 当前阶段完成比例0-1
+        :param message: 进度说明
+        :param force: 忽略间隔立即写入
+        :return:
+        '''
+        stages = len(self.queue.pipeline)
+        self.job.progress = round((self._stage_index + min(max(fraction, 0.0), 1.0)) / stages, 4)
+        if message:
+            self.job.message = message
+        now = time.time()
+        if force or now - self._reported >= 1:
+            self._reported = now
+            await self.queue.backend.save(self.job)
+
+
+Handler = Callable[[Job, JobContext], Awaitable[Optional[dict]]]
+
+
+@dataclass
+class Stage:
+    name: str
+    handler: Handler
+    concurrency: int = 1
+    max_attempts: int = 3
+    timeout: Optional[float] = None
+
+
+class JobQueue:
+    """按顺序执行的多阶段任务队列"""
+
+    def __init__(self, backend: Optional[QueueBackend] = None):
+        self._backend = backend
+        self.stages: Dict[str, Stage] = {}
+        self.pipeline: List[str] = []  #阶段执行顺序
+        self._tasks: List[asyncio.Task] = []
+        self._running = False
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'retries': 0, 'recovered': 0}
+
+    @property
+    def backend(self) -> QueueBackend:
+        if self._backend is None:
+            self._backend = create_backend()
+        return self._backend
+
+    def stage(self, name: str):
+        '''
+        注册阶段处理函数(装饰器)，按注册顺序执行，并发数、重试次数及超时时间取settings.mq['stages'][name]
+        处理函数返回的字典保存在job.result[阶段名]中
+        :param name: 阶段名
+        :return:
+        '''
+        def decorator(handler: Handler) -> Handler:
+            config = settings.mq['stages'].get(name, {})
+            self.stages[name] = Stage(name=name, handler=handler, concurrency=config.get('concurrency', 1),
+                                      max_attempts=config.get('max_attempts', 3), timeout=config.get('timeout'))
+            if name not in self.pipeline:
+                self.pipeline.append(name)
+            return handler
+        return decorator
+
+    async def submit(self, payload: dict, priority: int = 0, stage: Optional[str] = None) -> Job:
+        '''
+        提交任务
+        :param payload: 任务参数
+        :param priority: 优先级，越大越优先
+        :param stage: 起始阶段，默认第一个阶段
+        :return:
+        '''
+        job = Job(stage=stage or self.pipeline[0], payload=payload, priority=priority, message='排队中')
+        job.progress = round(self.pipeline.index(job.stage) / len(self.pipeline), 4)
+        await self.backend.push(job)
+        self.stats['submitted'] += 1
+        return job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return await self.backend.get(job_id)
+
+    async def _run(self, stage: Stage, job: Job):
+        index = self.pipeline.index(stage.name)
+        ctx = JobContext(self, job, index)
+        job.attempts += 1
+        job.error = None
+        await ctx.report(0, f'{stage.name}中', force=True)
+        try:
+            result = await asyncio.wait_for(stage.handler(job, ctx), stage.timeout)
+        except asyncio.CancelledError:
+            #停止工作协程时放回队列，由其他工作进程继续
+            job.status, job.attempts = QUEUED, max(job.attempts - 1, 0)
+            await asyncio.shield(self.backend.push(job))
+            raise
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}' if str(e) else type(e).__name__
+            logger.warning('任务%s在%s阶段失败(第%s次)：%s', job.id, stage.name, job.attempts, error)
+            job.error = error
+            if job.attempts < stage.max_attempts:
+                self.stats['retries'] += 1
+                job.status = QUEUED
+                job.available_at = time.time() + settings.mq['retry_backoff'] * 2 ** (job.attempts - 1)
+                job.message = f'{stage.name}失败，等待第{job.attempts + 1}次尝试'
+                await self.backend.push(job)
+            else:
+                self.stats['failed'] += 1
+                job.status, job.message = FAILED, f'{stage.name}失败'
+                job.error = error + '\n' + traceback.format_exc(limit=5)
+                await self.backend.save(job)
+            return
+        job.result[stage.name] = result or {}
+        if index + 1 < len(self.pipeline):
+            job.stage, job.status, job.attempts = self.pipeline[index + 1], QUEUED, 0
+            job.available_at = time.time()
+            job.progress = round((index + 1) / len(self.pipeline), 4)
+            job.message = '排队中'
+            await self.backend.push(job)
+        else:
+            self.stats['completed'] += 1
+            job.status, job.progress, job.message = DONE, 1.0, '完成'
+            await self.backend.save(job)
+
+    async def _worker(self, stage: Stage):
+        interval = settings.mq['poll_interval']
+        while self._running:
+            try:
+                job = await self.backend.pop(stage.name)
+            except Exception as e:
+                logger.warning('领取%s阶段任务失败：%s', stage.name, e)
+                job = None
+            if job is None:
+                await asyncio.sleep(interval)
+                continue
+            try:
+                await self._run(stage, job)
+            except Exception as e:
+                #上报进度或放回队列时后端出错：工作协程继续运行，任务保持运行中状态，超过stale_seconds后由_recover重新排队
+                logger.warning('处理任务%s(%s阶段)失败：%s', job.id, stage.name, e)
+                await asyncio.sleep(interval)
+
+    async def _recover(self):
+        '''
+        将工作进程已退出而遗留的运行中任务重新排队
+        '''
+        stale_seconds = settings.mq['stale_seconds']
+        while self._running:
+            try:
+                for job in await self.backend.stale(time.time() - stale_seconds):
+                    if job.status == RUNNING:
+                        job.status, job.message = QUEUED, '工作进程无响应，重新排队'
+                        job.available_at = time.time()
+                        await self.backend.push(job)
+                        self.stats['recovered'] += 1
+            except Exception as e:
+                logger.warning('恢复遗留任务失败：%s', e)
+            await asyncio.sleep(min(stale_seconds, 60))
+
+    def start(self, stages: Optional[List[str]] = None):
+        '''
+        启动工作协程，必须在事件循环中调用
+        :param stages: 只处理指定阶段，默认全部阶段
+        :return:
+        '''
+        if self._running:
+            return
+        self._running = True
+        for name in stages or self.pipeline:
+            stage = self.stages[name]
+            for _ in range(stage.concurrency):
+                self._tasks.append(asyncio.create_task(self._worker(stage)))
+        self._tasks.append(asyncio.create_task(self._recover()))
+
+    async def stop(self):
+        self._running = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def get_stats(self) -> dict:
+        return dict(self.stats, backend=type(self.backend).__name__, running=self._running,
+                    workers={name: stage.concurrency for name, stage in self.stages.items()})
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stages', nargs='+', help='只处理指定阶段，默认全部阶段')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    from core.biziness.mq.ingest import ingest_queue
+    if settings.mq['backend'] == 'memory':
+        raise SystemExit('单独运行工作进程需要使用database或redis后端')
+    ingest_queue.start(args.stages)
+    print(f'工作进程已启动：{args.stages or ingest_queue.pipeline}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await ingest_queue.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
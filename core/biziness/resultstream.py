@@ -0,0 +1,230 @@
+"""
+查询结果流式导出
+text-to-sql流程中校验并执行成功的SQL登记为query_id，
+结果接口按query_id用服务端游标逐块执行并以NDJSON/CSV/Arrow IPC格式流式返回，不经过LLM
+"""
+import asyncio
+import csv
+import io
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import AsyncIterator, Optional
+
+import settings
+from core.dataaccess.sql.executor import stream_select
+from utils.asyncutils import run_blocking
+
+logger = logging.getLogger(__name__)
+
+MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+
+class ApprovedQueries:
+    """已校验通过的SQL，LRU+TTL淘汰；只有登记过的SQL才能通过结果接口执行"""
+
+    def __init__(self, max_entries: int = 1000, ttl: int = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  #query_id->(sql,db_key,登记时间)
+        self._lock = threading.Lock()
+
+    def register(self, sql: str, db_key: str) -> str:
+        '''
+        登记SQL
+        :param sql: 已校验的查询SQL
+        :param db_key: 数据库配置名
+        :return: query_id
+        '''
+        query_id = uuid.uuid4().hex
+        with self._lock:
+            self._entries[query_id] = (sql, db_key, time.time())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return query_id
+
+    def get(self, query_id: str) -> Optional[tuple]:
+        '''
+        :param query_id:
+        :return: (sql,db_key)，不存在或已过期返回None
+        '''
+        with self._lock:
+            entry = self._entries.get(query_id)
+            if entry is None:
+                return None
+            if time.time() - entry[2] > self.ttl:
+                del self._entries[query_id]
+                return None
+            self._entries.move_to_end(query_id)
+            return entry[0], entry[1]
+
+
+class NdjsonEncoder:
+    def __init__(self, columns):
+        self.columns = columns
+
+    def header(self) -> bytes:
+        return b''
+
+    def encode(self, rows) -> bytes:
+        lines = (json.dumps(dict(zip(self.columns, row)), ensure_ascii=False, default=str) for row in rows)
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def footer(self) -> bytes:
+        return b''
+
+    def truncated(self, max_rows: int) -> bytes:
+        return (json.dumps({'_truncated': True, 'max_rows': max_rows}) + '\n').encode('utf-8')
+
+
+class CsvEncoder:
+    def __init__(self, columns):
+        self.columns = columns
+
+    def _write(self, rows) -> bytes:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue().encode('utf-8')
+
+    def header(self) -> bytes:
+        #带BOM，Excel打开中文不乱码
+        return '\ufeff'.encode('utf-8') + self._write([self.columns])
+
+    def encode(self, rows) -> bytes:
+        return self._write(rows)
+
+    def footer(self) -> bytes:
+        return b''
+
+    def truncated(self, max_rows: int) -> bytes:
+        return f'# truncated: max_rows={max_rows}\n'.encode('utf-8')
+
+
+class ArrowEncoder:
+    """Arrow IPC流格式，依赖pyarrow"""
+
+    def __init__(self, columns):
+        import pyarrow
+        self.pa = pyarrow
+        self.columns = columns
+        self.schema = None
+        self.sink = io.BytesIO()
+        self.writer = None
+
+    def _drain(self) -> bytes:
+        data = self.sink.getvalue()
+        self.sink.seek(0)
+        self.sink.truncate()
+        return data
+
+    def header(self) -> bytes:
+        return b''
+
+    def encode(self, rows) -> bytes:
+        pa = self.pa
+        data = {name: [row[i] for row in rows] for i, name in enumerate(self.columns)}
+        if self.schema is None:
+            #以第一块数据推断类型，全为空值的列按字符串处理
+            fields = []
+            for name in self.columns:
+                field_type = pa.array(data[name]).type
+                fields.append(pa.field(name, pa.string() if pa.types.is_null(field_type) else field_type))
+            self.schema = pa.schema(fields)
+            self.writer = pa.ipc.new_stream(self.sink, self.schema)
+        arrays = []
+        for field in self.schema:
+            values = data[field.name]
+            if pa.types.is_string(field.type):
+                values = [None if v is None else str(v) for v in values]
+            arrays.append(pa.array(values, type=field.type))
+        self.writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        return self._drain()
+
+    def truncated(self, max_rows: int) -> bytes:
+        #最后追加一个带custom_metadata的空批次
+        empty = self.pa.RecordBatch.from_arrays([self.pa.array([], type=f.type) for f in self.schema],
+                                                schema=self.schema)
+        self.writer.write_batch(empty, custom_metadata={'truncated': 'true', 'max_rows': str(max_rows)})
+        return self._drain()
+
+    def footer(self) -> bytes:
+        if self.writer is None:
+            #无数据时输出只有表结构的空流
+            self.schema = self.pa.schema([self.pa.field(name, self.pa.string()) for name in self.columns])
+            self.writer = self.pa.ipc.new_stream(self.sink, self.schema)
+        self.writer.close()
+        return self._drain()
+
+
+ENCODERS = {
+    'ndjson': NdjsonEncoder,
+    'csv': CsvEncoder,
+    'arrow': ArrowEncoder,
+}
+
+
+async def stream_results(db, sql: str, fmt: str = 'ndjson', chunk_size: int = 1000) -> AsyncIterator[bytes]:
+    '''
+    逐块读取并编码查询结果
+    每次只从数据库取一个块，客户端读取后才取下一块(背压)，内存占用与结果总行数无关；
+    超过max_rows被截断时在末尾追加截断标记：ndjson为{"_truncated":true,"max_rows":N}行，
+    csv为"# truncated: max_rows=N"行，arrow为带custom_metadata(truncated/max_rows)的空批次
+    :param db: SQLDatabase
+    :param sql: 已登记的SQL
+    :param fmt: ndjson/csv/arrow
+    :param chunk_size: 每块行数
+    :return:
+    '''
+    config = settings.texttosql['result_stream']
+    chunks = stream_select(db, sql, chunk_size, config['timeout'])
+    sent = 0
+    pending = None
+
+    async def fetch():
+        #客户端断开时取消的只是等待，线程中的读取会继续执行
+        nonlocal pending
+        pending = asyncio.ensure_future(run_blocking(next, chunks, None))
+        return await asyncio.shield(pending)
+    try:
+        columns = await fetch()
+        encoder = ENCODERS[fmt](list(columns))
+        header = encoder.header()
+        if header:
+            yield header
+        truncated = False
+        while True:
+            rows = await fetch()
+            if rows is None:
+                break
+            if sent + len(rows) > config['max_rows']:
+                rows = rows[:config['max_rows'] - sent]
+                truncated = True
+            if rows:
+                sent += len(rows)
+                yield encoder.encode(rows)
+            if truncated:
+                logger.warning('结果导出超过%s行，已截断', config['max_rows'])
+                yield encoder.truncated(config['max_rows'])
+                break
+        footer = encoder.footer()
+        if footer:
+            yield footer
+    finally:
+        #客户端断开或读取完毕后释放服务端游标及连接；须等待未完成的读取，
+        #否则关闭正在执行的生成器会失败("generator already executing")，游标不释放
+        if pending is not None and not pending.done():
+            await asyncio.wait([pending])
+            if not pending.cancelled():
+                pending.exception()
+        await run_blocking(chunks.close)
+
+
+_config = settings.texttosql['result_stream']
+approved_queries = ApprovedQueries(max_entries=_config['max_queries'], ttl=_config['query_ttl'])
@@ -0,0 +1,163 @@
+"""
+基于语法树(sqlglot)的SQL校验
+只允许单条SELECT查询，拒绝写操作/DDL/权限语句/多语句/INTO OUTFILE/锁及危险函数，
+按需注入或收紧LIMIT，并对照表结构检查引用的表和字段
+"""
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional, Set
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+
+#sqlalchemy方言名->sqlglot方言名
+DIALECTS = {'mysql': 'mysql', 'postgresql': 'postgres', 'sqlite': 'sqlite'}
+
+
+def _types(*names):
+    return tuple(getattr(exp, name) for name in names if hasattr(exp, name))
+
+
+QUERY_TYPES = _types('Select', 'Union', 'Except', 'Intersect', 'SetOperation')
+FORBIDDEN_TYPES = _types('Insert', 'Update', 'Delete', 'Merge', 'Drop', 'Create', 'Alter', 'AlterTable',
+                         'TruncateTable', 'Command', 'Grant', 'Revoke', 'Set', 'Use', 'Into', 'Lock', 'LoadData')
+FORBIDDEN_FUNCTIONS = {'SLEEP', 'BENCHMARK', 'LOAD_FILE', 'GET_LOCK', 'RELEASE_LOCK', 'SYS_EXEC', 'SYS_EVAL',
+                       'PG_SLEEP', 'PG_READ_FILE', 'LO_IMPORT', 'LO_EXPORT'}
+_outfile = re.compile(r'\bINTO\s+(OUT|DUMP)FILE\b', re.IGNORECASE)
+
+
+@dataclass
+class SqlCheck:
+    ok: bool
+    sql: Optional[str] = None  #校验后的SQL(已按需注入或收紧LIMIT)
+    raw_sql: Optional[str] = None  #校验后的SQL(保持原有LIMIT)
+    error: Optional[str] = None
+    tables: List[str] = field(default_factory=list)
+
+
+@lru_cache(maxsize=2048)
+def parse_sql(sql: str, dialect: str) -> tuple:
+    '''
+    解析SQL(结果缓存，使用方修改前需copy)
+    :param sql:
+    :param dialect: sqlglot方言名
+    :return: 语句表达式元组
+    '''
+    return tuple(e for e in sqlglot.parse(sql, read=dialect) if e is not None)
+
+
+def _check_references(tree, schema: Dict[str, Set[str]]) -> Optional[str]:
+    '''
+    对照表结构检查引用的表及字段
+    :param tree: 语法树
+    :param schema: 表名->字段名集合(均为小写)
+    :return: 错误信息，没有错误返回None
+    '''
+    cte_names = {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+    aliases = {}  #表别名->表名
+    for table in tree.find_all(exp.Table):
+        name = table.name.lower()
+        if name in cte_names:
+            continue
+        if name not in schema:
+            return f'表不存在：{table.name}'
+        aliases[table.alias_or_name.lower()] = name
+    #存在CTE或派生表时无法可靠推断未限定字段的来源，只检查限定了真实表的字段
+    derived = bool(cte_names) or any(isinstance(s.this, exp.Select) for s in tree.find_all(exp.Subquery)
+                                     if isinstance(s.parent, (exp.From, exp.Join)))
+    projection_aliases = {a.alias.lower() for a in tree.find_all(exp.Alias)}
+    known_columns = set().union(*(schema[t] for t in aliases.values())) if aliases else set()
+    for column in tree.find_all(exp.Column):
+        name = column.name.lower()
+        if not name or isinstance(column.this, exp.Star):
+            continue
+        qualifier = column.table.lower()
+        if qualifier:
+            table = aliases.get(qualifier)
+            if table and name not in schema[table]:
+                return f'字段不存在：{column.table}.{column.name}'
+        elif not derived and aliases and name not in known_columns and name not in projection_aliases:
+            return f'字段不存在：{column.name}'
+    return None
+
+
+def get_limit(tree) -> Optional[int]:
+    '''
+    最外层LIMIT的值
+    :param tree: 语法树
+    :return: 没有LIMIT返回None，非常量LIMIT返回-1
+    '''
+    limit = tree.args.get('limit')
+    if limit is None:
+        return None
+    value = limit.args.get('expression') or limit.this
+    if isinstance(value, exp.Literal) and value.is_int:
+        return int(value.this)
+    return -1
+
+
+def drop_limit(sql: str, dialect: str, value: int) -> str:
+    '''
+    去掉等于value的最外层LIMIT(带OFFSET的分页查询保留)
+    :param sql: 已校验的SQL
+    :param dialect: sqlalchemy方言名
+    :param value: 要去掉的LIMIT值
+    :return:
+    '''
+    read = DIALECTS.get(dialect, dialect)
+    tree = parse_sql(sql, read)[0]
+    if get_limit(tree) != value or tree.args.get('offset'):
+        return sql
+    tree = tree.copy()
+    tree.set('limit', None)
+    return tree.sql(dialect=read)
+
+
+def validate_select(sql: str, dialect: str = 'mysql', schema: Optional[Dict[str, Set[str]]] = None,
+                    max_limit: Optional[int] = None) -> SqlCheck:
+    '''
+    校验SQL只包含一条安全的查询语句
+    :param sql: 待校验SQL
+    :param dialect: sqlalchemy方言名
+    :param schema: 表名->字段名集合，为空时不检查表和字段
+    :param max_limit: 最大返回行数，为空时不注入LIMIT
+    :return:
+    '''
+    if not sql or not sql.strip():
+        return SqlCheck(False, error='SQL为空')
+    if _outfile.search(sql):
+        return SqlCheck(False, error='SQL包含危险操作：INTO OUTFILE')
+    read = DIALECTS.get(dialect, dialect)
+    try:
+        statements = parse_sql(sql.strip(), read)
+    except SqlglotError as e:
+        return SqlCheck(False, error=f'SQL语法错误：{str(e).splitlines()[0]}')
+    if len(statements) != 1:
+        return SqlCheck(False, error='只允许执行单条SQL语句')
+    tree = statements[0].copy()
+    if not isinstance(tree, QUERY_TYPES):
+        return SqlCheck(False, error=f'只允许SELECT查询，当前为：{tree.key.upper()}')
+    for node in tree.walk():
+        node = node[0] if isinstance(node, tuple) else node
+        if isinstance(node, FORBIDDEN_TYPES):
+            return SqlCheck(False, error=f'SQL包含危险操作：{node.key.upper()}')
+        if isinstance(node, exp.Func):
+            func_name = (node.name if isinstance(node, exp.Anonymous) else node.sql_name()).upper()
+            if func_name in FORBIDDEN_FUNCTIONS:
+                return SqlCheck(False, error=f'SQL包含危险函数：{func_name}')
+    if tree.args.get('locks'):
+        return SqlCheck(False, error='不允许使用加锁查询(FOR UPDATE/SHARE)')
+    if schema is not None:
+        error = _check_references(tree, schema)
+        if error:
+            return SqlCheck(False, error=error)
+    tables = sorted({t.name for t in tree.find_all(exp.Table)})
+    raw_sql = tree.sql(dialect=read)
+    limited = tree
+    if max_limit:
+        current = get_limit(tree)
+        if current is None or current < 0 or current > max_limit:
+            limited = tree.limit(max_limit)
+    return SqlCheck(True, sql=limited.sql(dialect=read), raw_sql=raw_sql, tables=tables)
@@ -0,0 +1,142 @@
+"""
+表选择
+根据用户问题对库中的表做相关性排序，只把最相关的前N张表及其外键关联表的结构送入提示词
+索引由表名、字段名及表/字段注释构建，库结构版本变化时自动重建
+"""
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import inspect
+
+_ascii_word = re.compile(r'[a-z0-9]+')
+_cjk_run = re.compile(r'[一-鿿]+')
+
+
+def tokenize(text: str) -> List[str]:
+    '''
+    分词：英文按单词(下划线/驼峰拆开)，中文按单字+相邻二字
+    :param text:
+    :return:
+    '''
+    if not text:
+        return []
+    text = re.sub(r'([a-z])([A-Z])', r'\1_\2', text).lower()
+    tokens = _ascii_word.findall(text)
+    for run in _cjk_run.findall(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def estimate_tokens(text: str) -> int:
+    '''
+    粗略估算token数：中文按一字一token，其余按4个字符一个token
+    :param text:
+    :return:
+    '''
+    if not text:
+        return 0
+    cjk = sum(len(run) for run in _cjk_run.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+class TableIndex:
+    """表相关性索引"""
+
+    def __init__(self, db, top_n: int = 5):
+        '''
+        :param db: CachedSQLDatabase
+        :param top_n: 最多选取的表数量(不含外键关联表)
+        '''
+        self.db = db
+        self.top_n = top_n
+        self._version = None
+        self._lock = threading.Lock()
+        #(表名->词频,词->IDF,表名->外键关联表)，重建时整体替换，检索时先取出引用，不会读到新旧混合的索引
+        self._index: Optional[Tuple[Dict[str, Counter], Dict[str, float], Dict[str, Set[str]]]] = None
+
+    def _build(self) -> tuple:
+        '''
+        读取表/字段名称、注释及外键，构建索引
+        :return: (表名->词频,词->IDF,表名->外键关联表)
+        '''
+        inspector = inspect(self.db._engine)
+        schema = self.db._schema
+        terms, neighbours = {}, {}
+        for table in self.db.get_usable_table_names():
+            counter = Counter()
+            try:
+                comment = inspector.get_table_comment(table, schema=schema).get('text') or ''
+            except NotImplementedError:
+                comment = ''
+            #表名和表注释权重更高
+            for token in tokenize(table) + tokenize(comment):
+                counter[token] += 3
+            for column in inspector.get_columns(table, schema=schema):
+                counter.update(tokenize(column['name']))
+                counter.update(tokenize(column.get('comment') or ''))
+            terms[table] = counter
+            neighbours.setdefault(table, set())
+            for fk in inspector.get_foreign_keys(table, schema=schema):
+                referred = fk.get('referred_table')
+                if referred:
+                    neighbours[table].add(referred)
+                    neighbours.setdefault(referred, set()).add(table)
+        df = Counter()
+        for counter in terms.values():
+            df.update(counter.keys())
+        total = len(terms)
+        idf = {term: math.log(1 + (total - n + 0.5) / (n + 0.5)) for term, n in df.items()}
+        return terms, idf, neighbours
+
+    def _ensure_index(self) -> tuple:
+        version = self.db.schema_version()
+        with self._lock:
+            #无法探测结构版本的数据库只构建一次
+            if self._index is None or (version is not None and version != self._version):
+                self._index = self._build()
+                self._version = version
+            return self._index
+
+    def rank(self, question: str) -> List[tuple]:
+        '''
+        按相关性对表排序
+        :param question: 用户问题
+        :return: [(表名,得分)]，仅包含得分大于0的表
+        '''
+        return self._rank(self._ensure_index(), question)
+
+    @staticmethod
+    def _rank(index: tuple, question: str) -> List[tuple]:
+        terms, idf, _ = index
+        query_terms = set(tokenize(question))
+        scores = []
+        for table, counter in terms.items():
+            score = sum(idf[t] * (1 + math.log(counter[t])) for t in query_terms if t in counter)
+            if score > 0:
+                scores.append((table, round(score, 4)))
+        scores.sort(key=lambda item: item[1], reverse=True)
+        return scores
+
+    def select(self, question: str, top_n: Optional[int] = None) -> Optional[List[str]]:
+        '''
+        选取相关表(前N张+外键关联表)
+        :param question: 用户问题
+        :param top_n:
+        :return: 表名列表；表数量不超过N或没有任何表命中时返回None，表示使用全部表
+        '''
+        top_n = top_n or self.top_n
+        index = self._ensure_index()
+        terms, _, neighbours = index
+        ranked = self._rank(index, question)
+        if len(terms) <= top_n or not ranked:
+            return None
+        selected = [table for table, _ in ranked[:top_n]]
+        for table in list(selected):
+            for neighbour in sorted(neighbours.get(table, ())):
+                if neighbour not in selected and neighbour in terms:
+                    selected.append(neighbour)
+        return selected
@@ -1,21 +1,74 @@
 from langchain_classic.agents import AgentType
-from langchain_classic.chains.sql_database.query import create_sql_query_chain
-from langchain_community.utilities import SQLDatabase
-from langchain_community.agent_toolkits import SQLDatabaseToolkit,create_sql_agent
+from langchain_community.agent_toolkits import create_sql_agent
 from langgraph.graph import StateGraph,START,END
+from langgraph.config import get_stream_writer
 from typing import Dict,List,Optional
+from dataclasses import dataclass,replace
 from langchain_core.prompts import PromptTemplate
+from langchain_core.output_parsers import StrOutputParser
 from typing_extensions import TypedDict
+import asyncio
+import hashlib
+import math
 import re
+from collections import Counter
+import time
 import settings
 from core.biziness.llmbase import getllm
+from core.dataaccess.sql.schema_cache import CachedSQLDatabase
+from core.biziness.tableselect import TableIndex,estimate_tokens
+from core.biziness.answercache import answer_cache
+from core.biziness.resultstream import approved_queries
+from core.biziness.sqlvalidator import drop_limit,validate_select
+from core.biziness.costguard import GuardedSQLDatabaseToolkit,check_query_cost,user_limiter
+from core.biziness.metrics import RequestTrace,TraceCallbackHandler
+from core.dataaccess.sql.executor import run_select,rows_to_markdown,explain_sql,timeout_engine_args
+from utils.asyncutils import run_blocking
 #------------------------------全局设置----------------------------------
-mysql_db_uri=settings.db['mysql']
-db=SQLDatabase.from_uri(mysql_db_uri)
-llm=getllm()
+#数据库、模型及依赖它们的链按配置名缓存，进程内共享；每个请求通过QueryContext选择使用哪一个
+_databases={}  #db_key->CachedSQLDatabase
+_table_indexes={}  #db_key->TableIndex
+_llms={}  #model->llm
+def get_db(db_key=None):
+    '''
+    获取数据库(表结构信息按库结构版本缓存，避免每次请求都反射全库并抽样查询)
+    :param db_key: settings.db中的配置名
+    :return:
+    '''
+    db_key=db_key or settings.texttosql['db']
+    if db_key not in _databases:
+        uri=settings.db[db_key]
+        _databases[db_key]=CachedSQLDatabase.from_uri(uri,
+                                                      engine_args=timeout_engine_args(uri,settings.texttosql['statement_timeout']),
+                                                      cache_ttl=settings.texttosql['schema_cache_ttl'],
+                                                      probe_interval=settings.texttosql['schema_probe_interval'],
+                                                      max_entries=settings.texttosql['schema_cache_entries'])
+    return _databases[db_key]
+def get_table_index(db_key=None):
+    '''
+    表相关性索引，只把与问题相关的表结构送入提示词
+    :param db_key:
+    :return:
+    '''
+    db_key=db_key or settings.texttosql['db']
+    if db_key not in _table_indexes:
+        _table_indexes[db_key]=TableIndex(get_db(db_key),top_n=settings.texttosql['table_top_n'])
+    return _table_indexes[db_key]
+def get_llm(model=None):
+    '''
+    获取模型
+    :param model: settings.llm中的配置名
+    :return:
+    '''
+    model=model or settings.texttosql['model']
+    if model not in _llms:
+        _llms[model]=getllm(model,'text-to-sql')
+    return _llms[model]
+db=get_db()
+llm=get_llm()
 #------------------------------提取查询关键词中的返回数量------------------------------------
-def extract_top_k_from_query(query: str) -> int:
-    """从用户查询中提取top_k值，默认为5"""
+def match_top_k_in_query(query: str) -> Optional[int]:
+    """从用户查询中提取返回数量，问题中未指定时返回None"""
     # 转换为小写便于匹配
     query_lower = query.lower()
 
@@ -37,18 +90,80 @@ def extract_top_k_from_query(query: str) -> int:
                 return max(1, min(top_k, 50))
             except ValueError:
                 continue
-
-    # 默认返回5
-    return 5
-#-------------------------------定义变量---------------------------------
-query_top_k=5   #定义查询结果数量
+    return None
+def extract_top_k_from_query(query: str) -> int:
+    """从用户查询中提取top_k值，默认为5"""
+    top_k = match_top_k_in_query(query)
+    return 5 if top_k is None else top_k
+#-------------------------------请求上下文---------------------------------
+@dataclass(frozen=True)
+class QueryContext:
+    '''
+    单次请求的执行参数，随状态在图节点间传递，并发请求互不影响
+    '''
+    top_k: int = 5  #最多返回的记录数
+    limit_in_question: bool = False  #问题中是否指定了返回数量(如"前10名")，指定时导出结果保留该LIMIT
+    exec_mode: str = 'direct'  #执行模式：direct(直接执行，失败时Agent修正)/agent(全部交给Agent)
+    exec_timeout: float = 10  #直接执行SQL的超时时间(秒)
+    max_rows: int = 100  #直接执行SQL时最多返回的行数
+    model: str = 'qwen'  #settings.llm中的模型配置名
+    db_key: str = 'mysql'  #settings.db中的数据库配置名
+    use_cache: bool = True  #是否使用问题缓存
+    user: str = 'anonymous'  #发起查询的用户，用于并发查询数限制
+    candidates: int = 1  #并行生成的候选SQL数量，大于1时按试运行结果择优
+    debug: bool = False  #调试模式，流程结束后输出各阶段耗时及token用量
+    @property
+    def cache_namespace(self):
+        '''
+        问题缓存的命名空间：生成的SQL随数据库及返回数量(可由请求指定)变化
+        :return:
+        '''
+        return f'{self.db_key}:{self.top_k}'
+    @classmethod
+    def build(cls,user_query,**overrides):
+        '''
+        根据默认配置及请求参数构建上下文，未指定top_k时从问题中提取
+        :param user_query: 用户问题
+        :param overrides: 请求指定的参数，值为None的忽略
+        :return:
+        '''
+        config=settings.texttosql
+        ctx=cls(top_k=extract_top_k_from_query(user_query),
+                limit_in_question=match_top_k_in_query(user_query) is not None,
+                exec_mode=config['exec_mode'],
+                exec_timeout=config['exec_timeout'],
+                max_rows=config['max_result_rows'],
+                model=config['model'],
+                db_key=config['db'],
+                candidates=config['candidates'])
+        ctx=replace(ctx,**{k:v for k,v in overrides.items() if v is not None})
+        #请求只能选择允许的模型及数据库(settings.db中还有应用自身的账号库)
+        if ctx.model not in settings.llm or ctx.model not in (config['models'] or [config['model']]):
+            raise ValueError(f'不允许使用的模型：{ctx.model}')
+        if ctx.db_key not in settings.db or ctx.db_key not in (config['dbs'] or [config['db']]):
+            raise ValueError(f'不允许查询的数据库：{ctx.db_key}')
+        #请求指定的超时不能超过连接上的默认语句超时
+        return replace(ctx,exec_timeout=min(ctx.exec_timeout,config['statement_timeout']))
+    def export_sql(self,sql):
+        '''
+        结果导出登记的SQL：LIMIT来自提示词中"最多返回top_k条"的要求(而非问题本身)时去掉，
+        导出行数由result_stream['max_rows']限制
+        :param sql: 已校验的SQL
+        :return:
+        '''
+        if self.limit_in_question:
+            return sql
+        return drop_limit(sql,get_db(self.db_key).dialect,self.top_k)
 #------------------------------模板定义----------------------------------
+#固定的说明及表结构在前，随请求变化的内容(返回数量、用户问题)在后，
+#相同表结构的请求提示词前缀完全一致，可命中模型服务端的前缀缓存(prompt cache)
 sql_template='''
 你是专业的MySQL SQL生成专家
 你的责职如下：
    1:仅生成查询SQL语句，无额外解释；
-   2：表结构：{table_info}
-   3：严禁生成任何可以影响数据库数据内容或结构的sql
+   2：严禁生成任何可以影响数据库数据内容或结构的sql
+   3：表结构：
+{table_info}
    4：最多返回{top_k}条记录
    用户需求：{input}
 '''
@@ -66,37 +181,187 @@ sql_agent_template='''
     - 如果查询结果为空，请明确说明"未查询到符合条件的数据"
     - 返回结果要简洁明了
 '''
+summary_template='''
+你是数据分析助手，请根据查询结果用简洁的中文对结果进行总结描述，不要重复输出表格。
+用户需求：{input}
+执行的SQL：{sql}
+查询结果：
+{result}
+'''
 #-----------------------------定义查询链生成sql-----------------------------------
 sql_prompt=PromptTemplate(
     input_variables=['input','table_info','top_k'],
     template=sql_template,
 )
-sql_query_chain=create_sql_query_chain(llm=llm,db=db,prompt=sql_prompt,k=query_top_k)
+_chains={}  #(链名,model,db_key)->链
+def get_sql_query_chain(model=None,temperature=None):
+    '''
+    sql生成链
+    不使用create_sql_query_chain：其末尾的清理函数会聚合输出，无法逐token流式返回
+    :param model:
+    :param temperature: 覆盖模型默认温度(多候选生成时使用)
+    :return:
+    '''
+    model=model or settings.texttosql['model']
+    key=('sql',model,temperature)
+    if key not in _chains:
+        bind_kwargs={'stop':['\nSQLResult:']}
+        if temperature is not None:
+            bind_kwargs['temperature']=temperature
+        _chains[key]=sql_prompt|get_llm(model).bind(**bind_kwargs)|StrOutputParser()
+    return _chains[key]
+def prompt_prefix_hash(table_info:str)->str:
+    '''
+    sql生成提示词中固定前缀(说明+表结构)的哈希，哈希相同的请求可复用服务端的前缀缓存
+    :param table_info: 表结构
+    :return:
+    '''
+    prefix=sql_template.split('{top_k}')[0].replace('{table_info}',table_info)
+    return hashlib.sha256(prefix.encode('utf-8')).hexdigest()[:16]
+def clean_sql(text:str)->str:
+    '''
+    清理模型输出的SQL(去除代码块标记及SQLQuery前缀)
+    :param text:
+    :return:
+    '''
+    text=text.strip()
+    text=re.sub(r'^```(?:sql)?','',text,flags=re.IGNORECASE).strip()
+    text=re.sub(r'```$','',text).strip()
+    if text.upper().startswith('SQLQUERY:'):
+        text=text[len('SQLQuery:'):].strip()
+    return text
+#-----------------------------定义总结链(直接执行模式下总结查询结果)-----------------------------------
+summary_prompt=PromptTemplate(
+    input_variables=['input','sql','result'],
+    template=summary_template,
+)
+def get_summary_chain(model=None):
+    model=model or settings.texttosql['model']
+    key=('summary',model)
+    if key not in _chains:
+        _chains[key]=summary_prompt|get_llm(model)|StrOutputParser()
+    return _chains[key]
 #----------------------------定义sqlagent负责校验执行-------------------------------------------
-#Sql Toolkit +Agent (校验执行Sql)
-toolkit=SQLDatabaseToolkit(db=db,llm=llm)
-sql_exec_agent=create_sql_agent(llm=llm,
-                                toolkit=toolkit,
-                                agent_type=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
-                                verbose=False,
-                                handle_parsing_errors=True,
-                                max_iterations=5, #增加迭代次数，允许sqlagent修正sql
-                                return_intermediate_steps=True,
-                                #添加提示词
-                                prefix=sql_agent_template
- )
+def get_sql_exec_agent(model=None,db_key=None):
+    '''
+    Sql Toolkit +Agent (校验执行Sql)
+    :param model:
+    :param db_key:
+    :return:
+    '''
+    model=model or settings.texttosql['model']
+    db_key=db_key or settings.texttosql['db']
+    key=('agent',model,db_key)
+    if key not in _chains:
+        agent_llm=get_llm(model)
+        #Agent执行的查询同样经过成本保护
+        toolkit=GuardedSQLDatabaseToolkit(db=get_db(db_key),llm=agent_llm)
+        _chains[key]=create_sql_agent(llm=agent_llm,
+                                      toolkit=toolkit,
+                                      agent_type=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
+                                      verbose=False,
+                                      handle_parsing_errors=True,
+                                      max_iterations=5, #增加迭代次数，允许sqlagent修正sql
+                                      return_intermediate_steps=True,
+                                      #添加提示词
+                                      prefix=sql_agent_template
+         )
+    return _chains[key]
 #----------------------------定义状态图-----------------------------------------------------
 class GraphState(TypedDict):
     user_query:str  #用户查询的问题
-    generated_sql: Optional[str]  # query生成的SQL
+    context: QueryContext  # 请求上下文(top_k、超时、模型、数据库等)
+    table_names: Optional[List[str]]  # 选取的相关表，None表示全部表
+    table_info: Optional[str]  # 相关表的表结构
+    schema_tokens_saved: int  # 表选择节省的表结构token数(估算)
+    generated_sql: Optional[str]  # query生成的SQL(校验后已注入LIMIT)
+    export_sql: Optional[str]  # 校验通过的SQL(保持原有LIMIT，用于结果导出及缓存)
     sql_validation: bool  # SQL语法是否有效
     sql_error: Optional[str]  # SQL相关错误信息
+    sql_rejected: bool  # 查询成本超限被拒绝，不再重试
+    sql_plan: Optional[Dict]  # 候选SQL试运行的执行计划{'sql','plan'}，校验节点直接复用，不再EXPLAIN
     exec_result: Optional[Dict]  # Agent执行结果
     formatted_result: Optional[str]  # 格式化后的最终结果
     retry_count: int  # 重试次数
     streaming_queue: List[str]  # 流式消息队列
     streaming_progress: str  # 当前流式进度消息
+    trace: RequestTrace  # 请求耗时及token用量记录
 #----------------------------图节点处理--------------------------------------------------
+async def select_tables_node(state:GraphState):
+    '''
+    选取与问题相关的表
+    :param state:
+    :return:
+    '''
+    state["streaming_progress"] = "🔍 正在选取与问题相关的数据表..."
+    state["streaming_queue"].append(state["streaming_progress"])
+    yield state
+    ctx=state['context']
+    query_db=get_db(ctx.db_key)
+    compact=settings.texttosql['schema_format']=='compact'
+    get_schema=query_db.get_compact_schema if compact else query_db.get_table_info
+    with state['trace'].stage('db.schema'):
+        full_info=await run_blocking(get_schema)
+        table_names=await run_blocking(get_table_index(ctx.db_key).select,state['user_query'])
+        table_info=await run_blocking(get_schema,table_names) if table_names else full_info
+        #调试模式下对比未做表选择及精简的完整表结构(含抽样数据)
+        baseline_info=await run_blocking(query_db.get_table_info) if ctx.debug and compact else full_info
+    saved=estimate_tokens(full_info)-estimate_tokens(table_info)
+    state["table_names"]=table_names
+    state["table_info"]=table_info
+    state["schema_tokens_saved"]=saved
+    state['trace'].annotate(schema_format=settings.texttosql['schema_format'],
+                            schema_tokens=estimate_tokens(table_info),
+                            baseline_schema_tokens=estimate_tokens(baseline_info),
+                            prompt_prefix_hash=prompt_prefix_hash(table_info))
+    if table_names:
+        state["streaming_progress"] = f"✅ 已选取相关表：{', '.join(table_names)}，表结构约节省{saved}个token"
+    else:
+        state["streaming_progress"] = "✅ 使用全部数据表"
+    state["streaming_queue"].append(state["streaming_progress"])
+    yield state
+def normalize_sql(sql:str)->str:
+    '''
+    规范化SQL用于候选投票(忽略大小写、空白及末尾分号)
+    :param sql:
+    :return:
+    '''
+    return re.sub(r'\s+',' ',sql).strip().rstrip(';').strip().lower()
+def select_best_candidate(candidates):
+    '''
+    从候选SQL中择优：可执行的优先，其次按相同SQL的票数，再按EXPLAIN估算成本
+    :param candidates: [{'sql','ok','cost','error'}]
+    :return: 最优候选，全部不可执行时返回None
+    '''
+    valid=[c for c in candidates if c['ok']]
+    if not valid:
+        return None
+    votes=Counter(normalize_sql(c['sql']) for c in valid)
+    return min(valid,key=lambda c:(-votes[normalize_sql(c['sql'])],
+                                   c['cost'] if c['cost'] is not None else math.inf))
+async def generate_candidates(state:GraphState):
+    '''
+    以不同温度并行生成多个候选SQL，并行校验及EXPLAIN试运行
+    :param state:
+    :return: 候选列表
+    '''
+    ctx=state['context']
+    temperatures=settings.texttosql['candidate_temperatures']
+    inputs={'input':state['user_query']+'\nSQLQuery: ','table_info':state['table_info'],'top_k':ctx.top_k}
+    query_db=get_db(ctx.db_key)
+    async def one(index):
+        temperature=temperatures[index%len(temperatures)]
+        try:
+            sql=clean_sql(await get_sql_query_chain(ctx.model,temperature).ainvoke(inputs))
+        except Exception as e:
+            return {'sql':None,'ok':False,'cost':None,'error':f'生成失败：{e}','temperature':temperature}
+        check=await run_blocking(check_sql,ctx,sql,ctx.max_rows)
+        if not check.ok:
+            return {'sql':sql,'ok':False,'cost':None,'error':check.error,'temperature':temperature}
+        plan=await run_blocking(explain_sql,query_db,check.sql)
+        return {'sql':sql,'ok':plan['ok'],'cost':plan['cost'],'error':plan['error'],'temperature':temperature,
+                'plan':{'sql':check.sql,'plan':plan}}
+    return await asyncio.gather(*(one(i) for i in range(ctx.candidates)))
 async  def generate_sql_node(state:GraphState):
     '''
     生成sql
@@ -108,23 +373,56 @@ async  def generate_sql_node(state:GraphState):
     state["streaming_progress"] = "🔄 正在分析用户需求,生成相应的Sql查询..."
     state["streaming_queue"].append(state["streaming_progress"])
     yield state
+    ctx=state['context']
+    if ctx.candidates>1:
+        candidates=await generate_candidates(state)
+        best=select_best_candidate(candidates)
+        valid_count=sum(1 for c in candidates if c['ok'])
+        if best:
+            state["streaming_progress"] = f"✅ {len(candidates)}个候选SQL中{valid_count}个可执行，已选出最优SQL(估算成本{best['cost']})"
+            generated_sql=best['sql']
+        else:
+            #全部试运行失败，取第一个生成成功的候选交由执行阶段修正
+            generated_sql=next((c['sql'] for c in candidates if c['sql']),None)
+            state["streaming_progress"] = f"⚠️ {len(candidates)}个候选SQL均未通过试运行"
+        state["streaming_queue"].append(state["streaming_progress"])
+        state["generated_sql"] = generated_sql
+        state["sql_plan"] = best['plan'] if best else None
+        state["sql_validation"] = True
+        state["sql_error"] = None
+        yield state
+        return
     #生成 sql
-    top_k = extract_top_k_from_query(state["user_query"])
-    global query_top_k
-    query_top_k=top_k
-    sql=sql_query_chain.invoke({
-        'question':state['user_query'],
-            "table_info": db.get_table_info(),
-            "top_k": top_k
-    })
-    generated_sql=sql.strip()
+    writer=get_stream_writer()
+    sql=''
+    #重试时重新生成，通知前端清空上一次流式输出的SQL
+    writer({'type':'token','stage':'sql','content':'','reset':True})
+    async for token in get_sql_query_chain(ctx.model).astream({
+        'input':state['user_query']+'\nSQLQuery: ',
+            "table_info": state['table_info'],
+            "top_k": ctx.top_k
+    }):
+        sql+=token
+        writer({'type':'token','stage':'sql','content':token})
+    generated_sql=clean_sql(sql)
     state["streaming_progress"] = "✅ SQL生成完成"
     state["streaming_queue"].append(state["streaming_progress"])
     state["generated_sql"] = generated_sql
+    state["sql_plan"] = None
     state["sql_validation"] = True
     state["sql_error"] = None
     yield state
 
+def check_sql(ctx,sql,max_limit=None):
+    '''
+    语法树校验：只允许单条SELECT，对照缓存的表结构检查表和字段，按需注入LIMIT
+    :param ctx: 请求上下文
+    :param sql:
+    :param max_limit: 最大返回行数，为空时不注入LIMIT
+    :return: SqlCheck
+    '''
+    query_db=get_db(ctx.db_key)
+    return validate_select(sql,query_db.dialect,query_db.get_schema_columns(),max_limit)
 async def validate_sql_node(state:GraphState):
     '''
     校验sql的合法性
@@ -138,23 +436,43 @@ async def validate_sql_node(state:GraphState):
         yield state
         return
     state['streaming_progress']='正在校验sql语句的合规性'
-    sql=state['generated_sql'].upper().strip()
-    dangerous_keywords = ['INSERT', 'UPDATE', 'DELETE', 'DROP', 'CREATE', 'ALTER']
-    for keyword in dangerous_keywords:
-        if keyword in sql:
-            state["streaming_progress"] = f"❌ SQL包含危险操作：{keyword}"
-            state["streaming_queue"].append(state["streaming_progress"])
-            state["sql_validation"] = False
-            state["sql_error"] = f"SQL包含危险操作：{keyword}"
-            yield state
-            return
-    # 如果sql_validation尚未被设置为False（即没有危险操作），则校验通过
-    # 只有在校验状态不是True时才设置为通过，避免重复设置
-    if state['sql_validation'] != True:
-        state["streaming_progress"] = "✅ SQL语法校验通过"
-        state["sql_validation"] = True
+    ctx=state['context']
+    check=await run_blocking(check_sql,ctx,state['generated_sql'],ctx.max_rows)
+    if check.ok:
+        # 语法树校验通过后用EXPLAIN试运行，不存在的表/字段、语法错误在执行前即可发现
+        # 成本保护：估算扫描行数或成本超限时拒绝，或对可提前终止的查询收紧LIMIT(改写后重新EXPLAIN)
+        #候选SQL已试运行过时复用其执行计划
+        cached=state.get('sql_plan') or {}
+        plan=cached['plan'] if cached.get('sql')==check.sql else None
+        with state['trace'].stage('db.explain'):
+            guard,plan=await run_blocking(check_query_cost,get_db(ctx.db_key),check.sql,plan)
+        if not plan['ok']:
+            check.ok,check.error=False,f"SQL试运行失败：{plan['error']}"
+    if not check.ok:
+        state["streaming_progress"] = f"❌ {check.error}"
+        state["streaming_queue"].append(state["streaming_progress"])
+        state["sql_validation"] = False
+        state["sql_error"] = check.error
+        yield state
+        return
+    if guard.action=='reject':
+        state["streaming_progress"] = f"⛔ 查询被拒绝：{guard.reason}"
         state["streaming_queue"].append(state["streaming_progress"])
+        state["sql_validation"] = False
+        state["sql_rejected"] = True
+        state["trace"].outcome = 'rejected'
+        state["sql_error"] = f"查询代价过高：{guard.reason}"
         yield state
+        return
+    if guard.action=='rewrite':
+        state["streaming_queue"].append(f"⚠️ 查询代价过高：{guard.reason}")
+    state["generated_sql"] = guard.sql
+    state["export_sql"] = check.raw_sql if guard.action=='ok' else guard.sql
+    cost=f"，估算成本{plan['cost']}" if plan['cost'] is not None else ''
+    state["streaming_progress"] = f"✅ SQL校验通过(涉及表：{', '.join(check.tables)}{cost})"
+    state["sql_validation"] = True
+    state["streaming_queue"].append(state["streaming_progress"])
+    yield state
 async def execute_sql_node(state:GraphState):
     '''
     执行sql
@@ -173,12 +491,46 @@ async def execute_sql_node(state:GraphState):
     yield state
     state["streaming_progress"] = "🚀 正在执行SQL查询..."
     yield state
+    ctx=state['context']
+    direct_error=None
+    if ctx.exec_mode=='direct':
+        # 直接在连接池上执行，成功且有数据时不再调用Agent
+        sql=state['generated_sql']
+        try:
+            with state['trace'].stage('db.execute'):
+                columns,rows=await run_blocking(run_select,get_db(ctx.db_key),sql,ctx.max_rows,ctx.exec_timeout)
+        except Exception as e:
+            columns,rows=[],[]
+            direct_error=str(e)
+        if rows:
+            table=rows_to_markdown(columns,rows)
+            writer=get_stream_writer()
+            writer({'type':'token','stage':'summary','content':f"{table}\n\n"})
+            summary=''
+            async for token in get_summary_chain(ctx.model).astream({'input':state['user_query'],'sql':sql,'result':table}):
+                summary+=token
+                writer({'type':'token','stage':'summary','content':token})
+            state["streaming_progress"] = "✅ SQL查询完成"
+            state["streaming_queue"].append(state["streaming_progress"])
+            state["exec_result"] = {
+                "raw_output": f"{table}\n\n{summary.strip()}",
+                "intermediate": [],
+                "mode": "direct",
+                "sql": sql
+            }
+            state['sql_error']=None
+            yield state
+            return
+        state["streaming_progress"] = f"⚠️ 直接执行{'失败' if direct_error else '无数据'}，交由Agent修正SQL..."
+        state["streaming_queue"].append(state["streaming_progress"])
+        yield state
     # 使用Agent执行SQL，让Agent进行校准和结果解析
     sql_with_context = f"""
+            表结构：{state['table_info']}
             请检查执行以下SQL查询并返回结果：
             SQL: {state['generated_sql']}
             用户需求：{state['user_query']}
-            表结构：{db.get_table_info()}
+            直接执行结果：{direct_error or '无数据' if ctx.exec_mode=='direct' else '未执行'}
             要求：
             1：分析sql查询是否满足查询要求,如果不能满足查询需求，请修正 SQL
             2. 先检查SQL语法是否正确
@@ -186,7 +538,8 @@ async def execute_sql_node(state:GraphState):
             4.执行查询并获取结果
             5. 如果查询有误，请修正后重新执行
             """
-    exec_result=sql_exec_agent.invoke({'input':sql_with_context})
+    with state['trace'].stage('agent'):
+        exec_result=await stream_agent(get_sql_exec_agent(ctx.model,ctx.db_key),sql_with_context)
     # 提取Agent的输出结果
     if isinstance(exec_result, dict):
         output = exec_result.get("output", "")
@@ -194,16 +547,55 @@ async def execute_sql_node(state:GraphState):
     else:
         output = str(exec_result)
         intermediate_steps = []
+    state['trace'].record_agent(len(intermediate_steps))
     if not output or output.strip() == "":
         output = "未查询到符合条件的数据"
     state["streaming_progress"] = "✅ SQL查询完成"
     state["streaming_queue"].append(state["streaming_progress"])
     state["exec_result"] = {
         "raw_output": output,
-        "intermediate": intermediate_steps
+        "intermediate": intermediate_steps,
+        "mode": "agent"
     }
     state['sql_error']=None
     yield state
+class FinalAnswerFilter:
+    '''
+    ReAct Agent的输出包含Thought/Action等中间内容，只转发"Final Answer:"之后的token
+    '''
+    marker='Final Answer:'
+    def __init__(self):
+        self.buffers={}  #run_id->已接收的文本
+        self.started=set()  #已出现Final Answer的run_id
+    def feed(self,run_id,token):
+        if run_id in self.started:
+            return token
+        buffer=self.buffers.get(run_id,'')+token
+        self.buffers[run_id]=buffer
+        index=buffer.find(self.marker)
+        if index<0:
+            return ''
+        self.started.add(run_id)
+        return buffer[index+len(self.marker):].lstrip()
+async def stream_agent(sql_exec_agent,sql_with_context):
+    '''
+    通过astream_events执行Agent，实时转发最终答案的token
+    :param sql_exec_agent: Agent
+    :param sql_with_context: Agent输入
+    :return: Agent执行结果
+    '''
+    writer=get_stream_writer()
+    answer_filter=FinalAnswerFilter()
+    exec_result=None
+    async for agent_event in sql_exec_agent.astream_events({'input':sql_with_context},version='v2'):
+        kind=agent_event['event']
+        if kind=='on_chat_model_stream':
+            token=answer_filter.feed(agent_event['run_id'],agent_event['data']['chunk'].content or '')
+            if token:
+                writer({'type':'token','stage':'summary','content':token})
+        elif kind=='on_chain_end' and not agent_event.get('parent_ids'):
+            exec_result=agent_event['data'].get('output')
+    return exec_result
 async def format_result_node(state:GraphState):
     '''
     格式化结果
@@ -229,7 +621,7 @@ async def format_result_node(state:GraphState):
     # 分析Agent的响应，提取有用的信息
     if not raw_output or raw_output.strip() == "":
         result_text = "未查询到符合条件的数据"
-    elif "error" in raw_output.lower():
+    elif state["exec_result"].get("mode")!="direct" and "error" in raw_output.lower():
         result_text = f"查询出现错误：{raw_output}"
     else:
         # 清理和格式化Agent的输出
@@ -254,6 +646,7 @@ async def retry_generate_sql_node(state:GraphState):
     state["streaming_progress"] = f"🔄 第{state['retry_count'] + 1}次重试生成SQL..."
     state["streaming_queue"].append(state["streaming_progress"])
     state["retry_count"] = state["retry_count"] + 1
+    state["trace"].retries = state["retry_count"]
     state["generated_sql"] = None  # 清空原有SQL
     state["sql_validation"] = False
     yield state
@@ -266,21 +659,39 @@ async def sql_validate_route(state:GraphState):
     '''
     if state['sql_validation']==True:
         return 'execute_sql'
+    elif state.get('sql_rejected'):
+        return 'format_result'
     elif state['retry_count']<=2:
         return 'retry_generate_sql'
     return 'format_result'
 #----------------------------定义工作流-----------------------------------------------------
+def traced(name,node):
+    '''
+    记录节点耗时(Prometheus指标、OpenTelemetry span及请求耗时汇总)
+    :param name: 节点名
+    :param node: 节点函数
+    :return:
+    '''
+    async def wrapper(state:GraphState):
+        with state['trace'].stage(name):
+            async for item in node(state):
+                yield item
+    wrapper.__name__=node.__name__
+    return wrapper
 async def workflow():
     graph=StateGraph(GraphState)
     #添加处理节点
-    graph.add_node('generate_sql',generate_sql_node)
-    graph.add_node('validate_sql',validate_sql_node)
-    graph.add_node('retry_generate_sql',retry_generate_sql_node)
-    graph.add_node('execute_sql',execute_sql_node)
-    graph.add_node('format_result',format_result_node)
+    graph.add_node('select_tables',traced('select_tables',select_tables_node))
+    graph.add_node('generate_sql',traced('generate_sql',generate_sql_node))
+    graph.add_node('validate_sql',traced('validate_sql',validate_sql_node))
+    graph.add_node('retry_generate_sql',traced('retry_generate_sql',retry_generate_sql_node))
+    graph.add_node('execute_sql',traced('execute_sql',execute_sql_node))
+    graph.add_node('format_result',traced('format_result',format_result_node))
 
     #添加边
-    graph.add_edge(START,'generate_sql')
+    graph.add_edge(START,'select_tables')
+    # #选取相关表->生成sql
+    graph.add_edge('select_tables','generate_sql')
 
     # #生成sql->检验sql
     graph.add_edge('generate_sql','validate_sql')
@@ -295,39 +706,228 @@ async def workflow():
     # #格式化结果->结束
     graph.add_edge('format_result',END)
     return graph.compile()
+#----------------------------工作流注册表-----------------------------------------------------
+#进程内只编译一次工作流，所有请求复用同一个已编译的图
+graph_builders={
+    'text-to-sql':workflow,
+}
+_compiled_graphs={}  #name->已编译的图
+graph_stats={}  #name->{'build_seconds':编译耗时,'built_at':编译时间,'reuse_count':复用次数}
+_graph_lock=asyncio.Lock()
+async def _build_graph(name):
+    '''
+    编译工作流并记录编译耗时
+    :param name: 工作流名称
+    :return:
+    '''
+    start=time.perf_counter()
+    graph=await graph_builders[name]()
+    _compiled_graphs[name]=graph
+    graph_stats[name]={
+        'build_seconds':round(time.perf_counter()-start,4),
+        'built_at':time.strftime('%Y-%m-%d %H:%M:%S'),
+        'reuse_count':0
+    }
+    return graph
+async def get_workflow(name='text-to-sql'):
+    '''
+    获取已编译的工作流，未编译时编译一次并缓存
+    :param name: 工作流名称
+    :return:
+    '''
+    graph=_compiled_graphs.get(name)
+    if graph is None:
+        async with _graph_lock:
+            graph=_compiled_graphs.get(name)
+            if graph is None:
+                return await _build_graph(name)
+    graph_stats[name]['reuse_count']+=1
+    return graph
+async def warmup_workflows():
+    '''
+    应用启动时预编译所有工作流
+    :return:
+    '''
+    for name in graph_builders:
+        await get_workflow(name)
+def get_workflow_stats():
+    '''
+    工作流编译耗时及复用次数
+    :return:
+    '''
+    return {name:dict(stats) for name,stats in graph_stats.items()}
+def invalidate_schema_cache(db_key=None):
+    '''
+    手动失效表结构缓存(如执行DDL后)
+    :param db_key: 数据库配置名，为空时失效全部数据库
+    :return:
+    '''
+    for key,query_db in _databases.items():
+        if db_key is None or key==db_key:
+            query_db.invalidate()
+def get_schema_cache_stats():
+    '''
+    各数据库表结构缓存命中统计
+    :return:
+    '''
+    return {key:query_db.get_cache_stats() for key,query_db in _databases.items()}
+#----------------------------问题缓存-----------------------------------------------------
+def extract_final_sql(state):
+    '''
+    提取最终执行成功的SQL：优先取Agent最后一次成功执行的sql_db_query，否则取生成的SQL
+    :param state: execute_sql节点输出的状态
+    :return:
+    '''
+    exec_result=state.get('exec_result') or {}
+    if exec_result.get('mode')=='direct':
+        return state.get('export_sql') or exec_result.get('sql')
+    for action,observation in reversed(exec_result.get('intermediate') or []):
+        if getattr(action,'tool',None)!='sql_db_query':
+            continue
+        if str(observation).startswith('Error'):
+            return None
+        tool_input=action.tool_input
+        if isinstance(tool_input,dict):
+            tool_input=tool_input.get('query')
+        return tool_input
+    return state.get('generated_sql')
+async def cached_sql_query(ctx,hit,trace):
+    '''
+    命中缓存：跳过LLM，直接执行缓存的SQL
+    :param ctx: 请求上下文
+    :param hit: 缓存命中信息
+    :param trace: 请求耗时记录
+    :return:
+    '''
+    tier={'exact':'精确','shared':'共享'}.get(hit['tier']) or f"语义(相似度{hit['score']})"
+    yield event('progress',f"⚡ 命中{tier}缓存，跳过SQL生成")
+    yield event('sql',hit['sql'])
+    #缓存的SQL同样校验(表结构可能已变化)，并注入LIMIT
+    check=await run_blocking(check_sql,ctx,hit['sql'],ctx.max_rows)
+    if not check.ok:
+        raise ValueError(check.error)
+    #数据量变化后缓存的SQL可能不再满足成本限制
+    with trace.stage('db.explain'):
+        guard,_=await run_blocking(check_query_cost,get_db(ctx.db_key),check.sql)
+    if guard.action=='reject':
+        raise ValueError(f"查询代价过高：{guard.reason}")
+    if guard.action=='rewrite':
+        yield event('progress',f"⚠️ 查询代价过高：{guard.reason}")
+    yield event('progress','🚀 正在执行SQL查询...')
+    with trace.stage('db.execute'):
+        columns,rows=await run_blocking(run_select,get_db(ctx.db_key),guard.sql,ctx.max_rows,ctx.exec_timeout)
+    yield event('progress',"✅ SQL查询完成")
+    yield event('result',f"""### 🎯 查询结果
+{rows_to_markdown(columns,rows)}
+""")
+    export_sql=ctx.export_sql(check.raw_sql) if guard.action=='ok' else guard.sql
+    yield event('query_id',approved_queries.register(export_sql,ctx.db_key))
+def get_answer_cache_stats():
+    '''
+    问题缓存命中率
+    :return:
+    '''
+    return answer_cache.get_stats()
 #----------------------------查询接口------------------------------------------------
-async  def stream_sql_query(user_query):
+def event(type,content,**extra):
     '''
-    调用工作流进行查询处理
+    流式输出事件
+    :param type: progress(进度)/sql(生成的SQL)/token(模型输出的token)/result(最终结果)/query_id(可导出结果的查询id)/timing(调试模式下的耗时汇总)/error/done
+    :param content: 内容
     :return:
     '''
-    # user_query='查询市盈率（TTM）大于 30 的股票名称、市盈率、持仓机构名称、持仓占比及持仓成本，按市盈率降序排序。查找前20条数据'
-    yield f'开始处理,用户问题：{user_query}\n'
-    yield '-'*50+'\n'
+    return {'type':type,'content':content,**extra}
+async  def stream_sql_query(user_query,context:Optional[QueryContext]=None):
+    '''
+    调用工作流进行查询处理
+    :param user_query: 用户问题
+    :param context: 请求上下文，为空时使用默认配置
+    :return: 事件字典，见event
+    '''
+    ctx=context or QueryContext.build(user_query)
+    trace=RequestTrace(db=ctx.db_key,model=ctx.model,exec_mode=ctx.exec_mode)
+    yield event('progress',f'开始处理,用户问题：{user_query}')
+    #限制每个用户同时执行的查询数
+    if not await user_limiter.acquire(ctx.user):
+        trace.finish('throttled')
+        yield event('error',f"⛔ 当前用户同时执行的查询已达上限({user_limiter.max_concurrent})，请稍后再试")
+        return
+    try:
+        async for chunk in run_sql_query(user_query,ctx,trace):
+            if chunk['type']=='error':
+                trace.outcome='error'
+            #调试模式下在结束(或出错)事件前输出耗时汇总
+            if chunk['type'] in ('done','error') and ctx.debug:
+                yield event('timing',trace.summary())
+            yield chunk
+    finally:
+        trace.finish()
+        await user_limiter.release(ctx.user)
+async def run_sql_query(user_query,ctx:QueryContext,trace:Optional[RequestTrace]=None):
+    '''
+    执行查询流程(缓存命中时直接执行缓存的SQL，否则执行工作流)
+    :param user_query: 用户问题
+    :param ctx: 请求上下文
+    :param trace: 请求耗时记录
+    :return: 事件字典，见event
+    '''
+    trace=trace or RequestTrace()
+    with trace.stage('cache.lookup'):
+        hit=await run_blocking(answer_cache.lookup,user_query,ctx.cache_namespace) if ctx.use_cache else None
+        if ctx.use_cache and not hit:
+            hit=await answer_cache.shared_lookup(user_query,ctx.cache_namespace)
+    if hit:
+        try:
+            async for chunk in cached_sql_query(ctx,hit,trace):
+                yield chunk
+            trace.outcome='cache_hit'
+            yield event('done',"工作流执行完成。")
+            return
+        except Exception as e:
+            #缓存的SQL执行失败(如表结构已变化)，删除缓存后走完整流程
+            answer_cache.evict(hit['question'],ctx.cache_namespace)
+            await answer_cache.shared_evict(hit['question'],ctx.cache_namespace)
+            yield event('progress',f"缓存的SQL执行失败({e})，重新生成SQL")
     sqlflag=False
-    graph_agent=await workflow()
-    yield "工作流已编译完成，开始流程任务\n"
+    final_sql=None
+    final_direct=False  #直接执行的SQL已在校验节点经过成本保护
+    graph_agent=await get_workflow('text-to-sql')
+    stats=graph_stats['text-to-sql']
+    yield event('progress',f"工作流已就绪(编译耗时{stats['build_seconds']}s，已复用{stats['reuse_count']}次)，开始流程任务")
     
     #初始状态
     current_state = {
         "user_query": user_query,
+        "context": ctx,
+        "table_names": None,
+        "table_info": None,
+        "schema_tokens_saved": 0,
         "generated_sql": None,
+        "export_sql": None,
         "sql_validation": None,
         "sql_error": None,
+        "sql_rejected": False,
+        "sql_plan": None,
         "exec_result": None,
         "formatted_result": None,
         "retry_count": 0,
         "streaming_queue": [],
-        "streaming_progress": ""
+        "streaming_progress": "",
+        "trace": trace
     }
     
     # 用于跟踪已经输出过的消息，防止重复输出
     previous_progress = set()
     
-    # 处理工作流的流式输出
-    yield "开始执行工作流...\n"
+    # 处理工作流的流式输出：updates为节点状态，custom为节点内转发的模型token
     try:
-        async for state in graph_agent.astream(current_state, stream_mode="updates"):
+        #回调随配置传递到节点内的链及Agent，记录每次LLM调用的耗时及token用量
+        async for mode,state in graph_agent.astream(current_state,
+                                                    config={'callbacks':[TraceCallbackHandler(trace)]},
+                                                    stream_mode=["updates","custom"]):
+            if mode=='custom':
+                yield state
+                continue
             for node_name, node_states in state.items():
                 if isinstance(node_states, dict) and node_states.get("streaming_progress"):
                     if  node_states.get("streaming_queue"):
@@ -335,12 +935,15 @@ async  def stream_sql_query(user_query):
                         for item_node_state in all_node_state:
                             # 只输出之前没有输出过的消息
                             if item_node_state not in previous_progress:
-                                yield item_node_state
+                                yield event('progress',item_node_state)
                                 previous_progress.add(item_node_state)
+                if node_name=='execute_sql' and isinstance(node_states, dict) and node_states.get('exec_result'):
+                    final_sql=extract_final_sql(node_states)
+                    final_direct=node_states['exec_result'].get('mode')=='direct'
                 if sqlflag==False:
                     if isinstance(node_states, dict):
                         if node_states.get('generated_sql'):
-                            yield f"首次生成的SQL: {node_states.get('generated_sql')}\n"
+                            yield event('sql',node_states.get('generated_sql'))
                             sqlflag=True
             # 获取格式化结果
             format_result = None
@@ -350,12 +953,25 @@ async  def stream_sql_query(user_query):
                 format_result = state.get('formatted_result')
                 
             if format_result:
-                yield f"{format_result}\n"
-        yield "工作流执行完成。\n"
+                yield event('result',format_result)
+        #Agent修正后的SQL未经过校验节点，登记前再次校验
+        check=await run_blocking(check_sql,ctx,final_sql) if final_sql else None
+        export_sql=check.raw_sql if check and check.ok else None
+        if export_sql and not final_direct:
+            #Agent修正的SQL按导出时的完整SQL检查成本，超限时只登记改写后的SQL或不登记
+            guard,_=await run_blocking(check_query_cost,get_db(ctx.db_key),export_sql)
+            export_sql=None if guard.action=='reject' else guard.sql
+        if export_sql:
+            #登记执行成功的SQL，可通过结果接口导出完整结果
+            yield event('query_id',approved_queries.register(ctx.export_sql(export_sql),ctx.db_key))
+            if ctx.use_cache:
+                await run_blocking(answer_cache.store,user_query,export_sql,ctx.cache_namespace)
+                await answer_cache.shared_store(user_query,export_sql,ctx.cache_namespace)
+        yield event('done',"工作流执行完成。")
     except Exception as e:
         import traceback
         msg=traceback.format_exc()
-        yield f"工作流执行出错: {msg}\n"
+        yield event('error',f"工作流执行出错: {msg}")
 
 # async def main():
 #     async for chunk in stream_sql_query():
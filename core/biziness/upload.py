@@ -0,0 +1,374 @@
+"""
+文件上传
+分块流式写入磁盘(写入及哈希计算放到线程池)，边写边校验大小并增量计算SHA256，内存占用与文件大小无关；
+大文件支持分片断点续传：创建会话后按偏移量逐片上传，中断后查询已接收的偏移量继续上传；
+文件按内容寻址保存(uploads/objects/前两位/次两位/sha256.扩展名)，相同内容只保存一份，
+元数据及下游产物(解析、切片、向量化)登记在PostgreSQL，重复上传时直接复用
+"""
+import asyncio
+import json
+import os
+import re
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, Optional
+
+from core.dataaccess.orm.Upload import UploadInfo
+
+import settings
+from utils.asyncutils import run_blocking
+from utils.utils import Sha256Stream, sha256_file
+
+
+class UploadError(Exception):
+    def __init__(self, message: str, status_code: int = 400, **extra):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.extra = extra
+
+
+@dataclass
+class StoredFile:
+    filename: str  #原始文件名
+    file_path: str  #保存路径
+    size: int
+    sha256: str
+    ext: str
+    duplicate: bool = False  #内容已存在，未重复保存
+    artifacts: dict = field(default_factory=dict)  #可复用的下游产物
+
+
+def check_extension(filename: str) -> str:
+    '''
+    校验文件类型
+    :param filename:
+    :return: 小写扩展名
+    '''
+    ext = os.path.splitext(filename or '')[1].lower()
+    allowed = settings.upload['allowed_extensions']
+    if ext not in allowed:
+        raise UploadError(f"不支持的文件类型。支持的格式: {', '.join(allowed)}")
+    return ext
+
+
+def _partial_dir() -> str:
+    path = os.path.join(settings.upload['dir'], '.partial')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+_upload_info = None
+
+
+def get_upload_info() -> UploadInfo:
+    global _upload_info
+    if _upload_info is None:
+        _upload_info = UploadInfo()
+    return _upload_info
+
+
+def object_path(sha256: str, ext: str) -> str:
+    '''
+    内容寻址的保存路径
+    :param sha256:
+    :param ext: 扩展名
+    :return:
+    '''
+    return os.path.join(settings.upload['dir'], 'objects', sha256[:2], sha256[2:4], f'{sha256}{ext}')
+
+
+def artifact_dir(sha256: str) -> str:
+    '''
+    文件内容的下游产物(解析结果、切片、向量)保存目录
+    :param sha256:
+    :return:
+    '''
+    return os.path.join(settings.upload['dir'], 'artifacts', sha256[:2], sha256[2:4], sha256)
+
+
+def _register(filename: str, size: int, sha256: str, ext: str, file_path: str, uploaded_by: Optional[str],
+              duplicate: bool) -> StoredFile:
+    info = get_upload_info().add_upload(sha256, size, ext, file_path, filename, uploaded_by)
+    return StoredFile(filename=filename, file_path=info['storage_path'], size=size, sha256=sha256, ext=ext,
+                      duplicate=duplicate, artifacts=info['artifacts'])
+
+
+def _store(tmp_path: str, filename: str, size: int, sha256: str, ext: str,
+           uploaded_by: Optional[str] = None) -> StoredFile:
+    '''
+    将写完的临时文件按内容保存，内容已存在时丢弃临时文件
+    保存路径带扩展名(解析时按扩展名选择解析器)，相同内容以其他扩展名上传时沿用已登记的路径
+    :return:
+    '''
+    existing = get_upload_info().get_object(sha256)
+    file_path = existing['storage_path'] if existing else object_path(sha256, ext)
+    duplicate = os.path.exists(file_path)
+    if duplicate:
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        #同一文件系统内rename为原子操作，并发上传相同内容时结果一致
+        os.replace(tmp_path, file_path)
+    stored = _register(filename, size, sha256, ext, file_path, uploaded_by, duplicate)
+    if not duplicate and stored.file_path != file_path:
+        #并发上传的相同内容(扩展名不同)已先登记了其他路径，删除本次写入的副本
+        os.remove(file_path)
+        stored.duplicate = True
+    return stored
+
+
+def _append(f, hasher: Optional[Sha256Stream], chunk: bytes):
+    f.write(chunk)
+    if hasher is not None:
+        hasher.update(chunk)
+
+
+def check_content_length(length: Optional[str], overhead: int = 64 * 1024):
+    '''
+    按Content-Length预先拒绝超过大小限制的请求，不读取请求体
+    :param length: Content-Length请求头，分块传输时为空(由save_stream边写边校验)
+    :param overhead: multipart边界及字段头的余量
+    :return:
+    '''
+    max_size = settings.upload['max_size']
+    if length and length.isdigit() and int(length) > max_size + overhead:
+        raise UploadError(f'文件大小不能超过{max_size // 1024 // 1024}MB', 413)
+
+
+async def iter_multipart_file(content_type: str, stream: AsyncIterator[bytes], field_name: str = 'file') -> AsyncIterator:
+    '''
+    流式解析multipart/form-data请求体中的文件字段，不经过Starlette的表单解析(会先把整个文件写入临时文件)
+    第一次产出文件名，之后产出文件内容块
+    :param content_type: Content-Type请求头
+    :param stream: request.stream()
+    :param field_name: 文件字段名
+    :return:
+    '''
+    try:
+        from python_multipart.multipart import MultipartParser, parse_options_header
+    except ImportError:
+        from multipart.multipart import MultipartParser, parse_options_header
+    media_type, options = parse_options_header(content_type)
+    if media_type != b'multipart/form-data' or not options.get(b'boundary'):
+        raise UploadError('请求须为multipart/form-data格式')
+    state = {'header_field': b'', 'header_value': b'', 'headers': {}, 'target': False, 'filename': None}
+    data = []
+
+    def on_part_begin():
+        state['headers'] = {}
+
+    def on_header_field(buf, start, end):
+        state['header_field'] += buf[start:end]
+
+    def on_header_value(buf, start, end):
+        state['header_value'] += buf[start:end]
+
+    def on_header_end():
+        state['headers'][state['header_field'].lower()] = state['header_value']
+        state['header_field'] = state['header_value'] = b''
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(state['headers'].get(b'content-disposition', b''))
+        #只取第一个文件字段
+        state['target'] = state['filename'] is None and disposition.get(b'name') == field_name.encode() \
+            and b'filename' in disposition
+        if state['target']:
+            state['filename'] = disposition[b'filename'].decode('utf-8', 'replace')
+
+    def on_part_data(buf, start, end):
+        if state['target']:
+            data.append(buf[start:end])
+
+    def on_part_end():
+        state['target'] = False
+
+    parser = MultipartParser(options[b'boundary'], {
+        'on_part_begin': on_part_begin, 'on_header_field': on_header_field, 'on_header_value': on_header_value,
+        'on_header_end': on_header_end, 'on_headers_finished': on_headers_finished,
+        'on_part_data': on_part_data, 'on_part_end': on_part_end})
+    sent_filename = False
+    async for chunk in stream:
+        parser.write(chunk)
+        if state['filename'] is not None and not sent_filename:
+            sent_filename = True
+            yield state['filename']
+        if data:
+            yield b''.join(data)
+            data.clear()
+    parser.finalize()
+    if not sent_filename:
+        raise UploadError('缺少上传文件')
+
+
+async def save_stream(chunks: AsyncIterator[bytes], filename: str, max_size: Optional[int] = None,
+                      uploaded_by: Optional[str] = None) -> StoredFile:
+    '''
+    流式保存上传文件，超过大小限制时立即中止并删除已写入的部分
+    :param chunks: 文件内容块
+    :param filename: 原始文件名
+    :param max_size: 最大字节数，默认settings.upload['max_size']
+    :param uploaded_by: 上传用户
+    :return:
+    '''
+    ext = check_extension(filename)
+    max_size = max_size or settings.upload['max_size']
+    tmp_path = os.path.join(_partial_dir(), f'{uuid.uuid4().hex}.part')
+    hasher = Sha256Stream()
+    f = await run_blocking(open, tmp_path, 'wb')
+    try:
+        async for chunk in chunks:
+            if hasher.size + len(chunk) > max_size:
+                raise UploadError(f'文件大小不能超过{max_size // 1024 // 1024}MB', 413)
+            await run_blocking(_append, f, hasher, chunk)
+        await run_blocking(f.close)
+    except BaseException:
+        await run_blocking(f.close)
+        if os.path.exists(tmp_path):
+            await run_blocking(os.remove, tmp_path)
+        raise
+    return await run_blocking(_store, tmp_path, filename, hasher.size, hasher.hexdigest(), ext, uploaded_by)
+
+
+class UploadSessions:
+    """
+    分片上传会话
+    会话信息及已接收的数据保存在上传目录的.partial下，服务重启后仍可续传；
+    已接收的字节数以磁盘上的文件大小为准
+    """
+    _id_pattern = re.compile(r'^[0-9a-f]{32}$')
+
+    def __init__(self):
+        self._hashers: Dict[str, Sha256Stream] = {}  #upload_id->顺序写入时的增量哈希
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _paths(self, upload_id: str):
+        if not self._id_pattern.match(upload_id or ''):
+            raise UploadError('上传会话不存在', 404)
+        base = os.path.join(_partial_dir(), upload_id)
+        return f'{base}.json', f'{base}.part'
+
+    def _lock(self, upload_id: str) -> asyncio.Lock:
+        return self._locks.setdefault(upload_id, asyncio.Lock())
+
+    def create(self, filename: str, size: int, sha256: Optional[str] = None, uploaded_by: Optional[str] = None) -> dict:
+        '''
+        创建会话
+        :param filename: 原始文件名
+        :param size: 文件总字节数
+        :param sha256: 客户端计算的摘要，完成时校验
+        :param uploaded_by: 上传用户
+        :return: 会话信息
+        '''
+        self.cleanup()
+        ext = check_extension(filename)
+        max_size = settings.upload['max_size']
+        if size <= 0 or size > max_size:
+            raise UploadError(f'文件大小不能超过{max_size // 1024 // 1024}MB', 413)
+        upload_id = uuid.uuid4().hex
+        meta_path, data_path = self._paths(upload_id)
+        meta = {'upload_id': upload_id, 'filename': filename, 'ext': ext, 'size': size,
+                'sha256': sha256.lower() if sha256 else None, 'uploaded_by': uploaded_by, 'created': time.time()}
+        open(data_path, 'wb').close()
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        self._hashers[upload_id] = Sha256Stream()
+        return dict(meta, offset=0, chunk_size=settings.upload['session_chunk_size'])
+
+    def get(self, upload_id: str) -> dict:
+        '''
+        会话信息，offset为已接收的字节数(续传的起始位置)
+        :param upload_id:
+        :return:
+        '''
+        meta_path, data_path = self._paths(upload_id)
+        if not os.path.exists(meta_path):
+            raise UploadError('上传会话不存在或已过期', 404)
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        return dict(meta, offset=os.path.getsize(data_path), chunk_size=settings.upload['session_chunk_size'])
+
+    async def append(self, upload_id: str, offset: int, chunks: AsyncIterator[bytes]) -> dict:
+        '''
+        从offset处追加一个分片
+        :param upload_id:
+        :param offset: 分片在文件中的起始位置，必须等于已接收的字节数
+        :param chunks: 分片内容
+        :return: 会话信息
+        '''
+        async with self._lock(upload_id):
+            meta = await run_blocking(self.get, upload_id)
+            if offset != meta['offset']:
+                raise UploadError('分片偏移量与已接收的字节数不一致', 409, offset=meta['offset'])
+            _, data_path = self._paths(upload_id)
+            hasher = self._hashers.get(upload_id)
+            if hasher is not None and hasher.size != offset:
+                #写入中断后增量哈希与文件不一致，不再增量计算，完成时按文件重新计算
+                self._hashers.pop(upload_id)
+                hasher = None
+            received = offset
+            f = await run_blocking(open, data_path, 'ab')
+            try:
+                async for chunk in chunks:
+                    if received + len(chunk) > meta['size']:
+                        raise UploadError('上传的数据超过声明的文件大小', 413, offset=received)
+                    await run_blocking(_append, f, hasher, chunk)
+                    received += len(chunk)
+            finally:
+                await run_blocking(f.close)
+            return dict(meta, offset=received)
+
+    async def complete(self, upload_id: str) -> StoredFile:
+        '''
+        完成上传：校验大小及摘要后移动到上传目录
+        :param upload_id:
+        :return:
+        '''
+        async with self._lock(upload_id):
+            meta = await run_blocking(self.get, upload_id)
+            if meta['offset'] != meta['size']:
+                raise UploadError('文件尚未上传完成', 409, offset=meta['offset'])
+            meta_path, data_path = self._paths(upload_id)
+            hasher = self._hashers.pop(upload_id, None)
+            if hasher is not None and hasher.size == meta['size']:
+                sha256 = hasher.hexdigest()
+            else:
+                sha256 = await run_blocking(sha256_file, data_path, settings.upload['chunk_size'])
+            if meta['sha256'] and meta['sha256'] != sha256:
+                await run_blocking(self.discard, upload_id)
+                raise UploadError('文件摘要校验失败，请重新上传', 422)
+            stored = await run_blocking(_store, data_path, meta['filename'], meta['size'], sha256, meta['ext'],
+                                        meta.get('uploaded_by'))
+            await run_blocking(os.remove, meta_path)
+        self._locks.pop(upload_id, None)
+        return stored
+
+    def discard(self, upload_id: str):
+        '''
+        删除会话及已接收的数据
+        :param upload_id:
+        :return:
+        '''
+        self._hashers.pop(upload_id, None)
+        for path in self._paths(upload_id):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def cleanup(self):
+        '''
+        清理超过有效期未再上传数据的会话
+        :return:
+        '''
+        now = time.time()
+        for name in os.listdir(_partial_dir()):
+            upload_id, ext = os.path.splitext(name)
+            if ext != '.json' or not self._id_pattern.match(upload_id):
+                continue
+            meta_path, data_path = self._paths(upload_id)
+            active = os.path.getmtime(data_path if os.path.exists(data_path) else meta_path)
+            if now - active > settings.upload['session_ttl']:
+                self.discard(upload_id)
+
+
+upload_sessions = UploadSessions()
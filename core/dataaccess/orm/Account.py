@@ -1,18 +1,19 @@
-from sqlalchemy.orm import  sessionmaker
-from core.dataaccess.orm.db_engine import create_database_engine
+from sqlalchemy import select
+from core.dataaccess.orm.db_engine import get_async_sessionmaker
 from core.dataaccess.orm.models import User
 class AccountInfo:
-    def __init__(self):
-        engine =create_database_engine()
-        self.Session = sessionmaker(bind=engine)
-    def auth_user(self,user,pwd)->bool:
+    def __init__(self,db_key:str='pg'):
+        self.db_key=db_key
+    async def auth_user(self,user,pwd,session=None)->bool:
         '''
         验证是否为有效用户
         :param user:
         :param pwd:
+        :param session: 请求级的异步会话(db_engine.get_async_session)，为空时从共享的会话工厂新建
         :return:
         '''
-        user = self.Session.query(User).filter((User.username==user)|(User.email==user),User.password_hash==pwd).first()
-        if user:
-            return True
-        return False
\ No newline at end of file
+        if session is None:
+            async with get_async_sessionmaker(self.db_key)() as session:
+                return await self.auth_user(user,pwd,session)
+        result=await session.execute(select(User.id).where((User.username==user)|(User.email==user),User.password_hash==pwd).limit(1))
+        return result.first() is not None
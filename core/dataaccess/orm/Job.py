@@ -0,0 +1,60 @@
+import time
+from typing import List, Optional
+from core.dataaccess.orm.db_engine import get_sessionmaker
+from core.dataaccess.orm.models import IngestJob
+_FIELDS=('id','stage','status','priority','payload','result','attempts','progress','message','error',
+         'available_at','created_at','updated_at')
+class JobInfo:
+    '''
+    文档入库任务表，供数据库任务队列使用
+    '''
+    def __init__(self):
+        self.Session=get_sessionmaker()
+    @staticmethod
+    def _to_dict(obj:IngestJob)->dict:
+        return {name:getattr(obj,name) for name in _FIELDS}
+    def save(self,job:dict)->None:
+        '''
+        新增或更新任务
+        :param job: 任务字段
+        :return:
+        '''
+        with self.Session() as session:
+            session.merge(IngestJob(**{name:job.get(name) for name in _FIELDS}))
+            session.commit()
+    def get(self,job_id:str)->Optional[dict]:
+        with self.Session() as session:
+            obj=session.get(IngestJob,job_id)
+            return self._to_dict(obj) if obj else None
+    def claim(self,stage:str,batch:int=5)->Optional[dict]:
+        '''
+        领取阶段中优先级最高的可执行任务
+        先查询候选再按状态条件更新，更新成功才算领取，多个工作进程并发领取时不会重复
+        :param stage: 阶段名
+        :param batch: 每次查询的候选数
+        :return: 没有可执行的任务返回None
+        '''
+        now=time.time()
+        with self.Session() as session:
+            candidates=session.query(IngestJob.id).filter(IngestJob.stage==stage,IngestJob.status=='queued',
+                IngestJob.available_at<=now).order_by(IngestJob.priority.desc(),IngestJob.created_at).limit(batch).all()
+            for (job_id,) in candidates:
+                claimed=session.query(IngestJob).filter(IngestJob.id==job_id,IngestJob.status=='queued',
+                    IngestJob.stage==stage).update({'status':'running','updated_at':now},synchronize_session=False)
+                session.commit()
+                if claimed:
+                    return self._to_dict(session.get(IngestJob,job_id))
+        return None
+    def recent(self,limit:int=50)->List[dict]:
+        with self.Session() as session:
+            rows=session.query(IngestJob).order_by(IngestJob.created_at.desc()).limit(limit).all()
+            return [self._to_dict(obj) for obj in rows]
+    def stale(self,before:float)->List[dict]:
+        '''
+        超过指定时间未更新的运行中任务(工作进程已退出)
+        :param before: Unix时间戳
+        :return:
+        '''
+        with self.Session() as session:
+            rows=session.query(IngestJob).filter(IngestJob.status=='running',IngestJob.updated_at<before).all()
+            return [self._to_dict(obj) for obj in rows]
@@ -0,0 +1,77 @@
+from typing import Optional
+from sqlalchemy.exc import IntegrityError
+from core.dataaccess.orm.db_engine import get_sessionmaker
+from core.dataaccess.orm.models import UploadObject, UploadRecord
+class UploadInfo:
+    '''
+    上传文件元数据：按SHA256去重的文件内容及每次上传的记录
+    '''
+    def __init__(self):
+        self.Session=get_sessionmaker()
+    @staticmethod
+    def _to_dict(obj:UploadObject)->dict:
+        return {'sha256':obj.sha256,'size':obj.size,'ext':obj.ext,'storage_path':obj.storage_path,
+                'artifacts':dict(obj.artifacts or {}),'upload_count':obj.upload_count}
+    def get_object(self,sha256:str)->Optional[dict]:
+        '''
+        查询文件内容
+        :param sha256:
+        :return: 不存在返回None
+        '''
+        with self.Session() as session:
+            obj=session.query(UploadObject).filter_by(sha256=sha256).first()
+            return self._to_dict(obj) if obj else None
+    def add_upload(self,sha256:str,size:int,ext:str,storage_path:str,filename:str,uploaded_by:Optional[str]=None)->dict:
+        '''
+        登记一次上传，文件内容不存在时一并登记
+        :param sha256:
+        :param size:
+        :param ext:
+        :param storage_path: 内容寻址的保存路径
+        :param filename: 原始文件名
+        :param uploaded_by: 上传用户
+        :return: 文件内容信息
+        '''
+        with self.Session() as session:
+            obj=session.query(UploadObject).filter_by(sha256=sha256).with_for_update().first()
+            if obj is None:
+                try:
+                    obj=UploadObject(sha256=sha256,size=size,ext=ext,storage_path=storage_path,artifacts={},upload_count=0)
+                    session.add(obj)
+                    session.flush()
+                except IntegrityError:
+                    #并发上传相同内容，已由其他请求登记
+                    session.rollback()
+                    obj=session.query(UploadObject).filter_by(sha256=sha256).with_for_update().one()
+            obj.upload_count+=1
+            session.add(UploadRecord(object_id=obj.id,filename=filename,uploaded_by=uploaded_by))
+            session.commit()
+            return self._to_dict(obj)
+    def get_artifacts(self,sha256:str)->dict:
+        '''
+        文件内容的下游产物(解析、切片、向量化等)
+        :param sha256:
+        :return: 阶段名->产物信息
+        '''
+        obj=self.get_object(sha256)
+        return obj['artifacts'] if obj else {}
+    def set_artifact(self,sha256:str,stage:str,value)->None:
+        '''
+        登记下游产物，相同内容再次上传时复用
+        :param sha256:
+        :param stage: 阶段名，如parse/chunk/embed
+        :param value: 产物信息(可JSON序列化)，为None时删除
+        :return:
+        '''
+        with self.Session() as session:
+            obj=session.query(UploadObject).filter_by(sha256=sha256).with_for_update().first()
+            if obj is None:
+                return
+            artifacts=dict(obj.artifacts or {})
+            if value is None:
+                artifacts.pop(stage,None)
+            else:
+                artifacts[stage]=value
+            #JSON字段需整体赋值才会被识别为已修改
+            obj.artifacts=artifacts
+            session.commit()
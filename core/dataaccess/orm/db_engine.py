@@ -1,5 +1,15 @@
-import os,re
+"""
+ORM引擎注册表：每个settings.db配置名在进程内只有一个同步引擎和一个异步引擎(各自一个连接池)及对应的会话工厂
+同步引擎供run_blocking中执行的数据访问类使用，异步引擎(asyncpg/aiomysql)供接口直接await，不占用线程池也不阻塞事件循环
+get_async_session为FastAPI依赖，每个请求一个会话，请求结束后关闭
+text-to-sql查询使用的连接池在core.biziness.texttosql.get_db中单独创建(连接上设置了语句超时)
+"""
+import os,re,threading
+from typing import AsyncIterator, Dict
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+import settings
 from settings import db
 
 def get_postgresql_url():
@@ -24,18 +34,137 @@ def get_postgresql_url():
     return url
 
 
-def create_database_engine():
-    """创建数据库引擎"""
-    database_url = get_postgresql_url()
-    echo = os.getenv('DB_ECHO', 'False').lower() == 'true'
+def get_database_url(db_key: str = 'pg') -> str:
+    """settings.db中配置名对应的连接URL，pg可由环境变量DB_URI覆盖"""
+    if db_key == 'pg':
+        return get_postgresql_url()
+    return db[db_key]
 
-    engine = create_engine(
-        database_url,
-        echo=echo,
-        pool_size=10,
-        max_overflow=20,
-        pool_pre_ping=True,
-        pool_recycle=3600
-    )
 
-    return engine
\ No newline at end of file
+#同步驱动->异步驱动
+_ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'postgresql+psycopg2': 'postgresql+asyncpg',
+                  'mysql': 'mysql+aiomysql', 'mysql+pymysql': 'mysql+aiomysql'}
+
+
+def get_async_url(url: str):
+    """同步连接URL转为异步驱动的URL"""
+    url = make_url(url)
+    drivername = _ASYNC_DRIVERS.get(url.drivername, url.drivername)
+    if drivername == 'postgresql+asyncpg' and 'sslmode' in url.query:
+        # asyncpg不识别sslmode参数，对应的参数为ssl
+        url = url.difference_update_query(['sslmode']).update_query_dict({'ssl': url.query['sslmode']})
+    return url.set(drivername=drivername)
+
+
+def _engine_args() -> dict:
+    config = settings.db_pool
+    return {'echo': os.getenv('DB_ECHO', 'False').lower() == 'true',
+            'pool_size': config['pool_size'],
+            'max_overflow': config['max_overflow'],
+            'pool_timeout': config['pool_timeout'],
+            'pool_pre_ping': True,
+            'pool_recycle': config['pool_recycle']}
+
+
+def create_database_engine(db_key: str = 'pg'):
+    """创建数据库引擎(新的连接池)，一般应使用get_engine获取共享的引擎"""
+    return create_engine(get_database_url(db_key), **_engine_args())
+
+
+def create_async_database_engine(db_key: str = 'pg'):
+    """创建异步数据库引擎(新的连接池)，一般应使用get_async_engine获取共享的引擎"""
+    from sqlalchemy.ext.asyncio import create_async_engine
+    return create_async_engine(get_async_url(get_database_url(db_key)), **_engine_args())
+
+
+_engines = {}  #db_key->Engine
+_async_engines = {}  #db_key->AsyncEngine
+_sessionmakers = {}
+_async_sessionmakers = {}
+_lock = threading.Lock()
+
+
+def get_engine(db_key: str = 'pg'):
+    """进程内共享的同步引擎"""
+    with _lock:
+        if db_key not in _engines:
+            _engines[db_key] = create_database_engine(db_key)
+        return _engines[db_key]
+
+
+def get_async_engine(db_key: str = 'pg'):
+    """进程内共享的异步引擎"""
+    with _lock:
+        if db_key not in _async_engines:
+            _async_engines[db_key] = create_async_database_engine(db_key)
+        return _async_engines[db_key]
+
+
+def get_sessionmaker(db_key: str = 'pg'):
+    """进程内共享的会话工厂"""
+    engine = get_engine(db_key)
+    with _lock:
+        if db_key not in _sessionmakers:
+            _sessionmakers[db_key] = sessionmaker(bind=engine)
+        return _sessionmakers[db_key]
+
+
+def get_async_sessionmaker(db_key: str = 'pg'):
+    """进程内共享的异步会话工厂，提交后不过期对象属性(异步会话中不能隐式加载)"""
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+    engine = get_async_engine(db_key)
+    with _lock:
+        if db_key not in _async_sessionmakers:
+            _async_sessionmakers[db_key] = async_sessionmaker(engine, expire_on_commit=False)
+        return _async_sessionmakers[db_key]
+
+
+def async_session_dependency(db_key: str = 'pg'):
+    """
+    生成FastAPI依赖：每个请求一个异步会话，请求处理出错时回滚，结束后关闭(连接归还连接池)
+    用法：session: AsyncSession = Depends(async_session_dependency('mysql'))
+    """
+    async def dependency() -> AsyncIterator:
+        async with get_async_sessionmaker(db_key)() as session:
+            try:
+                yield session
+            except Exception:
+                await session.rollback()
+                raise
+    return dependency
+
+
+#默认库(pg)的请求级会话依赖
+get_async_session = async_session_dependency('pg')
+
+
+def _pool_stats(pool) -> dict:
+    stats = {'pool': type(pool).__name__}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        method = getattr(pool, name, None)
+        if method is not None:
+            stats[name] = method()
+    return stats
+
+
+def get_pool_stats() -> Dict[str, dict]:
+    """各引擎连接池的连接数(size为常驻连接数，checkedout为使用中，overflow为超出size临时建立的连接)"""
+    stats = {}
+    for kind, engines in (('sync', _engines), ('async', _async_engines)):
+        for db_key, engine in list(engines.items()):
+            stats.setdefault(db_key, {})[kind] = _pool_stats(engine.pool)
+    return stats
+
+
+async def dispose_engines():
+    """关闭全部引擎的连接池(应用退出时)"""
+    with _lock:
+        engines, async_engines = list(_engines.values()), list(_async_engines.values())
+        _engines.clear()
+        _async_engines.clear()
+        _sessionmakers.clear()
+        _async_sessionmakers.clear()
+    for engine in async_engines:
+        await engine.dispose()
+    for engine in engines:
+        engine.dispose()
@@ -3,10 +3,11 @@
 使用PostgreSQL数据库配置
 """
 
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, Text, ForeignKey, Table, UniqueConstraint
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, Float, Text, JSON, ForeignKey, Index, Table, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
+from core.dataaccess.orm.db_engine import get_sessionmaker
 
 
 # 获取数据库配置
@@ -116,6 +117,68 @@ class Permission(Base):
         return f"<Permission(id={self.id}, name='{self.name}', code='{self.code}', category='{self.category}')>"
 
 
+class UploadObject(Base):
+    """上传文件内容表(按SHA256去重，同一内容只保存一份)"""
+    __tablename__ = 'upload_objects'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    sha256 = Column(String(64), unique=True, nullable=False, index=True)
+    size = Column(BigInteger, nullable=False)
+    ext = Column(String(16), nullable=False)
+    storage_path = Column(String(512), nullable=False)
+    # 下游产物(解析、切片、向量化等)，阶段名->产物信息，相同内容再次上传时直接复用
+    artifacts = Column(JSON, default=dict, nullable=False)
+    upload_count = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=func.now(), nullable=False)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), nullable=False)
+
+    # 关系定义
+    records = relationship('UploadRecord', back_populates='object')
+
+    def __repr__(self):
+        return f"<UploadObject(id={self.id}, sha256='{self.sha256}', size={self.size})>"
+
+
+class UploadRecord(Base):
+    """上传记录表(每次上传一条，指向去重后的文件内容)"""
+    __tablename__ = 'upload_records'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    object_id = Column(Integer, ForeignKey('upload_objects.id'), nullable=False, index=True)
+    filename = Column(String(255), nullable=False)
+    uploaded_by = Column(String(100))
+    created_at = Column(DateTime, default=func.now(), nullable=False)
+
+    # 关系定义
+    object = relationship('UploadObject', back_populates='records')
+
+    def __repr__(self):
+        return f"<UploadRecord(id={self.id}, object_id={self.object_id}, filename='{self.filename}')>"
+
+
+class IngestJob(Base):
+    """文档入库任务表(解析->切片->向量化，每个阶段完成后进入下一阶段的队列)"""
+    __tablename__ = 'ingest_jobs'
+    __table_args__ = (Index('ix_ingest_jobs_dequeue', 'stage', 'status', 'priority', 'available_at'),)
+
+    id = Column(String(32), primary_key=True)
+    stage = Column(String(32), nullable=False)
+    status = Column(String(16), nullable=False)  # queued/running/done/failed
+    priority = Column(Integer, default=0, nullable=False)  # 越大越优先
+    payload = Column(JSON, default=dict, nullable=False)
+    result = Column(JSON, default=dict, nullable=False)  # 阶段名->阶段结果
+    attempts = Column(Integer, default=0, nullable=False)  # 当前阶段已尝试次数
+    progress = Column(Float, default=0, nullable=False)  # 整体进度0-1
+    message = Column(String(255))
+    error = Column(Text)
+    available_at = Column(Float, nullable=False)  # 可被领取的时间(重试时延后)，Unix时间戳
+    created_at = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)  # 运行中的任务以此判断工作进程是否存活
+
+    def __repr__(self):
+        return f"<IngestJob(id='{self.id}', stage='{self.stage}', status='{self.status}')>"
+
+
 def create_tables(engine):
     """创建所有表"""
     Base.metadata.create_all(engine)
@@ -128,27 +191,25 @@ def drop_tables(engine):
     print("✓ 所有表删除成功")
 
 
-def get_session(engine):
-    """获取数据库会话"""
-    Session = sessionmaker(bind=engine)
-    return Session()
+def get_session(db_key='pg'):
+    """获取数据库会话(共享的引擎及会话工厂，见db_engine.get_sessionmaker)"""
+    return get_sessionmaker(db_key)()
 
 
 if __name__ == "__main__":
     print("开始初始化数据库...")
 
     # 创建数据库引擎
-    import db_engine
+    from core.dataaccess.orm.db_engine import get_engine
 
-    engine = db_engine.create_database_engine()
-    Session = sessionmaker(bind=engine)
+    engine = get_engine()
     print(f"✓ 数据库引擎创建成功: {engine.url}")
     
     # 创建所有表
     create_tables(engine)
     
     # 创建会话
-    session = get_session(engine)
+    session = get_session()
     
     try:
         # 检查是否已有数据
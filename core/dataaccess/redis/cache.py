@@ -0,0 +1,345 @@
+"""
+多进程共享缓存(表结构、问题->SQL、会话、限流计数等)
+键按命名空间组织：{settings.redis['prefix']}:{命名空间}:{键}，值以msgpack序列化(见codec)
+后端：
+redis：多个uvicorn worker及工作进程共享，批量读写使用MGET及管道，一次往返
+memory：进程内LRU+TTL，用于测试及单进程部署，不需要Redis服务
+防击穿：get_or_set在缓存未命中时，同一进程内的并发请求只加载一次，
+不同进程之间以带有效期的锁(SET NX PX)保证只有一个进程加载，其他进程等待结果写入后直接读取
+Redis不可用时读取视为未命中、写入忽略，不影响业务请求
+"""
+import asyncio
+import inspect
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import settings
+from core.dataaccess.redis.codec import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class CacheBackend:
+    errors: Tuple[type, ...] = (ConnectionError, OSError, asyncio.TimeoutError)  #视为缓存不可用的异常
+
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        raise NotImplementedError
+
+    async def set_many(self, items: Dict[str, bytes], ttl: Optional[float] = None) -> None:
+        '''
+        :param items: 键->序列化后的值
+        :param ttl: 有效期(秒)，为空不过期
+        '''
+        raise NotImplementedError
+
+    async def delete(self, keys: List[str]) -> int:
+        raise NotImplementedError
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        '''
+        计数加amount，键不存在时从0开始并设置有效期(限流窗口)
+        '''
+        raise NotImplementedError
+
+    async def acquire_lock(self, key: str, token: str, ttl: float) -> bool:
+        raise NotImplementedError
+
+    async def release_lock(self, key: str, token: str) -> None:
+        '''
+        只释放自己持有的锁(token一致)，锁已过期被他人获取时不释放
+        '''
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()  #键->(值,过期时间)
+        self._lock = threading.Lock()
+
+    def _get(self, key: str, now: float):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _set(self, key: str, value, ttl: Optional[float], now: float):
+        self._entries[key] = (value, now + ttl if ttl else None)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_many(self, keys):
+        now = time.time()
+        with self._lock:
+            return [self._get(key, now) for key in keys]
+
+    async def set_many(self, items, ttl=None):
+        now = time.time()
+        with self._lock:
+            for key, value in items.items():
+                self._set(key, value, ttl, now)
+
+    async def delete(self, keys):
+        with self._lock:
+            return sum(self._entries.pop(key, None) is not None for key in keys)
+
+    async def incr(self, key, amount=1, ttl=None):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[1] is not None and entry[1] <= now):
+                entry = (0, now + ttl if ttl else None)
+            value = entry[0] + amount
+            self._entries[key] = (value, entry[1])
+            return value
+
+    async def acquire_lock(self, key, token, ttl):
+        now = time.time()
+        with self._lock:
+            if self._get(key, now) is not None:
+                return False
+            self._set(key, token, ttl, now)
+            return True
+
+    async def release_lock(self, key, token):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == token:
+                del self._entries[key]
+
+
+class RedisBackend(CacheBackend):
+    #值与token一致时才删除，避免删除已过期后被其他进程获取的锁
+    _RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+    _BATCH = 500
+
+    def __init__(self):
+        from redis.exceptions import RedisError
+        from core.dataaccess.redis.client import get_redis
+        self.redis = get_redis(decode_responses=False)
+        self.errors = (RedisError,) + CacheBackend.errors
+        self._release = self.redis.register_script(self._RELEASE)
+
+    async def get_many(self, keys):
+        values = []
+        for start in range(0, len(keys), self._BATCH):
+            values.extend(await self.redis.mget(keys[start:start + self._BATCH]))
+        return values
+
+    async def set_many(self, items, ttl=None):
+        items = list(items.items())
+        px = int(ttl * 1000) if ttl else None
+        for start in range(0, len(items), self._BATCH):
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for key, value in items[start:start + self._BATCH]:
+                    pipe.set(key, value, px=px)
+                await pipe.execute()
+
+    async def delete(self, keys):
+        return await self.redis.delete(*keys) if keys else 0
+
+    async def incr(self, key, amount=1, ttl=None):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if ttl:
+                pipe.set(key, 0, px=int(ttl * 1000), nx=True)
+            pipe.incrby(key, amount)
+            return (await pipe.execute())[-1]
+
+    async def acquire_lock(self, key, token, ttl):
+        return bool(await self.redis.set(key, token, px=int(ttl * 1000), nx=True))
+
+    async def release_lock(self, key, token):
+        await self._release(keys=[key], args=[token])
+
+
+def create_backend(name: Optional[str] = None) -> CacheBackend:
+    '''
+    :param name: memory/redis，默认settings.cache['backend']
+    :return:
+    '''
+    name = name or settings.cache['backend']
+    if name == 'memory':
+        return MemoryBackend(settings.cache['max_entries'])
+    if name == 'redis':
+        return RedisBackend()
+    raise ValueError(f'未知的缓存后端：{name}')
+
+
+class SharedCache:
+    def __init__(self, namespace: str, backend: CacheBackend, ttl: Optional[float] = None):
+        '''
+        :param namespace: 命名空间
+        :param backend:
+        :param ttl: 默认有效期(秒)，为空不过期
+        '''
+        self.namespace = namespace
+        self.backend = backend
+        self.ttl = ttl
+        self.prefix = f"{settings.redis['prefix']}:{namespace}:"
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.stats = {'hits': 0, 'misses': 0, 'loads': 0, 'coalesced': 0, 'lock_waits': 0, 'errors': 0}
+
+    def key(self, key: str) -> str:
+        return self.prefix + key
+
+    def _error(self, action: str, error: Exception):
+        self.stats['errors'] += 1
+        logger.warning('共享缓存%s%s失败：%s', self.namespace, action, error)
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, object]:
+        '''
+        批量读取
+        :param keys:
+        :return: 命中的键->值
+        '''
+        keys = list(keys)
+        if not keys:
+            return {}
+        try:
+            values = await self.backend.get_many([self.key(key) for key in keys])
+        except self.backend.errors as e:
+            self._error('读取', e)
+            values = [None] * len(keys)
+        result = {key: loads(value) for key, value in zip(keys, values) if value is not None}
+        self.stats['hits'] += len(result)
+        self.stats['misses'] += len(keys) - len(result)
+        return result
+
+    async def get(self, key: str, default=None):
+        return (await self.get_many([key])).get(key, default)
+
+    async def set_many(self, items: Dict[str, object], ttl: Optional[float] = None):
+        '''
+        批量写入
+        :param items: 键->值
+        :param ttl: 有效期(秒)，默认self.ttl
+        '''
+        if not items:
+            return
+        try:
+            await self.backend.set_many({self.key(key): dumps(value) for key, value in items.items()},
+                                        ttl or self.ttl)
+        except self.backend.errors as e:
+            self._error('写入', e)
+
+    async def set(self, key: str, value, ttl: Optional[float] = None):
+        await self.set_many({key: value}, ttl)
+
+    async def delete(self, *keys: str) -> int:
+        try:
+            return await self.backend.delete([self.key(key) for key in keys])
+        except self.backend.errors as e:
+            self._error('删除', e)
+            return 0
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        '''
+        计数(限流)，计数键只能通过incr读写；不吞掉异常，由调用方决定Redis不可用时是否放行
+        '''
+        return await self.backend.incr(self.key(key), amount, ttl)
+
+    async def get_or_set(self, key: str, loader: Callable, ttl: Optional[float] = None):
+        '''
+        读取缓存，未命中时调用loader加载并写入，并发未命中时只加载一次
+        :param key:
+        :param loader: 无参函数或协程函数，返回值须可序列化
+        :param ttl: 有效期(秒)，默认self.ttl
+        :return:
+        '''
+        value = await self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        full_key = self.key(key)
+        inflight = self._inflight.get(full_key)
+        if inflight is not None:
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(inflight)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[full_key] = future
+        try:
+            value = await self._load(key, loader, ttl)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            #没有其他等待者时避免"Future exception was never retrieved"
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(full_key, None)
+
+    async def _call(self, key: str, loader: Callable, ttl: Optional[float]):
+        self.stats['loads'] += 1
+        value = loader()
+        if inspect.isawaitable(value):
+            value = await value
+        await self.set(key, value, ttl)
+        return value
+
+    async def _load(self, key: str, loader: Callable, ttl: Optional[float]):
+        '''
+        跨进程防击穿：获取锁的进程加载，其他进程轮询等待结果，超过lock_wait仍未写入时自行加载
+        '''
+        config = settings.cache
+        lock_key, token = self.key(key) + ':lock', uuid.uuid4().hex
+        deadline = time.monotonic() + config['lock_wait']
+        while True:
+            try:
+                acquired = await self.backend.acquire_lock(lock_key, token, config['lock_ttl'])
+            except self.backend.errors as e:
+                self._error('加锁', e)
+                return await self._call(key, loader, ttl)
+            if acquired:
+                try:
+                    #等待锁期间其他进程可能已写入
+                    value = await self.get(key, _MISSING)
+                    return value if value is not _MISSING else await self._call(key, loader, ttl)
+                finally:
+                    try:
+                        await self.backend.release_lock(lock_key, token)
+                    except self.backend.errors as e:
+                        self._error('解锁', e)
+            self.stats['lock_waits'] += 1
+            await asyncio.sleep(config['lock_poll'])
+            value = await self.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            if time.monotonic() > deadline:
+                return await self._call(key, loader, ttl)
+
+    def get_stats(self) -> dict:
+        return dict(self.stats, namespace=self.namespace, backend=type(self.backend).__name__)
+
+
+_backend: Optional[CacheBackend] = None
+_caches: Dict[str, SharedCache] = {}
+
+
+def get_cache(namespace: str, ttl: Optional[float] = None) -> SharedCache:
+    '''
+    获取命名空间的共享缓存，同一命名空间返回同一实例
+    :param namespace:
+    :param ttl: 默认有效期(秒)，首次获取时设置
+    :return:
+    '''
+    global _backend
+    if namespace not in _caches:
+        if _backend is None:
+            _backend = create_backend()
+        _caches[namespace] = SharedCache(namespace, _backend, ttl)
+    return _caches[namespace]
+
+
+def get_cache_stats() -> List[dict]:
+    return [cache.get_stats() for cache in _caches.values()]
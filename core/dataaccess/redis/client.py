@@ -0,0 +1,64 @@
+"""
+Redis异步客户端，进程内按(地址,是否解码)共享连接池
+decode_responses=True的客户端读写字符串(任务队列等)，False的读写bytes(共享缓存的msgpack数据)
+"""
+from typing import Dict, Optional, Tuple
+
+import settings
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+_clients: Dict[Tuple[str, bool], object] = {}
+
+
+def get_redis(url: Optional[str] = None, decode_responses: bool = True):
+    '''
+    获取共享的异步客户端
+    :param url: 连接地址，默认settings.redis['url']
+    :param decode_responses: 返回值是否解码为字符串
+    :return: redis.asyncio.Redis
+    '''
+    if aioredis is None:
+        raise RuntimeError('使用Redis需要安装redis')
+    config = settings.redis
+    key = (url or config['url'], decode_responses)
+    client = _clients.get(key)
+    if client is None:
+        pool = aioredis.ConnectionPool.from_url(key[0], decode_responses=decode_responses,
+                                                max_connections=config['max_connections'],
+                                                socket_timeout=config['socket_timeout'],
+                                                socket_connect_timeout=config['socket_timeout'],
+                                                health_check_interval=config['health_check_interval'])
+        client = _clients[key] = aioredis.Redis(connection_pool=pool)
+    return client
+
+
+async def close_redis():
+    '''
+    关闭全部客户端及连接池(应用退出时)
+    :return:
+    '''
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        close = getattr(client, 'aclose', None) or client.close
+        await close()
+        await client.connection_pool.disconnect()
+
+
+def get_pool_stats() -> list:
+    '''
+    各连接池的连接数
+    :return:
+    '''
+    stats = []
+    for (url, decode), client in _clients.items():
+        pool = client.connection_pool
+        stats.append({'url': url.rsplit('@', 1)[-1], 'decode_responses': decode,
+                      'max_connections': pool.max_connections,
+                      'in_use': len(getattr(pool, '_in_use_connections', ())),
+                      'idle': len(getattr(pool, '_available_connections', ()))})
+    return stats
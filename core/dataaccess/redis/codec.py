@@ -0,0 +1,51 @@
+"""
+缓存值序列化
+使用msgpack(比JSON体积小、编解码快，支持bytes)，datetime/date/Decimal/set以扩展类型保存，读取后类型不变；
+未安装msgpack时退化为JSON(扩展类型转为字符串)，同一Redis的所有进程须使用相同的序列化方式
+"""
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+_DATETIME, _DATE, _DECIMAL, _SET = 1, 2, 3, 4
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return msgpack.ExtType(_DATETIME, value.isoformat().encode('utf-8'))
+    if isinstance(value, date):
+        return msgpack.ExtType(_DATE, value.isoformat().encode('utf-8'))
+    if isinstance(value, Decimal):
+        return msgpack.ExtType(_DECIMAL, str(value).encode('utf-8'))
+    if isinstance(value, (set, frozenset)):
+        return msgpack.ExtType(_SET, dumps(list(value)))
+    raise TypeError(f'无法序列化的类型：{type(value).__name__}')
+
+
+def _ext_hook(code: int, data: bytes):
+    if code == _DATETIME:
+        return datetime.fromisoformat(data.decode('utf-8'))
+    if code == _DATE:
+        return date.fromisoformat(data.decode('utf-8'))
+    if code == _DECIMAL:
+        return Decimal(data.decode('utf-8'))
+    if code == _SET:
+        return set(loads(data))
+    return msgpack.ExtType(code, data)
+
+
+def dumps(value) -> bytes:
+    if msgpack is None:
+        return json.dumps(value, ensure_ascii=False, default=str).encode('utf-8')
+    return msgpack.packb(value, use_bin_type=True, default=_default)
+
+
+def loads(data: bytes):
+    if msgpack is None:
+        return json.loads(data)
+    return msgpack.unpackb(data, raw=False, ext_hook=_ext_hook, strict_map_key=False)
@@ -0,0 +1,192 @@
+"""
+SQL直接执行
+不经过Agent，直接在连接池上执行已校验的查询SQL
+"""
+import json
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+
+
+def _set_timeout(conn, timeout: Optional[float]):
+    '''
+    设置当前连接的语句超时，返回恢复用的SQL
+    :param conn:
+    :param timeout: 超时时间(秒)，为空不限制
+    :return:
+    '''
+    if not timeout:
+        return None
+    dialect = conn.dialect.name
+    millis = int(timeout * 1000)
+    if dialect == 'mysql':
+        #恢复为连接原有的值(连接建立时设置的默认语句超时)
+        previous = conn.exec_driver_sql('SELECT @@SESSION.max_execution_time').scalar()
+        conn.exec_driver_sql(f'SET SESSION MAX_EXECUTION_TIME={millis}')
+        return f'SET SESSION MAX_EXECUTION_TIME={int(previous or 0)}'
+    if dialect == 'postgresql':
+        #SET LOCAL随事务结束失效，无需恢复
+        conn.exec_driver_sql(f'SET LOCAL statement_timeout={millis}')
+    return None
+
+
+def timeout_engine_args(uri: str, timeout: Optional[float]) -> dict:
+    '''
+    连接建立时设置默认语句超时，Agent等不经过run_select的查询同样受限
+    :param uri: 数据库连接串
+    :param timeout: 超时时间(秒)
+    :return: create_engine参数
+    '''
+    if not timeout:
+        return {}
+    millis = int(timeout * 1000)
+    if uri.startswith('mysql+pymysql'):
+        return {'connect_args': {'init_command': f'SET SESSION MAX_EXECUTION_TIME={millis}'}}
+    if uri.startswith('postgresql'):
+        return {'connect_args': {'options': f'-c statement_timeout={millis}'}}
+    return {}
+
+
+def run_select(db, sql: str, max_rows: int = 100, timeout: Optional[float] = None) -> Tuple[List[str], List[tuple]]:
+    '''
+    在连接池上执行查询SQL，最多取回max_rows行
+    :param db: SQLDatabase
+    :param sql: 查询SQL
+    :param max_rows: 最大返回行数
+    :param timeout: 语句超时时间(秒)
+    :return: (列名,行数据)
+    '''
+    with db._engine.connect() as conn:
+        reset_sql = _set_timeout(conn, timeout)
+        try:
+            result = conn.execute(text(sql))
+            columns = list(result.keys())
+            rows = [tuple(row) for row in result.fetchmany(max_rows)]
+            result.close()
+        finally:
+            #连接归还连接池前恢复超时设置
+            if reset_sql:
+                conn.exec_driver_sql(reset_sql)
+    return columns, rows
+
+
+def rows_to_markdown(columns: Sequence[str], rows: Sequence[tuple]) -> str:
+    '''
+    查询结果转为markdown表格
+    :param columns: 列名
+    :param rows: 行数据
+    :return:
+    '''
+    if not rows:
+        return '未查询到符合条件的数据'
+
+    def cell(value):
+        return '' if value is None else str(value).replace('|', '\\|').replace('\n', ' ')
+
+    lines = ['| ' + ' | '.join(cell(c) for c in columns) + ' |',
+             '|' + '---|' * len(columns)]
+    lines.extend('| ' + ' | '.join(cell(v) for v in row) + ' |' for row in rows)
+    return '\n'.join(lines)
+
+
+def stream_select(db, sql: str, chunk_size: int = 1000, timeout: Optional[float] = None) -> Iterator[Sequence]:
+    '''
+    使用服务端游标(不缓冲)执行查询，按块返回行数据，内存占用不超过一个块
+    第一次产出列名，之后每次产出一个块的行数据
+    :param db: SQLDatabase
+    :param sql: 查询SQL
+    :param chunk_size: 每块行数
+    :param timeout: 语句超时时间(秒)
+    :return:
+    '''
+    with db._engine.connect() as conn:
+        reset_sql = _set_timeout(conn, timeout)
+        result = None
+        try:
+            #stream_results：MySQL使用SSCursor，PostgreSQL使用命名游标
+            result = conn.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(text(sql))
+            yield tuple(result.keys())
+            for partition in result.partitions(chunk_size):
+                yield [tuple(row) for row in partition]
+        finally:
+            #服务端游标未读完时连接不可复用，先关闭结果集再恢复超时设置
+            if result is not None:
+                result.close()
+            if reset_sql:
+                conn.exec_driver_sql(reset_sql)
+
+
+def _mysql_plan_scan(node) -> Tuple[float, float]:
+    '''
+    :return: (当前查询块内按嵌套循环相乘的扫描行数,其中子查询块的扫描行数之和)
+    '''
+    rows, nested = 1.0, 0.0
+    for key, value in node.items():
+        if key == 'rows_examined_per_scan':
+            rows *= max(float(value), 1.0)
+        elif key == 'nested_loop':
+            #同一查询块内的连接：每个表的扫描次数为前一个表连接后的行数(rows_produced_per_join)，
+            #扫描行数=扫描次数x每次扫描行数，各表相加；第一个表只扫描一次
+            loop_rows, outer = 0.0, None
+            for item in value:
+                item_rows, item_nested = _mysql_plan_scan(item)
+                scanned = item_rows if outer is None else outer * item_rows
+                loop_rows += scanned
+                nested += item_nested
+                produced = (item.get('table') or {}).get('rows_produced_per_join')
+                outer = max(float(produced), 1.0) if produced is not None else scanned
+            rows *= max(loop_rows, 1.0)
+        elif key == 'query_block':
+            #子查询、派生表、UNION的各分支：独立的查询块，相加
+            nested += _mysql_plan_rows(value)
+        elif isinstance(value, dict):
+            item_rows, item_nested = _mysql_plan_scan(value)
+            rows *= item_rows
+            nested += item_nested
+        elif isinstance(value, list):
+            #attached_subqueries、query_specifications等
+            for item in value:
+                if isinstance(item, dict):
+                    item_rows, item_nested = _mysql_plan_scan(item)
+                    nested += (item_rows if item_rows > 1 else 0) + item_nested
+    return rows, nested
+
+
+def _mysql_plan_rows(query_block: dict) -> float:
+    '''
+    从MySQL EXPLAIN FORMAT=JSON的query_block估算扫描行数：
+    同一嵌套循环内每个表的扫描行数为前一个表的rows_produced_per_join乘以本表的rows_examined_per_scan，
+    子查询及UNION分支等查询块之间相加
+    :param query_block:
+    :return:
+    '''
+    rows, nested = _mysql_plan_scan(query_block)
+    return rows + nested
+
+
+def explain_sql(db, sql: str) -> dict:
+    '''
+    试运行EXPLAIN，校验SQL能否执行并估算成本，不真正执行查询
+    :param db: SQLDatabase
+    :param sql: 查询SQL
+    :return: {'ok':是否可执行,'cost':估算成本,'rows':估算扫描行数,'error':错误信息,'plan':原始执行计划}
+    '''
+    dialect = db._engine.dialect.name
+    try:
+        with db._engine.connect() as conn:
+            if dialect == 'mysql':
+                plan = json.loads(conn.execute(text(f'EXPLAIN FORMAT=JSON {sql}')).scalar())
+                cost_info = plan.get('query_block', {}).get('cost_info', {})
+                return {'ok': True, 'cost': float(cost_info.get('query_cost', 0)),
+                        'rows': _mysql_plan_rows(plan.get('query_block', {})), 'error': None, 'plan': plan}
+            if dialect == 'postgresql':
+                plan = conn.execute(text(f'EXPLAIN (FORMAT JSON) {sql}')).scalar()
+                plan = json.loads(plan) if isinstance(plan, str) else plan
+                root = plan[0]['Plan']
+                return {'ok': True, 'cost': float(root.get('Total Cost', 0)),
+                        'rows': float(root.get('Plan Rows', 0)), 'error': None, 'plan': plan}
+            plan = [tuple(row) for row in conn.execute(text(f'EXPLAIN QUERY PLAN {sql}')).fetchall()] \
+                if dialect == 'sqlite' else None
+            return {'ok': True, 'cost': None, 'rows': None, 'error': None, 'plan': plan}
+    except Exception as e:
+        return {'ok': False, 'cost': None, 'rows': None, 'error': str(e), 'plan': None}
@@ -0,0 +1,242 @@
+"""
+表结构元数据缓存
+SQLDatabase.get_table_info 每次都会反射整个库并对每张表抽样查询，
+这里按库结构版本缓存其结果，结构版本通过 information_schema 探测
+"""
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from langchain_community.utilities import SQLDatabase
+from sqlalchemy import MetaData, inspect, text
+
+#MySQL:字段定义校验和+表创建时间，DDL变更(ALTER/CREATE/DROP)后结果随之变化
+MYSQL_VERSION_SQL = """
+SELECT COUNT(*),
+       COALESCE(SUM(CRC32(CONCAT_WS('|', c.TABLE_NAME, c.COLUMN_NAME, c.COLUMN_TYPE,
+                                    c.COLUMN_KEY, c.COLUMN_COMMENT))), 0),
+       (SELECT MAX(t.CREATE_TIME) FROM information_schema.TABLES t
+         WHERE t.TABLE_SCHEMA = DATABASE())
+FROM information_schema.COLUMNS c
+WHERE c.TABLE_SCHEMA = DATABASE()
+"""
+SQLITE_VERSION_SQL = "SELECT group_concat(sql, ';') FROM sqlite_master"
+
+
+def _quote(comment: str) -> str:
+    return ' '.join(comment.split()).replace("'", "''")
+
+
+class CachedSQLDatabase(SQLDatabase):
+    """带表结构缓存的SQLDatabase"""
+
+    def __init__(self, *args, cache_ttl: int = 300, probe_interval: int = 30, max_entries: int = 256, **kwargs):
+        '''
+        :param cache_ttl: 缓存有效期(秒)，到期后即使结构未变也重新生成(刷新抽样数据)
+        :param probe_interval: 结构版本探测间隔(秒)，间隔内直接信任上次探测结果
+        :param max_entries: 最多缓存的表组合数，超出时淘汰最久未使用的
+        '''
+        super().__init__(*args, **kwargs)
+        self.cache_ttl = cache_ttl
+        self.probe_interval = probe_interval
+        self.max_entries = max_entries
+        self._cache: Dict[Tuple, Tuple[float, str]] = OrderedDict()  #LRU
+        self._cache_lock = threading.RLock()
+        self._loading: Dict[Tuple, threading.Event] = {}  #正在生成的缓存键，同一键只由一个线程生成
+        self._metadata_lock = threading.Lock()  #SQLDatabase反射到的MetaData不是线程安全的
+        self._version: Optional[str] = None
+        self._probed_at = 0.0
+        self.cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'probes': 0, 'evictions': 0}
+
+    def _probe_version(self) -> Optional[str]:
+        '''
+        探测库结构版本，不支持的数据库返回None(仅依赖TTL)
+        :return:
+        '''
+        dialect = self._engine.dialect.name
+        if dialect == 'mysql':
+            probe_sql = MYSQL_VERSION_SQL
+        elif dialect == 'sqlite':
+            probe_sql = SQLITE_VERSION_SQL
+        else:
+            return None
+        with self._engine.connect() as conn:
+            row = conn.execute(text(probe_sql)).fetchone()
+        self.cache_stats['probes'] += 1
+        return hashlib.md5(repr(tuple(row)).encode('utf-8')).hexdigest()
+
+    def schema_version(self) -> Optional[str]:
+        '''
+        当前库结构版本，版本变化时清空缓存并重新反射
+        :return:
+        '''
+        with self._cache_lock:
+            now = time.monotonic()
+            if self._version is not None and now - self._probed_at < self.probe_interval:
+                return self._version
+            version = self._probe_version()
+            self._probed_at = now
+            if self._version is not None and version != self._version:
+                self._reset_metadata()
+            self._version = version
+            return version
+
+    def _reset_metadata(self):
+        '''
+        清空缓存及已反射的元数据，下次访问时重新反射
+        :return:
+        '''
+        self._cache.clear()
+        with self._metadata_lock:
+            self._metadata = MetaData()
+            self._inspector = inspect(self._engine)
+            self._all_tables = set(
+                self._inspector.get_table_names(schema=self._schema)
+                + (self._inspector.get_view_names(schema=self._schema) if self._view_support else [])
+            )
+        self.cache_stats['invalidations'] += 1
+
+    def invalidate(self):
+        '''
+        手动失效缓存
+        :return:
+        '''
+        with self._cache_lock:
+            self._reset_metadata()
+            self._version = None
+            self._probed_at = 0.0
+
+    def _cache_get(self, key: Tuple):
+        '''
+        读取未过期的缓存并标记为最近使用，调用方持有_cache_lock
+        :param key:
+        :return: 未命中返回None
+        '''
+        cached = self._cache.get(key)
+        if cached is None or time.monotonic() - cached[0] >= self.cache_ttl:
+            return None
+        self._cache.move_to_end(key)
+        return cached[1]
+
+    def _cache_put(self, key: Tuple, value):
+        '''
+        写入缓存，超出max_entries时淘汰最久未使用的，调用方持有_cache_lock
+        :param key:
+        :param value:
+        :return:
+        '''
+        self._cache[key] = (time.monotonic(), value)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+            self.cache_stats['evictions'] += 1
+
+    def _cached(self, key: Tuple, load, count: bool = True):
+        '''
+        读取缓存，未命中时在锁外调用load生成(反射及抽样查询耗时较长，不阻塞其他键的读取)，
+        同一键同时只有一个线程生成，其余线程等待其结果
+        :param key:
+        :param load: 生成缓存值的函数
+        :param count: 是否计入命中统计
+        :return:
+        '''
+        while True:
+            with self._cache_lock:
+                value = self._cache_get(key)
+                if value is not None:
+                    if count:
+                        self.cache_stats['hits'] += 1
+                    return value
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    if count:
+                        self.cache_stats['misses'] += 1
+                    break
+            #生成失败时等待的线程醒来后重新尝试
+            loading.wait()
+        try:
+            value = load()
+            with self._cache_lock:
+                self._cache_put(key, value)
+            return value
+        finally:
+            with self._cache_lock:
+                self._loading.pop(key, None)
+            loading.set()
+
+    def _load_table_info(self, table_names: Optional[List[str]]) -> str:
+        with self._metadata_lock:
+            return super().get_table_info(table_names)
+
+    def get_table_info(self, table_names: Optional[List[str]] = None) -> str:
+        key = (self.schema_version(), tuple(sorted(table_names)) if table_names else None)
+        return self._cached(key, lambda: self._load_table_info(table_names))
+
+    def _compact_table(self, inspector, table: str) -> str:
+        '''
+        单表的精简DDL：只保留字段名、类型、主键、外键及注释，不含索引、默认值及抽样数据
+        :param inspector:
+        :param table:
+        :return:
+        '''
+        pk = set(inspector.get_pk_constraint(table, schema=self._schema).get('constrained_columns') or [])
+        lines = []
+        for column in inspector.get_columns(table, schema=self._schema):
+            column_type = re.sub(r'\s+COLLATE\s+\S+', '', str(column['type']))
+            line = f"{column['name']} {column_type}"
+            if column['name'] in pk and len(pk) == 1:
+                line += ' PRIMARY KEY'
+            if column.get('comment'):
+                line += f" COMMENT '{_quote(column['comment'])}'"
+            lines.append(line)
+        if len(pk) > 1:
+            lines.append(f"PRIMARY KEY ({', '.join(sorted(pk))})")
+        for fk in inspector.get_foreign_keys(table, schema=self._schema):
+            lines.append(f"FOREIGN KEY ({', '.join(fk['constrained_columns'])}) "
+                         f"REFERENCES {fk['referred_table']}({', '.join(fk['referred_columns'])})")
+        try:
+            comment = (inspector.get_table_comment(table, schema=self._schema) or {}).get('text')
+        except NotImplementedError:
+            comment = None
+        suffix = f" COMMENT='{_quote(comment)}'" if comment else ''
+        return f'CREATE TABLE {table} (\n  ' + ',\n  '.join(lines) + f'\n){suffix};'
+
+    def get_compact_schema(self, table_names: Optional[List[str]] = None) -> str:
+        '''
+        精简DDL形式的表结构，表按名称排序，同一库结构版本及表集合下输出完全相同(利于模型服务端的前缀缓存)
+        :param table_names: 表名，为空时全部表
+        :return:
+        '''
+        tables = sorted(table_names) if table_names else sorted(self.get_usable_table_names())
+        key = (self.schema_version(), '__compact__', tuple(tables))
+
+        def load():
+            inspector = inspect(self._engine)
+            return '\n\n'.join(self._compact_table(inspector, table) for table in tables)
+        return self._cached(key, load)
+
+    def get_schema_columns(self) -> Dict[str, set]:
+        '''
+        表名->字段名集合(均为小写)，用于校验SQL引用的表和字段，随库结构版本缓存
+        :return:
+        '''
+        key = (self.schema_version(), '__columns__')
+
+        def load():
+            inspector = inspect(self._engine)
+            return {
+                table.lower(): {c['name'].lower() for c in inspector.get_columns(table, schema=self._schema)}
+                for table in self.get_usable_table_names()
+            }
+        return self._cached(key, load, count=False)
+
+    def get_cache_stats(self) -> dict:
+        '''
+        缓存命中统计
+        :return:
+        '''
+        return dict(self.cache_stats, version=self._version, entries=len(self._cache))
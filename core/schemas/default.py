@@ -1,3 +1,18 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
 class Query(BaseModel):
-    question: str
\ No newline at end of file
+    question: str
+    exec_mode: Optional[Literal['direct','agent']] = Field(None, description='SQL执行模式，为空时使用默认配置')
+    use_cache: bool = Field(True, description='是否使用问题缓存')
+    top_k: Optional[int] = Field(None, ge=1, le=50, description='最多返回的记录数，为空时从问题中提取')
+    timeout: Optional[float] = Field(None, gt=0, description='SQL执行超时时间(秒)')
+    model: Optional[str] = Field(None, description='使用的模型配置名(settings.llm)')
+    db: Optional[str] = Field(None, description='查询的数据库配置名(settings.db)')
+    candidates: Optional[int] = Field(None, ge=1, le=8, description='并行生成的候选SQL数量')
+    debug: bool = Field(False, description='调试模式，流式输出末尾追加各阶段耗时及token用量')
+class UploadSession(BaseModel):
+    filename: str
+    size: int = Field(..., gt=0, description='文件总字节数')
+    sha256: Optional[str] = Field(None, pattern='^[0-9a-fA-F]{64}$', description='文件SHA256，完成上传时校验')
+class DocumentTags(BaseModel):
+    tags: List[str] = Field(default_factory=list, description='文档标签，整体替换')
@@ -17,4 +17,28 @@ def fastapi_init():
     )
     # 挂载静态文件
     app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+    # 启动时预编译工作流，避免首个请求承担编译开销
+    @app.on_event("startup")
+    async def warmup():
+        from core.biziness.metrics import setup_tracing
+        from core.biziness.texttosql import warmup_workflows
+        setup_tracing()
+        await warmup_workflows()
+    # 文档入库工作协程
+    @app.on_event("startup")
+    async def start_workers():
+        import settings
+        from core.biziness.mq.ingest import ingest_queue
+        if settings.mq['run_workers']:
+            ingest_queue.start()
+    @app.on_event("shutdown")
+    async def close_pools():
+        from core.biziness.docs.pipeline import shutdown
+        from core.biziness.mq.ingest import ingest_queue
+        from core.dataaccess.redis.client import close_redis
+        from core.dataaccess.orm.db_engine import dispose_engines
+        await ingest_queue.stop()
+        shutdown()
+        await close_redis()
+        await dispose_engines()
     return app
\ No newline at end of file
@@ -1,9 +1,11 @@
 from fastapi import APIRouter
 from apps.default import Default
 from apps.text2sql import TextToSql
+from apps.knowledge import Knowledge
 sys_router=APIRouter()
 pageinfo=Default()
 nlp2sql=TextToSql()
+knowledge=Knowledge()
 sys_router.add_api_route(path='/index',methods=['get'],endpoint=pageinfo.default_page,description='首页')
 sys_router.add_api_route(path='/menu',methods=['get'],endpoint=pageinfo.left_page,description='菜单')
 sys_router.add_api_route(path='/pagecontent',methods=['get'],endpoint=pageinfo.right_page,description='内容查询')
@@ -18,4 +20,21 @@ sys_router.add_api_route(path='/data_backup',methods=['get'],endpoint=pageinfo.d
 sys_router.add_api_route(path='/system_settings',methods=['get'],endpoint=pageinfo.system_settings,description='系统设置')
 sys_router.add_api_route(path='/right_settings',methods=['get'],endpoint=pageinfo.right_settings,description='权限管理')
 sys_router.add_api_route(path='/doc_upload',methods=['post'],endpoint=pageinfo.file_upload,description='文件上传')
-sys_router.add_api_route(path='/text-to-sql',methods=['post'],endpoint=nlp2sql.query,description='text-to-sql查询')
\ No newline at end of file
+sys_router.add_api_route(path='/doc_upload/sessions',methods=['post'],endpoint=pageinfo.upload_session_create,description='创建分片上传会话')
+sys_router.add_api_route(path='/doc_upload/sessions/{upload_id}',methods=['get'],endpoint=pageinfo.upload_session_status,description='查询分片上传进度')
+sys_router.add_api_route(path='/doc_upload/sessions/{upload_id}',methods=['put'],endpoint=pageinfo.upload_session_chunk,description='上传分片')
+sys_router.add_api_route(path='/doc_upload/sessions/{upload_id}/complete',methods=['post'],endpoint=pageinfo.upload_session_complete,description='完成分片上传')
+sys_router.add_api_route(path='/system/pools',methods=['get'],endpoint=pageinfo.pool_stats,description='连接池统计')
+sys_router.add_api_route(path='/ingest/jobs',methods=['get'],endpoint=pageinfo.ingest_jobs,description='入库任务列表')
+sys_router.add_api_route(path='/ingest/jobs/{job_id}',methods=['get'],endpoint=pageinfo.ingest_job,description='查询入库任务进度')
+sys_router.add_api_route(path='/ingest/jobs/{job_id}/events',methods=['get'],endpoint=pageinfo.ingest_job_events,description='入库任务进度推送')
+sys_router.add_api_route(path='/knowledge/documents',methods=['get'],endpoint=knowledge.documents,description='知识库文档列表')
+sys_router.add_api_route(path='/knowledge/documents/{doc_id}',methods=['delete'],endpoint=knowledge.delete_document,description='从知识库删除文档')
+sys_router.add_api_route(path='/knowledge/documents/{doc_id}/tags',methods=['put'],endpoint=knowledge.set_tags,description='设置文档标签')
+sys_router.add_api_route(path='/knowledge/query',methods=['get'],endpoint=knowledge.query,description='知识库查询(关键词+向量)')
+sys_router.add_api_route(path='/knowledge/stats',methods=['get'],endpoint=knowledge.stats,description='知识库统计')
+sys_router.add_api_route(path='/text-to-sql',methods=['post'],endpoint=nlp2sql.query,description='text-to-sql查询')
+sys_router.add_api_route(path='/text-to-sql/stats',methods=['get'],endpoint=nlp2sql.stats,description='text-to-sql运行统计')
+sys_router.add_api_route(path='/text-to-sql/metrics',methods=['get'],endpoint=nlp2sql.metrics,description='text-to-sql Prometheus指标')
+sys_router.add_api_route(path='/text-to-sql/schema/invalidate',methods=['post'],endpoint=nlp2sql.invalidate_schema,description='失效表结构缓存')
+sys_router.add_api_route(path='/text-to-sql/results/{query_id}',methods=['get'],endpoint=nlp2sql.results,description='流式导出查询结果')
\ No newline at end of file
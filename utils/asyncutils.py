@@ -0,0 +1,21 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+import settings
+
+#阻塞调用(同步数据库驱动、向量模型等)统一放到有界线程池中执行，避免阻塞事件循环
+_executor = ThreadPoolExecutor(max_workers=settings.thread_pool['max_workers'],
+                               thread_name_prefix='blocking')
+
+
+async def run_blocking(func: Callable, *args, **kwargs) -> Any:
+    """
+    在有界线程池中执行阻塞函数
+    :param func: 阻塞函数
+    :param args: 位置参数
+    :param kwargs: 关键字参数
+    :return: 函数返回值
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
@@ -20,3 +20,39 @@ def sha256_verify(data: Union[str, bytes], digest: str) -> bool:
     :return: 一致返回 True，否则 False
     """
     return sha256_encrypt(data) == digest
+
+
+class Sha256Stream:
+    """
+    增量计算 SHA256，分块 update 的结果与对完整数据调用 sha256_encrypt 相同
+    """
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def update(self, data: Union[str, bytes]) -> None:
+        """
+        追加数据
+        :param data: 字符串(按utf-8编码)或字节
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._hash.update(data)
+        self.size += len(data)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+def sha256_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    分块计算文件的 SHA256，内存占用不超过一个块
+    :param path: 文件路径
+    :param chunk_size: 每次读取的字节数
+    :return: 十六进制摘要
+    """
+    hasher = Sha256Stream()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()